@@ -1,18 +1,292 @@
+import argparse
+import ctypes
+import ctypes.util
+import datetime
+import os
 import socket
 import struct
-import datetime
+import sys
+import threading
+import time
+from array import array
+
+from token_log import TokenLog
 
 LOGGING_SERVICE_PORT = 9999
 LOGGING_SERVICE_ADDRESS = '224.3.2.1'
 
-# setup socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-sock.bind((LOGGING_SERVICE_ADDRESS, LOGGING_SERVICE_PORT))
-mreq = struct.pack("4sl", socket.inet_aton(LOGGING_SERVICE_ADDRESS), socket.INADDR_ANY)
+# size of single datagram buffer, client messages are "<name> <type> <uuid>"
+DATAGRAM_SIZE = 2048
+
+# recvmmsg flag, block until at least one datagram arrives and return all available
+MSG_WAITFORONE = 0x10000
+
+
+def open_socket(receive_buffer=0):
+    """ Opens socket joined to logging service multicast group, with given kernel receive buffer size if positive """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if receive_buffer > 0:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    sock.bind((LOGGING_SERVICE_ADDRESS, LOGGING_SERVICE_PORT))
+    mreq = struct.pack("4sl", socket.inet_aton(LOGGING_SERVICE_ADDRESS), socket.INADDR_ANY)
+
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return sock
+
+
+def kernel_drops(sock):
+    """ Returns number of datagrams dropped by kernel for socket, read from /proc/net/udp, or None if not available """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    try:
+        with open('/proc/net/udp') as file:
+            next(file)
+            for line in file:
+                fields = line.split()
+                if fields[9] == inode:
+                    return int(fields[12])
+    except OSError:
+        pass
+    return None
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)), ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int)
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+class BatchReceiver:
+    """
+    Receives many datagrams per system call with recvmmsg.
+    Falls back to draining non-blocking socket after blocking receive of the first datagram where recvmmsg is not available.
+    """
+
+    def __init__(self, sock, batch=64):
+        self._sock = sock
+        self._batch = batch
+
+        # preallocated buffers, one per datagram
+        self._buffers = [ctypes.create_string_buffer(DATAGRAM_SIZE) for _ in range(batch)]
+        self._iovecs = (_IOVec * batch)(*[_IOVec(ctypes.cast(b, ctypes.c_void_p), DATAGRAM_SIZE) for b in self._buffers])
+        self._messages = (_MMsgHdr * batch)()
+        for i in range(batch):
+            self._messages[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            self._messages[i].msg_hdr.msg_iovlen = 1
+
+        # find recvmmsg
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._recvmmsg = getattr(libc, 'recvmmsg', None)
+        if self._recvmmsg is not None:
+            self._recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+            self._recvmmsg.restype = ctypes.c_int
+
+    def receive(self):
+        """ Blocks until datagrams arrive, returns list of them """
+        if self._recvmmsg is None:
+            return self._drain()
+
+        count = self._recvmmsg(self._sock.fileno(), self._messages, self._batch, MSG_WAITFORONE, None)
+        if count < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        return [self._buffers[i].raw[:self._messages[i].msg_len] for i in range(count)]
+
+    def _drain(self):
+        datagrams = [self._sock.recv(DATAGRAM_SIZE)]
+        while len(datagrams) < self._batch:
+            try:
+                datagrams.append(self._sock.recv(DATAGRAM_SIZE, socket.MSG_DONTWAIT))
+            except BlockingIOError:
+                break
+        return datagrams
+
+
+class RingBuffer:
+    """
+    Preallocated ring buffer of parsed token events, written by receiver and read by consumer thread.
+    Events not fitting into full buffer are dropped and counted.
+    """
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.dropped = 0
+
+        # event fields, in preallocated columns
+        self.times = array('d', [0.]) * capacity
+        self.types = array('i', [0]) * capacity
+        self.uuids = array('q', [0]) * capacity
+        self.clients = [b''] * capacity
+
+        # positions only grow, index is position modulo capacity
+        self._head = 0
+        self._tail = 0
+        self._condition = threading.Condition()
+
+    def put(self, timestamp, datagrams):
+        """ Parses datagrams received at given time and appends them """
+        head = self._head
+        free = self.capacity - (head - self._tail)
+
+        for datagram in datagrams:
+            if not free:
+                self.dropped += 1
+                continue
+            try:
+                client, token_type, uuid = datagram.split(b' ', 2)
+                token_type, uuid = int(token_type), int(uuid)
+            except ValueError:
+                continue
+
+            index = head % self.capacity
+            self.times[index] = timestamp
+            self.clients[index] = client
+            self.types[index] = token_type
+            self.uuids[index] = uuid
+            head += 1
+            free -= 1
+
+        with self._condition:
+            self._head = head
+            self._condition.notify()
+
+    def take(self, timeout=None):
+        """ Waits for events, returns range of their positions, which have to be released after reading """
+        with self._condition:
+            if self._head == self._tail:
+                self._condition.wait(timeout)
+            return range(self._tail, self._head)
+
+    def release(self, positions):
+        with self._condition:
+            self._tail = positions.stop
+
+
+def print_events(ring, positions, file=sys.stdout):
+    """ Writes events in the same format as simple receiver """
+    lines = []
+    for position in positions:
+        index = position % ring.capacity
+        lines.append(f'{datetime.datetime.fromtimestamp(ring.times[index])} Client: {ring.clients[index].decode()} '
+                     f'Type: {ring.types[index]} UUID: {ring.uuids[index]}\n')
+    file.write(''.join(lines))
+    file.flush()
+
+
+def log_events(ring, positions, log):
+    """ Appends events to binary token log """
+    events = []
+    for position in positions:
+        index = position % ring.capacity
+        events.append((ring.times[index], ring.clients[index].decode(), ring.types[index], ring.uuids[index]))
+    log.append_many(events)
+
+
+def receive_simple(sock, log=None):
+    """ Receives and prints datagrams one by one, appending them to token log if given """
+    while True:
+        data = sock.recv(10240).decode("utf-8").split(" ")
+        now = datetime.datetime.now()
+        print(now, "Client:", data[0], "Type:", data[1], "UUID:", data[2])
+        if log is not None:
+            log.append(now.timestamp(), data[0], int(data[1]), int(data[2]))
+
+
+def receive_fast(sock, batch, capacity, sink, stats_interval):
+    """ Receives datagrams in batches into ring buffer, consumer thread passes them to sink, statistics are reported to stderr """
+    receiver = BatchReceiver(sock, batch)
+    ring = RingBuffer(capacity)
+    received = [0]
+
+    def consume():
+        while True:
+            positions = ring.take(timeout=1.)
+            if positions:
+                sink(ring, positions)
+                ring.release(positions)
+
+    def report():
+        last, last_time = 0, time.monotonic()
+        while True:
+            time.sleep(stats_interval)
+            now, count = time.monotonic(), received[0]
+            print(f'{(count - last) / (now - last_time):.0f} msg/s, received {count}, '
+                  f'dropped by kernel {kernel_drops(sock)}, dropped by ring buffer {ring.dropped}', file=sys.stderr)
+            last, last_time = count, now
+
+    threading.Thread(target=consume, name='consumer', daemon=True).start()
+    if stats_interval > 0:
+        threading.Thread(target=report, name='stats', daemon=True).start()
+
+    while True:
+        datagrams = receiver.receive()
+        received[0] += len(datagrams)
+        ring.put(time.time(), datagrams)
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Logging service of token ring clients')
+
+    parser.add_argument('-f', '--fast',
+                        action='store_true',
+                        help='Receive in batches into ring buffer, writing events on separate thread'
+                        )
+    parser.add_argument('-r', '--receive-buffer',
+                        type=int,
+                        default=8 * 1024 * 1024,
+                        help='Kernel receive buffer size in bytes in fast mode, limited by net.core.rmem_max'
+                        )
+    parser.add_argument('-b', '--batch',
+                        type=int,
+                        default=64,
+                        help='Maximum number of datagrams received in single system call'
+                        )
+    parser.add_argument('-c', '--capacity',
+                        type=int,
+                        default=65536,
+                        help='Number of events kept in ring buffer'
+                        )
+    parser.add_argument('-o', '--output',
+                        help='File to append events to instead of printing them'
+                        )
+    parser.add_argument('-s', '--stats-interval',
+                        type=float,
+                        default=5.,
+                        help='Seconds between statistics reports, 0 disables them'
+                        )
+    parser.add_argument('-l', '--log',
+                        help='Directory of binary token log to append events to, in fast mode they are printed only with --output'
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_arguments()
+
+    log = TokenLog(args.log, writable=True) if args.log else None
+    if not args.fast:
+        receive_simple(open_socket(), log)
+
+    # setup sink
+    output = open(args.output, 'a') if args.output else None if log else sys.stdout
 
-sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    def sink(ring, positions):
+        if log is not None:
+            log_events(ring, positions, log)
+        if output is not None:
+            print_events(ring, positions, output)
 
-while True:
-    data = sock.recv(10240).decode("utf-8").split(" ")
-    print(datetime.datetime.now(), "Client:", data[0], "Type:", data[1], "UUID:", data[2])
\ No newline at end of file
+    receive_fast(open_socket(args.receive_buffer), args.batch, args.capacity, sink, args.stats_interval)
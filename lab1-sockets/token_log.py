@@ -0,0 +1,300 @@
+"""
+Persistent binary log of token events received by logging service, and tool querying it.
+
+Log is a directory containing:
+    events.log  - header followed by fixed-size records (timestamp, uuid, type, client id), memory-mapped
+    clients.txt - client names, line number is client id
+    index/      - per-client append-only arrays of record positions
+
+Usage:
+    python token_log.py DIR replay [-c CLIENT] [--from T] [--to T]
+    python token_log.py DIR count
+    python token_log.py DIR gaps [-t SECONDS]
+    python token_log.py DIR duplicates
+"""
+import argparse
+import bisect
+import datetime
+import mmap
+import os
+import struct
+from array import array
+from collections import Counter, defaultdict
+
+MAGIC = b'TOKENLOG'
+VERSION = 1
+
+# header: magic, version, record size, number of records
+_HEADER = struct.Struct('<8sIIQ')
+HEADER_SIZE = 64
+
+# record: timestamp, token uuid, token type, client id
+_RECORD = struct.Struct('<dqiI')
+RECORD_SIZE = _RECORD.size
+
+
+class TokenLog:
+    """
+    Append-only log of token events, written by single writer.
+    File grows in chunks and is accessed through memory map, number of records in header is updated after every append,
+    so readers and recovery after crash see only complete records.
+    """
+
+    def __init__(self, directory, writable=False, chunk=1 << 20):
+        """ Opens log in given directory, creating it if writable """
+        self.directory = directory
+        self.writable = writable
+        self._chunk = chunk
+        self._path = os.path.join(directory, 'events.log')
+        self._index_path = os.path.join(directory, 'index')
+
+        if writable:
+            os.makedirs(self._index_path, exist_ok=True)
+            if not os.path.exists(self._path):
+                with open(self._path, 'wb') as file:
+                    file.write(_HEADER.pack(MAGIC, VERSION, RECORD_SIZE, 0).ljust(HEADER_SIZE, b'\0'))
+
+        # map events
+        self._file = open(self._path, 'r+b' if writable else 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, version, record_size, self._count = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            raise ValueError(f'{self._path} is not token log of version {VERSION}')
+
+        # load clients
+        self.clients = []
+        self._client_ids = {}
+        clients_path = os.path.join(directory, 'clients.txt')
+        if os.path.exists(clients_path):
+            with open(clients_path) as file:
+                for name in file.read().splitlines():
+                    self._add_client(name)
+        self._clients_file = open(clients_path, 'a') if writable else None
+
+        # index positions waiting to be appended and open index files, by client id
+        self._pending_index = defaultdict(lambda: array('Q'))
+        self._index_files = {}
+        if writable:
+            self._trim_index()
+
+    def __len__(self):
+        return self._count
+
+    def _add_client(self, name):
+        self._client_ids[name] = len(self.clients)
+        self.clients.append(name)
+
+    def _client_id(self, name):
+        client_id = self._client_ids.get(name)
+        if client_id is None:
+            self._add_client(name)
+            client_id = len(self.clients) - 1
+            self._clients_file.write(name + '\n')
+            self._clients_file.flush()
+        return client_id
+
+    def append_many(self, events):
+        """ Appends events given as (timestamp, client, type, uuid) tuples """
+        records = []
+        position = self._count
+        for timestamp, client, token_type, uuid in events:
+            client_id = self._client_id(client)
+            records.append(_RECORD.pack(timestamp, uuid, token_type, client_id))
+            self._pending_index[client_id].append(position)
+            position += 1
+
+        # grow file by whole chunks
+        start = HEADER_SIZE + self._count * RECORD_SIZE
+        end = start + len(records) * RECORD_SIZE
+        if end > len(self._map):
+            self._map.resize(end + self._chunk * RECORD_SIZE)
+
+        # write records, then index, then publish them in header
+        self._map[start:end] = b''.join(records)
+        self._write_index()
+        self._count = position
+        _HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD_SIZE, position)
+
+    def append(self, timestamp, client, token_type, uuid):
+        self.append_many([(timestamp, client, token_type, uuid)])
+
+    def _trim_index(self):
+        """ Removes index entries of records not published in header, left by crash between index and header writes """
+        for client_id in range(len(self.clients)):
+            path = os.path.join(self._index_path, f'{client_id}.pos')
+            if not os.path.exists(path):
+                continue
+            positions = array('Q')
+            with open(path, 'rb') as file:
+                positions.frombytes(file.read())
+            valid = bisect.bisect_left(positions, self._count)
+            if valid < len(positions):
+                os.truncate(path, valid * positions.itemsize)
+
+    def _write_index(self):
+        for client_id, positions in self._pending_index.items():
+            file = self._index_files.get(client_id)
+            if file is None:
+                file = self._index_files[client_id] = open(os.path.join(self._index_path, f'{client_id}.pos'), 'ab', buffering=0)
+            positions.tofile(file)
+        self._pending_index.clear()
+
+    def _column(self, offset, code):
+        """ Returns values of record field at given offset as list, read directly from memory map """
+        step = RECORD_SIZE // struct.calcsize(code)
+        view = memoryview(self._map)[HEADER_SIZE + offset:HEADER_SIZE + offset + self._count * RECORD_SIZE]
+        # view length has to be multiple of item size, last record is cut after the field
+        view = view[:len(view) - len(view) % struct.calcsize(code)]
+        try:
+            return view.cast(code)[::step].tolist()
+        finally:
+            view.release()
+
+    def times(self):
+        return self._column(0, 'd')
+
+    def uuids(self):
+        return self._column(8, 'q')
+
+    def types(self):
+        return self._column(16, 'i')
+
+    def client_ids(self):
+        return self._column(20, 'I')
+
+    def event(self, position):
+        """ Returns event at given position as (timestamp, client, type, uuid) tuple """
+        timestamp, uuid, token_type, client_id = _RECORD.unpack_from(self._map, HEADER_SIZE + position * RECORD_SIZE)
+        return timestamp, self.clients[client_id], token_type, uuid
+
+    def events(self, start=0, stop=None):
+        """ Iterates over events in order of arrival """
+        stop = self._count if stop is None else min(stop, self._count)
+        for position in range(start, stop):
+            yield self.event(position)
+
+    def find(self, timestamp):
+        """ Returns position of the first event not earlier than timestamp, events are logged in order of arrival """
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if struct.unpack_from('<d', self._map, HEADER_SIZE + middle * RECORD_SIZE)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def positions(self, client):
+        """ Returns positions of events of client, read from index """
+        client_id = self._client_ids.get(client)
+        positions = array('Q')
+        if client_id is None:
+            return positions
+
+        try:
+            with open(os.path.join(self._index_path, f'{client_id}.pos'), 'rb') as file:
+                positions.frombytes(file.read())
+        except FileNotFoundError:
+            return positions
+
+        # index can be ahead of header after crash, until log is opened for writing
+        del positions[bisect.bisect_left(positions, self._count):]
+        return positions
+
+    def count_by_client(self):
+        """ Returns number of token passes of every client, by token type """
+        counts = defaultdict(Counter)
+        for (client_id, token_type), count in Counter(zip(self.client_ids(), self.types())).items():
+            counts[self.clients[client_id]][token_type] = count
+        return counts
+
+    def gaps(self, threshold):
+        """ Returns (start, end) times of periods longer than threshold seconds without any token passes """
+        times = self.times()
+        return [(a, b) for a, b in zip(times, times[1:]) if b - a > threshold]
+
+    def duplicates(self):
+        """
+        Returns pairs of token uuids which circulated in the ring at the same time, with times of their overlap.
+        Every uuid is active from its first to its last pass, ring should have a single active token at any time.
+        """
+        first, last = {}, {}
+        for timestamp, uuid in zip(self.times(), self.uuids()):
+            first.setdefault(uuid, timestamp)
+            last[uuid] = timestamp
+
+        # sweep intervals in order of start, comparing each with intervals still active
+        overlaps = []
+        active = []
+        for uuid in sorted(first, key=first.get):
+            start = first[uuid]
+            active = [other for other in active if last[other] > start]
+            overlaps.extend((other, uuid, start, min(last[other], last[uuid])) for other in active)
+            active.append(uuid)
+        return overlaps
+
+    def close(self):
+        if self.writable:
+            self._write_index()
+            for file in self._index_files.values():
+                file.close()
+            self._map.flush()
+            self._clients_file.close()
+        self._map.close()
+        self._file.close()
+
+
+def _format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp)
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Query token log of logging service')
+    parser.add_argument('directory', help='Token log directory')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    replay = commands.add_parser('replay', help='Print events')
+    replay.add_argument('-c', '--client', help='Print only events of given client, using index')
+    replay.add_argument('--from', dest='start', type=float, help='Print events since given timestamp')
+    replay.add_argument('--to', dest='end', type=float, help='Print events before given timestamp')
+
+    commands.add_parser('count', help='Count token passes of every client, by token type')
+
+    gaps = commands.add_parser('gaps', help='Find periods without token passes, when token could be lost')
+    gaps.add_argument('-t', '--threshold', type=float, default=1., help='Minimum gap in seconds')
+
+    commands.add_parser('duplicates', help='Find tokens circulating in the ring at the same time')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_arguments()
+    log = TokenLog(args.directory)
+
+    if args.command == 'replay':
+        start = log.find(args.start) if args.start is not None else 0
+        stop = log.find(args.end) if args.end is not None else len(log)
+        if args.client:
+            positions = log.positions(args.client)
+            events = (log.event(p) for p in positions[bisect.bisect_left(positions, start):bisect.bisect_left(positions, stop)])
+        else:
+            events = log.events(start, stop)
+        for timestamp, client, token_type, uuid in events:
+            print(_format_time(timestamp), "Client:", client, "Type:", token_type, "UUID:", uuid)
+
+    elif args.command == 'count':
+        for client, counts in sorted(log.count_by_client().items()):
+            by_type = ', '.join(f'type {t}: {c}' for t, c in sorted(counts.items()))
+            print(f'{client}: {sum(counts.values())} passes ({by_type})')
+
+    elif args.command == 'gaps':
+        for start, end in log.gaps(args.threshold):
+            print(f'{_format_time(start)} - {_format_time(end)}: no token for {end - start:.3f} s')
+
+    elif args.command == 'duplicates':
+        for first, second, start, end in log.duplicates():
+            print(f'Tokens {first} and {second} circulated together from {_format_time(start)} to {_format_time(end)}')
+
+    log.close()
@@ -0,0 +1,129 @@
+"""
+Benchmark of token log at millions of events.
+
+Generates token passing in ring of simulated clients, with token regenerated every so often, one period without
+any passes and one period of two tokens circulating at once. Events are appended in batches, as received by fast
+logging service, then queries are run on reopened log. Durations and rates are reported as JSON.
+
+Run: python token_log_benchmark.py -n 5000000 -c 16
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+from time import perf_counter
+
+from token_log import TokenLog
+
+
+def generate(events, clients, batch, regenerate):
+    """ Yields batches of events of token passed around ring every millisecond, with single gap and duplicate injected """
+    names = [f'client{i}' for i in range(clients)]
+    timestamp = 1.6e9
+    uuid = random.getrandbits(31)
+    duplicate = None
+    buffer = []
+
+    for i in range(events):
+        timestamp += 0.001
+        if i == events // 3:
+            timestamp += 10.
+        if i == events // 2:
+            duplicate = random.getrandbits(31)
+        if duplicate is not None and i > events // 2 + 1000:
+            duplicate = None
+        if i and i % regenerate == 0:
+            uuid = random.getrandbits(31)
+
+        # duplicated token is passed alongside the valid one
+        token = duplicate if duplicate is not None and i % 2 else uuid
+        buffer.append((timestamp, names[i % clients], 1, token))
+        if len(buffer) == batch:
+            yield buffer
+            buffer = []
+
+    if buffer:
+        yield buffer
+
+
+def _measure(report, name, function, *args):
+    start = perf_counter()
+    result = function(*args)
+    report[name] = perf_counter() - start
+    return result
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Token log benchmark')
+
+    parser.add_argument('-n', '--events',
+                        type=int,
+                        default=5_000_000,
+                        help='Number of logged events'
+                        )
+    parser.add_argument('-c', '--clients',
+                        type=int,
+                        default=16,
+                        help='Number of clients in ring'
+                        )
+    parser.add_argument('-b', '--batch',
+                        type=int,
+                        default=64,
+                        help='Number of events appended at once'
+                        )
+    parser.add_argument('-r', '--regenerate',
+                        type=int,
+                        default=100_000,
+                        help='Number of passes after which token is regenerated with new uuid'
+                        )
+    parser.add_argument('-d', '--directory',
+                        help='Directory of token log, temporary one is created and removed if omitted'
+                        )
+
+    return parser.parse_args()
+
+
+def _benchmark(args, directory):
+    report = {'config': {'events': args.events, 'clients': args.clients, 'batch': args.batch}}
+
+    # append, generation is done upfront to measure log only
+    batches = list(generate(args.events, args.clients, args.batch, args.regenerate))
+    log = TokenLog(directory, writable=True)
+    start = perf_counter()
+    for batch in batches:
+        log.append_many(batch)
+    log.close()
+    report['append'] = perf_counter() - start
+    report['append_rate'] = args.events / report['append']
+    report['size_bytes'] = os.path.getsize(os.path.join(directory, 'events.log'))
+
+    # queries on reopened log
+    log = TokenLog(directory)
+    counts = _measure(report, 'count_by_client', log.count_by_client)
+    positions = _measure(report, 'client_index', log.positions, 'client0')
+    _measure(report, 'client_replay', lambda: sum(1 for p in positions if log.event(p)))
+    _measure(report, 'find', log.find, 1.6e9 + args.events / 2000)
+    gaps = _measure(report, 'gaps', log.gaps, 1.)
+    duplicates = _measure(report, 'duplicates', log.duplicates)
+    _measure(report, 'replay', lambda: sum(1 for _ in log.events()))
+    log.close()
+
+    report['results'] = {
+        'passes': sum(sum(c.values()) for c in counts.values()),
+        'client0_passes': len(positions),
+        'gaps': len(gaps),
+        'duplicates': len(duplicates),
+    }
+    return report
+
+
+if __name__ == '__main__':
+    args = _parse_arguments()
+    directory = args.directory or tempfile.mkdtemp(prefix='token-log-')
+    try:
+        print(json.dumps(_benchmark(args, directory), indent=2))
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory)
@@ -2,7 +2,7 @@ import atexit
 
 from termcolor import colored
 
-from hospital import Producer, Consumer
+from hospital import Producer, Consumer, decode
 
 
 class Administrator:
@@ -17,7 +17,8 @@ class Administrator:
         self._examinations_consumer.start_consuming()
 
     def _handle_examinations(self, channel, method, props, body):
-        print(colored(f'[{method.routing_key}] {body.decode()}', "grey"))
+        message = decode(body)
+        print(colored(f'[{method.routing_key}] {message.patient} {message.examination} {message.doctor}', "grey"))
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
     def send_announcement(self, message):
@@ -1,8 +1,9 @@
 import atexit
+from time import time
 
 from termcolor import colored
 
-from hospital import Producer, Consumer
+from hospital import URGENT, Consumer, Requester, decode, encode, new_request
 
 
 class Doctor:
@@ -10,13 +11,8 @@ class Doctor:
     def __init__(self, name):
         self._name = name
 
-        # setup producer
-        self._examinations_producer = Producer('localhost', 'examinations', 'topic')
-
-        # setup consumer for examination results
-        self._examinations_consumer = Consumer('localhost', 'examinations', 'topic')
-        self._examinations_consumer.register_queue(key=f"result.{name}", callback=self._handle_examinations)
-        self._examinations_consumer.start_consuming()
+        # setup requester of examinations, results are returned to it directly
+        self._examinations = Requester('localhost', 'examinations', 'topic', persistent=True, decoder=decode)
 
         # setup consumer for announcements
         self._announcements_consumer = Consumer('localhost', 'announcements', 'fanout')
@@ -27,26 +23,37 @@ class Doctor:
         print(colored("[A] " + body.decode(), "cyan"))
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
-    def _handle_examinations(self, channel, method, props, body):
-        result = body.decode().split(" ")
-        print(colored(f'Received results of {result[1]} examination for {result[0]}', 'green'))
-        channel.basic_ack(delivery_tag=method.delivery_tag)
-
-    def request_examination(self, patient, examination):
-        self._examinations_producer.send(f'{patient} {examination} {self._name}', key=f'exam.{examination}')
+    def request_examination(self, patient, examination, urgent=False, timeout=None):
+        """ Requests examination, returns future of its result """
+        request = new_request(patient, examination, self._name)
+        return self._examinations.request(encode(request), key=f'exam.{examination}', correlation_id=request.request_id.hex(),
+                                          priority=URGENT if urgent else None, timeout=timeout)
 
     def close(self):
-        self._examinations_producer.close()
-        self._examinations_consumer.close()
+        self._examinations.close()
         self._announcements_consumer.close()
 
 
+def _print_result(future):
+    if future.cancelled():
+        return
+    try:
+        result = future.result()
+    except TimeoutError as err:
+        print(colored(f'Examination not completed: {err}', 'red'))
+        return
+    print(colored(f'Received results of {result.examination} examination for {result.patient} after {time() - result.requested:.2f} s', 'green'))
+
+
 if __name__ == '__main__':
     doctor = Doctor(input("Enter doctor name: "))
     atexit.register(doctor.close)
 
-    print("Enter requests in format: <patient> <type>")
+    print("Enter requests in format: <patient> <type> [!], patient name can contain spaces, ! marks urgent examination")
 
     while True:
-        request = input("> ").split(" ")
-        doctor.request_examination(request[0], request[1])
+        request = input("> ")
+        urgent = request.endswith(" !")
+        request = request[:-2] if urgent else request
+        patient, examination = request.rsplit(" ", 1)
+        doctor.request_examination(patient, examination, urgent, timeout=60.).add_done_callback(_print_result)
@@ -1,22 +1,29 @@
+import argparse
 import atexit
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
 from time import sleep
 
 from termcolor import colored
 
-from hospital import Producer, Consumer
+from hospital import EXAMINATIONS, Producer, Consumer, decode, encode, new_result
 
 
 class Specialist:
 
-    def __init__(self, examination_types):
+    def __init__(self, examination_types, workers=4, prefetch_count=None):
+        # setup pool running examinations outside of connection thread, keep it busy by default
+        self._workers = ThreadPoolExecutor(max_workers=workers)
+        if prefetch_count is None:
+            prefetch_count = workers
+
         # setup results producer
         self._examinations_producer = Producer('localhost', 'examinations', 'topic')
 
         # setup consumer for examination requests
-        self._examinations_consumer = Consumer('localhost', 'examinations', 'topic')
+        self._examinations_consumer = Consumer('localhost', 'examinations', 'topic', prefetch_count)
         for t in examination_types:
-            self._examinations_consumer.register_queue(name=t, key=f"exam.{t}", callback=self._handle_examinations)
+            self._examinations_consumer.register_queue(name=t, key=f"exam.{t}", callback=self._handle_examinations, policy=EXAMINATIONS)
         self._examinations_consumer.start_consuming()
 
         # setup consumer for announcements
@@ -29,22 +36,55 @@ class Specialist:
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
     def _handle_examinations(self, channel, method, props, body):
-        request = body.decode().split(" ")
-        print(colored(f'Received request for {request[1]} examination for {request[0]} from {request[2]}', 'blue'))
+        self._workers.submit(self._examine, channel, method, props, body)
+
+    def _examine(self, channel, method, props, body):
+        # failed examination is retried later, and eventually moved to dead letter queue
+        try:
+            self._perform_examination(props, body)
+        except Exception as err:
+            print(colored(f'Examination failed: {err}', 'red'))
+            self._examinations_consumer.reject(channel, method, props, body)
+        else:
+            self._examinations_consumer.ack(channel, method.delivery_tag)
+
+    def _perform_examination(self, props, body):
+        request = decode(body)
+        print(colored(f'Received request for {request.examination} examination for {request.patient} from {request.doctor}', 'blue'))
 
         sleep(randint(1, 3))
 
-        self._examinations_producer.send(f'{request[0]} {request[1]}', key=f'result.{request[2]}')
-        print(colored(f'Results of {request[1]} examination for {request[0]} has been sent to {request[2]}', 'green'))
-        channel.basic_ack(delivery_tag=method.delivery_tag)
+        # reply to doctor, and publish result for observers
+        result = encode(new_result(request))
+        self._examinations_producer.reply(result, props)
+        self._examinations_producer.send(result, key=f'result.{request.doctor}', correlation_id=props.correlation_id)
+        print(colored(f'Results of {request.examination} examination for {request.patient} has been sent to {request.doctor}', 'green'))
 
     def close(self):
+        self._workers.shutdown()
         self._examinations_producer.close()
         self._examinations_consumer.close()
         self._announcements_consumer.close()
 
 
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Hospital specialist')
+
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=4,
+                        help='Number of examinations performed at once'
+                        )
+    parser.add_argument('-p', '--prefetch',
+                        type=int,
+                        help='Number of unacknowledged examination requests, equal to number of workers if omitted'
+                        )
+
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    specialist = Specialist(input("Enter examination types: ").split(" "))
+    args = _parse_arguments()
+    specialist = Specialist(input("Enter examination types: ").split(" "), args.workers, args.prefetch)
     atexit.register(specialist.close)
 
@@ -0,0 +1,242 @@
+"""
+End-to-end benchmark of examination round trip, Doctor -> Specialist -> Doctor.
+
+Runs simulated doctors and specialists in single event loop, against local broker or in-process fake.
+Every message is stamped in its properties: correlation id is request id, headers carry times of sending request,
+starting and completing examination. Round trip is split into queue wait, service time and result delivery,
+their percentiles and throughput are reported as JSON.
+
+Run: python benchmark.py -d 50 -s 10 -r 20 -t exp:0.05 --fake
+"""
+import argparse
+import asyncio
+import json
+import random
+from time import time
+
+import hospital_async
+import fake_broker
+from hospital import QueuePolicy, decode, encode, new_request, new_result
+
+EXAMINATION_TYPES = ['knee', 'hip', 'elbow']
+
+# exchange and queues separate from those of running hospital
+EXCHANGE = 'bench.examinations'
+POLICY = QueuePolicy()
+
+
+def _service_time(value):
+    """ Parses distribution of service time in seconds: const:T, uniform:A:B, exp:MEAN or lognormal:MU:SIGMA """
+    kind, *params = value.split(':')
+    params = [float(p) for p in params]
+    distributions = {
+        'const': lambda t: lambda: t,
+        'uniform': lambda a, b: lambda: random.uniform(a, b),
+        'exp': lambda mean: lambda: random.expovariate(1 / mean),
+        'lognormal': lambda mu, sigma: lambda: random.lognormvariate(mu, sigma),
+    }
+    if kind not in distributions:
+        raise argparse.ArgumentTypeError(f'unknown distribution {kind}, available: {", ".join(distributions)}')
+    try:
+        return distributions[kind](*params)
+    except TypeError:
+        raise argparse.ArgumentTypeError(f'wrong number of parameters of {kind} distribution')
+
+
+class _Stats:
+    """ Stage durations of completed round trips """
+
+    def __init__(self):
+        self.stages = {'round_trip': [], 'queue_wait': [], 'service': [], 'result_delivery': []}
+        self.sent = 0
+
+        # times of sending first request and receiving last result
+        self.first_sent = None
+        self.last_received = None
+
+    def record_sent(self, sent):
+        self.sent += 1
+        if self.first_sent is None:
+            self.first_sent = sent
+
+    def record(self, headers, received):
+        sent, started, completed = headers['sent'], headers['started'], headers['completed']
+        self.last_received = received
+        self.stages['round_trip'].append(received - sent)
+        self.stages['queue_wait'].append(started - sent)
+        self.stages['service'].append(completed - started)
+        self.stages['result_delivery'].append(received - completed)
+
+    def report(self):
+        """ Returns report of stage durations, throughput is measured from sending first request to receiving last result """
+        completed = len(self.stages['round_trip'])
+        duration = self.last_received - self.first_sent if completed else 0.
+        report = {
+            'duration': duration,
+            'sent': self.sent,
+            'completed': completed,
+            'throughput': completed / duration if duration > 0 else 0.,
+        }
+        for stage, values in self.stages.items():
+            values = sorted(values)
+            if not values:
+                continue
+            report[stage] = {
+                'mean': sum(values) / len(values),
+                'p50': values[int(len(values) * 0.5)],
+                'p90': values[int(len(values) * 0.9)],
+                'p99': values[int(len(values) * 0.99)],
+                'max': values[-1],
+            }
+        return report
+
+
+class BenchDoctor:
+    """ Requests examinations at random intervals and records round trips of results """
+
+    def __init__(self, broker, connection, name, stats):
+        self._name = name
+        self._stats = stats
+        self._producer = broker.Producer(connection, EXCHANGE, 'topic')
+        self._consumer = broker.Consumer(connection, EXCHANGE, 'topic', prefetch_count=100)
+
+    async def open(self):
+        await self._producer.open()
+        await self._consumer.open()
+        await self._consumer.register_queue(key=f'result.{self._name}', callback=self._handle_result)
+
+    async def _handle_result(self, message):
+        self._stats.record(message.headers, time())
+
+    async def run(self, rate, until):
+        """ Sends requests as Poisson process with given rate per second """
+        patients = 0
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            if time() >= until:
+                return
+            patients += 1
+            examination = random.choice(EXAMINATION_TYPES)
+            request = new_request(f'patient-{patients}', examination, self._name)
+            sent = time()
+            await self._producer.send(encode(request), key=f'exam.{examination}', correlation_id=request.request_id.hex(),
+                                      headers={'sent': sent})
+            self._stats.record_sent(sent)
+
+
+class BenchSpecialist:
+    """ Performs examinations of all types, taking time drawn from service time distribution """
+
+    def __init__(self, broker, connection, service_time, prefetch_count):
+        self._service_time = service_time
+        self._producer = broker.Producer(connection, EXCHANGE, 'topic')
+        self._consumer = broker.Consumer(connection, EXCHANGE, 'topic', prefetch_count)
+
+    async def open(self):
+        await self._producer.open()
+        await self._consumer.open()
+        for t in EXAMINATION_TYPES:
+            await self._consumer.register_queue(name=f'bench.{t}', key=f'exam.{t}', callback=self._handle_request, policy=POLICY)
+
+    async def _handle_request(self, message):
+        started = time()
+        request = decode(message.body)
+        await asyncio.sleep(self._service_time())
+
+        headers = dict(message.headers, started=started, completed=time())
+        await self._producer.send(encode(new_result(request)), key=f'result.{request.doctor}', correlation_id=message.correlation_id,
+                                  headers=headers)
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Examination round trip benchmark')
+
+    parser.add_argument('-d', '--doctors',
+                        type=int,
+                        default=20,
+                        help='Number of simulated doctors'
+                        )
+    parser.add_argument('-s', '--specialists',
+                        type=int,
+                        default=5,
+                        help='Number of simulated specialists'
+                        )
+    parser.add_argument('-r', '--rate',
+                        type=float,
+                        default=5.,
+                        help='Examination requests per second of single doctor'
+                        )
+    parser.add_argument('-t', '--service-time',
+                        type=_service_time,
+                        default=_service_time('exp:0.05'),
+                        help='Distribution of examination time in seconds: const:T, uniform:A:B, exp:MEAN or lognormal:MU:SIGMA'
+                        )
+    parser.add_argument('-p', '--prefetch',
+                        type=int,
+                        default=4,
+                        help='Number of examinations performed at once by single specialist'
+                        )
+    parser.add_argument('-D', '--duration',
+                        type=float,
+                        default=10.,
+                        help='Seconds of sending requests'
+                        )
+    parser.add_argument('-g', '--grace',
+                        type=float,
+                        default=5.,
+                        help='Seconds of waiting for outstanding results after sending stops'
+                        )
+    parser.add_argument('-f', '--fake',
+                        action='store_true',
+                        help='Use in-process fake broker instead of RabbitMQ'
+                        )
+    parser.add_argument('-H', '--host',
+                        default='localhost',
+                        help='Address of RabbitMQ broker'
+                        )
+    parser.add_argument('-o', '--output',
+                        help='File to write JSON report to, printed if omitted'
+                        )
+
+    return parser.parse_args()
+
+
+async def _benchmark(args):
+    broker = fake_broker if args.fake else hospital_async
+    connection = broker.Connection(args.host)
+    await connection.connect()
+
+    # setup roles
+    stats = _Stats()
+    doctors = [BenchDoctor(broker, connection, f'doctor{i}', stats) for i in range(args.doctors)]
+    specialists = [BenchSpecialist(broker, connection, args.service_time, args.prefetch) for _ in range(args.specialists)]
+    for role in specialists + doctors:
+        await role.open()
+
+    # send requests, then wait for outstanding results
+    start = time()
+    await asyncio.gather(*(doctor.run(args.rate, start + args.duration) for doctor in doctors))
+    deadline = time() + args.grace
+    while len(stats.stages['round_trip']) < stats.sent and time() < deadline:
+        await asyncio.sleep(0.1)
+
+    report = stats.report()
+    report['config'] = {
+        'doctors': args.doctors, 'specialists': args.specialists, 'rate': args.rate, 'prefetch': args.prefetch, 'fake': args.fake
+    }
+
+    await connection.close()
+    return report
+
+
+if __name__ == '__main__':
+    args = _parse_arguments()
+    report = asyncio.run(_benchmark(args))
+
+    # write report
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
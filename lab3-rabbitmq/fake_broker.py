@@ -0,0 +1,172 @@
+"""
+In-process stand-in for broker, with the same Connection, Producer and Consumer interface as hospital_async.
+Routes messages through direct, fanout and topic exchanges to priority queues within the event loop,
+so roles can be run and measured without RabbitMQ. Queue policies are honoured except durability.
+"""
+import asyncio
+import itertools
+from time import time
+
+from hospital import RETRY_EXCHANGE, TRANSIENT, retries
+
+
+class FakeMessage:
+    """ Delivered message, with attributes of aio-pika incoming message used by roles """
+
+    def __init__(self, body, routing_key, priority=None, correlation_id=None, headers=None, timestamp=None, reply_to=None):
+        self.body = body
+        self.routing_key = routing_key
+        self.priority = priority
+        self.correlation_id = correlation_id
+        self.reply_to = reply_to
+        self.headers = headers or {}
+        self.timestamp = timestamp
+
+
+class _Queue:
+
+    def __init__(self, name, policy):
+        self.name = name
+        self.policy = policy
+        self.messages = asyncio.PriorityQueue()
+        self._order = itertools.count()
+
+    def put(self, message):
+        # higher priority first, then in order of arrival
+        priority = min(message.priority or 0, self.policy.max_priority)
+        self.messages.put_nowait((-priority, next(self._order), message))
+
+    async def get(self):
+        return (await self.messages.get())[2]
+
+
+def _topic_matches(binding, routing):
+    """ Checks if words of routing key match words of topic binding key, * matches single word and # any number of words """
+    if not binding:
+        return not routing
+    if binding[0] == '#':
+        return _topic_matches(binding[1:], routing) or bool(routing) and _topic_matches(binding, routing[1:])
+    return bool(routing) and binding[0] in ('*', routing[0]) and _topic_matches(binding[1:], routing[1:])
+
+
+class Connection:
+    """ In-memory broker, address is ignored """
+
+    def __init__(self, address='localhost'):
+        self._exchanges = {}
+        self._queues = {}
+        self._names = itertools.count()
+        self._tasks = []
+
+    async def connect(self):
+        pass
+
+    def exchange(self, name, exchange_type):
+        self._exchanges.setdefault(name, (exchange_type, []))
+
+    def queue(self, name='', policy=TRANSIENT):
+        if not name:
+            name = f'fake.gen-{next(self._names)}'
+        if name not in self._queues:
+            self._queues[name] = _Queue(name, policy)
+        return self._queues[name]
+
+    def bind(self, queue, exchange_name, key):
+        # binding the same queue with the same key again has no effect, like in broker
+        _, bindings = self._exchanges[exchange_name]
+        if not any(k == key and q is queue for k, _, q in bindings):
+            bindings.append((key, key.split('.'), queue))
+
+    def publish(self, exchange_name, message):
+        """ Routes message to queues bound to exchange, message to default exchange goes to queue named by its key """
+        if not exchange_name:
+            self.queue(message.routing_key).put(message)
+            return
+
+        exchange_type, bindings = self._exchanges[exchange_name]
+        routing = message.routing_key.split('.')
+        for key, words, queue in bindings:
+            if exchange_type == 'fanout' \
+                    or exchange_type == 'direct' and key == message.routing_key \
+                    or exchange_type == 'topic' and _topic_matches(words, routing):
+                queue.put(message)
+
+    def start(self, coroutine):
+        self._tasks.append(asyncio.ensure_future(coroutine))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class Producer:
+
+    def __init__(self, connection, exchange_name, exchange_type, persistent=False):
+        self._connection = connection
+        self._exchange_name = exchange_name
+        self._exchange_type = exchange_type
+
+    async def open(self):
+        self._connection.exchange(self._exchange_name, self._exchange_type)
+
+    async def send(self, message, key='', priority=None, correlation_id=None, headers=None):
+        body = message.encode() if isinstance(message, str) else message
+        self._connection.publish(self._exchange_name, FakeMessage(body, key, priority, correlation_id, dict(headers or {}), time()))
+
+    async def send_many(self, messages, key='', priority=None):
+        for message in messages:
+            await self.send(message, key, priority)
+
+    async def reply(self, message, request):
+        if request.reply_to:
+            body = message.encode() if isinstance(message, str) else message
+            self._connection.publish('', FakeMessage(body, request.reply_to, correlation_id=request.correlation_id, timestamp=time()))
+
+
+class Consumer:
+
+    def __init__(self, connection, exchange_name, exchange_type, prefetch_count=1):
+        self._connection = connection
+        self._exchange_name = exchange_name
+        self._exchange_type = exchange_type
+        self._prefetch_count = prefetch_count
+
+    async def open(self):
+        self._connection.exchange(self._exchange_name, self._exchange_type)
+
+    async def register_queue(self, name='', key='', callback=None, policy=TRANSIENT):
+        """ Consumes queue bound with key, up to prefetch count messages are processed at once """
+        queue = self._connection.queue(name, policy)
+        self._connection.bind(queue, self._exchange_name, key)
+
+        for _ in range(self._prefetch_count):
+            self._connection.start(self._consume(queue, callback))
+
+        return queue.name
+
+    async def _consume(self, queue, callback):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await queue.get()
+            try:
+                await callback(message)
+            except Exception:
+                if not queue.policy.max_retries:
+                    continue
+
+                # consumers move message out of retries to dead letter queue as it is
+                count = retries(message.headers, queue.name)
+                if count >= queue.policy.max_retries:
+                    self._connection.queue(f'{queue.name}.dead').put(message)
+                    continue
+
+                # count rejection and expiration in retry queue the way broker does, latest death first, then retry after delay
+                message.headers['x-death'] = [
+                    {'count': count + 1, 'exchange': RETRY_EXCHANGE, 'queue': f'{queue.name}.retry', 'reason': 'expired', 'routing-keys': [queue.name]},
+                    {'count': count + 1, 'exchange': self._exchange_name, 'queue': queue.name, 'reason': 'rejected', 'routing-keys': [message.routing_key]},
+                ]
+                loop.call_later(queue.policy.retry_delay, queue.put, message)
+
+    async def close(self):
+        pass
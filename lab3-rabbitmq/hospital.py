@@ -1,56 +1,690 @@
-from threading import Thread
+import logging
+import struct
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from threading import Event, Lock, Thread, current_thread
+from time import sleep, time
+from uuid import uuid4
 
-from pika import BlockingConnection, ConnectionParameters
+from pika import BasicProperties, BlockingConnection, ConnectionParameters
+from pika.exceptions import AMQPChannelError, AMQPConnectionError, AMQPError
+
+# examination messages, timestamps are seconds since epoch
+ExaminationRequest = namedtuple('ExaminationRequest', ['request_id', 'created', 'patient', 'examination', 'doctor'])
+ExaminationResult = namedtuple('ExaminationResult', ['request_id', 'requested', 'created', 'patient', 'examination', 'doctor'])
+
+# binary message layout: header followed by length-prefixed UTF-8 strings
+SCHEMA_VERSION = 1
+_HEADER = struct.Struct('!BB16sdd')  # version, kind, request id, request timestamp, message timestamp
+_LENGTH = struct.Struct('!H')
+_REQUEST, _RESULT = 1, 2
+
+logger = logging.getLogger(__name__)
+
+# exchange to which rejected messages of queues with retries are dead-lettered, routed by queue name
+RETRY_EXCHANGE = 'hospital.retry'
+
+
+class QueuePolicy:
+    """
+    Declarative settings of queue.
+
+    Durable queues survive broker restarts and consumers leaving, other queues are deleted with their last consumer.
+    Messages of queues with max priority are delivered in order of priority, from 0 up to max priority.
+    Messages rejected by consumer of queue with retries wait retry delay seconds in retry queue and are delivered again,
+    once they run out of retries they are moved to dead letter queue.
+    """
+
+    def __init__(self, durable=False, max_priority=0, max_retries=0, retry_delay=5.):
+        self.durable = durable
+        self.max_priority = max_priority
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+
+# temporary queues of single consumer, and queues of examination requests
+TRANSIENT = QueuePolicy()
+EXAMINATIONS = QueuePolicy(durable=True, max_priority=10, max_retries=3, retry_delay=5.)
+URGENT = 9
+
+
+def queue_arguments(name, policy):
+    """ Returns arguments of queue with given policy """
+    if (policy.durable or policy.max_retries) and not name:
+        raise ValueError('Durable queues and queues with retries have to be named')
+
+    arguments = {}
+    if policy.max_priority:
+        arguments['x-max-priority'] = policy.max_priority
+    if policy.max_retries:
+        arguments['x-dead-letter-exchange'] = RETRY_EXCHANGE
+        arguments['x-dead-letter-routing-key'] = name
+    return arguments
+
+
+def retry_queue_arguments(name, policy):
+    """ Returns arguments of retry queue of given queue, which sends messages back to it after retry delay """
+    return {
+        'x-message-ttl': int(policy.retry_delay * 1000),
+        'x-dead-letter-exchange': '',
+        'x-dead-letter-routing-key': name
+    }
+
+
+def retries(headers, queue):
+    """ Returns number of times message with given headers was rejected by consumers of queue """
+    deaths = (headers or {}).get('x-death') or []
+    return sum(death.get('count', 1) for death in deaths if death.get('queue') == queue and death.get('reason') == 'rejected')
+
+
+def new_request(patient, examination, doctor):
+    """ Creates examination request with new id, created now """
+    return ExaminationRequest(uuid4().bytes, time(), patient, examination, doctor)
+
+
+def new_result(request):
+    """ Creates result of examination request, created now """
+    return ExaminationResult(request.request_id, request.created, time(), request.patient, request.examination, request.doctor)
+
+
+def encode(message):
+    """ Encodes examination request or result to bytes """
+    if isinstance(message, ExaminationRequest):
+        header = _HEADER.pack(SCHEMA_VERSION, _REQUEST, message.request_id, message.created, message.created)
+    else:
+        header = _HEADER.pack(SCHEMA_VERSION, _RESULT, message.request_id, message.requested, message.created)
+
+    parts = [header]
+    for text in (message.patient, message.examination, message.doctor):
+        data = text.encode()
+        parts.append(_LENGTH.pack(len(data)))
+        parts.append(data)
+
+    return b''.join(parts)
+
+
+def decode(body):
+    """ Decodes examination request or result encoded by encode """
+    version, kind, request_id, requested, created = _HEADER.unpack_from(body)
+    if version != SCHEMA_VERSION:
+        raise ValueError(f'Unsupported message schema version {version}')
+
+    # read strings
+    texts = []
+    offset = _HEADER.size
+    for _ in range(3):
+        length, = _LENGTH.unpack_from(body, offset)
+        offset += _LENGTH.size
+        texts.append(bytes(body[offset:offset + length]).decode())
+        offset += length
+
+    if kind == _REQUEST:
+        return ExaminationRequest(request_id, created, *texts)
+    if kind == _RESULT:
+        return ExaminationResult(request_id, requested, created, *texts)
+    raise ValueError(f'Unknown message kind {kind}')
+
+
+class Connection:
+    """
+    Connection to broker shared by all producers and consumers of the process.
+
+    Single thread drives the connection and runs consumer callbacks, calls from other threads are queued for it
+    and run after connection is reestablished if it was lost. Failures of callbacks and queued calls are logged
+    and do not stop the thread. Exchanges and queues are declared once per connection. Users register setup functions
+    creating their channels, which are called again after the connection is lost and reestablished.
+    """
+
+    _instances = {}
+    _instances_lock = Lock()
+
+    def __init__(self, address, reconnect_delay=1., max_reconnect_delay=30., call_timeout=60.):
+        self._address = address
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._call_timeout = call_timeout
+
+        self._setups = []
+        self._exchanges = set()
+        self._queues = set()
+        self._users = 0
+        self._thread = None
+        self._closed = False
+
+        # calls from other threads waiting for connection thread, guarded by lock together with connection replacement
+        self._calls = deque()
+        self._calls_lock = Lock()
+
+        # setup connection
+        self._connection = BlockingConnection(ConnectionParameters(host=address))
+
+    @classmethod
+    def get(cls, address):
+        """ Returns connection to broker at given address shared within process """
+        with cls._instances_lock:
+            connection = cls._instances.get(address)
+            if connection is None or connection._closed:
+                connection = cls._instances[address] = cls(address)
+            connection._users += 1
+            return connection
+
+    def open(self, setup):
+        """ Opens channel and passes it to setup, which is called again with new channel after reconnection """
+        def open_channel():
+            self._setups.append(setup)
+            setup(self._connection.channel())
+
+        self.call(open_channel)
+
+    def channel(self):
+        """ Opens channel which is not set up again after reconnection, must be called from connection thread """
+        return self._connection.channel()
+
+    def declare_exchange(self, channel, name, exchange_type):
+        if name not in self._exchanges:
+            channel.exchange_declare(exchange=name, exchange_type=exchange_type, durable=True)
+            self._exchanges.add(name)
+
+    def declare_queue(self, channel, name='', policy=TRANSIENT):
+        """ Declares queue with given policy and returns its name, queues without name are always declared as server names them """
+        if name and name in self._queues:
+            return name
+
+        # setup retry and dead letter queues
+        if policy.max_retries:
+            self.declare_exchange(channel, RETRY_EXCHANGE, 'direct')
+            channel.queue_declare(queue=f'{name}.retry', durable=True, arguments=retry_queue_arguments(name, policy))
+            channel.queue_bind(queue=f'{name}.retry', exchange=RETRY_EXCHANGE, routing_key=name)
+            channel.queue_declare(queue=f'{name}.dead', durable=True)
+
+        name = channel.queue_declare(queue=name, durable=policy.durable, auto_delete=not policy.durable,
+                                     arguments=queue_arguments(name, policy)).method.queue
+        self._queues.add(name)
+        return name
+
+    def call(self, function, *args):
+        """
+        Calls function in connection thread and returns its result.
+        Raises AMQPConnectionError if connection thread stopped and TimeoutError if call is not done within call timeout,
+        call which timed out before it was started is not run anymore.
+        """
+
+        # call directly before connection thread is started or from it
+        if self._thread is None or current_thread() is self._thread:
+            return function(*args)
+
+        # pass call to connection thread and wait for it
+        done = Event()
+        result = [None, None]
+        state = {'cancelled': False}
+
+        def run():
+            if state['cancelled']:
+                return
+            try:
+                result[0] = function(*args)
+            except Exception as err:
+                result[1] = err
+            done.set()
+
+        self.call_soon(run)
+
+        deadline = time() + self._call_timeout if self._call_timeout is not None else None
+        while not done.wait(0.1):
+            if not self._thread.is_alive():
+                raise AMQPConnectionError('Connection thread is not running')
+            if deadline is not None and time() >= deadline:
+                state['cancelled'] = True
+                raise TimeoutError(f'Call to connection thread not done within {self._call_timeout} seconds')
+
+        if result[1] is not None:
+            raise result[1]
+        return result[0]
+
+    def call_soon(self, function, *args):
+        """ Schedules call of function in connection thread, without waiting for it """
+        if self._thread is None or current_thread() is self._thread:
+            function(*args)
+            return
+
+        if not self._thread.is_alive():
+            raise AMQPConnectionError('Connection thread is not running')
+
+        # queue call and wake connection thread, if connection is being replaced call is run after reconnection
+        with self._calls_lock:
+            self._calls.append((function, args))
+            connection = self._connection
+        try:
+            connection.add_callback_threadsafe(self._run_calls)
+        except AMQPError:
+            pass
+
+    def _run_calls(self):
+        """ Runs queued calls, in connection thread """
+        while True:
+            with self._calls_lock:
+                if not self._calls:
+                    return
+                function, args = self._calls.popleft()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception('Call in connection thread failed')
+
+    def consume(self, channel, queue, callback, on_error=None, auto_ack=False):
+        """
+        Starts consuming queue on channel, must be called from connection thread.
+        Exception raised by callback is logged and passed to on_error with the message, instead of stopping connection thread.
+        """
+        def guarded(channel, method, props, body):
+            try:
+                callback(channel, method, props, body)
+            except Exception:
+                logger.exception('Handling message from queue %s failed', queue)
+                if on_error is not None:
+                    on_error(channel, method, props, body)
+
+        return channel.basic_consume(queue=queue, on_message_callback=guarded, auto_ack=auto_ack)
+
+    def call_later(self, delay, function):
+        """ Schedules call of function in connection thread after delay in seconds """
+        self.call_soon(lambda: self._connection.call_later(delay, function))
+
+    def start(self):
+        """ Starts connection thread, consuming messages of all channels """
+        with self._instances_lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.start()
+
+    def release(self):
+        """ Called when user stops using connection, connection is closed when it has no more users """
+        with self._instances_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            self._closed = True
+
+        # connection thread closes connection when it notices it is not used anymore
+        if self._thread is None:
+            self._connection.close()
+        elif current_thread() is not self._thread:
+            self._thread.join()
+
+    def _run(self):
+        lost = False
+        while not self._closed:
+            try:
+                if lost:
+                    self._reconnect()
+                    lost = False
+                self._connection.process_data_events(time_limit=1)
+                self._run_calls()
+            except AMQPConnectionError:
+                lost = True
+            except AMQPChannelError:
+                # channel of consumer was closed by broker, set up all channels again on new connection
+                logger.exception('Channel closed by broker, reconnecting')
+                lost = True
+            except Exception:
+                logger.exception('Connection thread call failed')
+
+        if self._connection.is_open:
+            self._connection.close()
+
+    def _reconnect(self):
+        if self._connection.is_open:
+            try:
+                self._connection.close()
+            except AMQPError:
+                pass
+
+        delay = self._reconnect_delay
+        while not self._closed:
+            try:
+                connection = BlockingConnection(ConnectionParameters(host=self._address))
+                break
+            except AMQPConnectionError:
+                sleep(delay)
+                delay = min(delay * 2, self._max_reconnect_delay)
+
+        if self._closed:
+            return
+
+        # calls queued from now on wake up new connection, those queued before are run after setup
+        with self._calls_lock:
+            self._connection = connection
+
+        # declare everything again, auto deleted exchanges and queues are gone with old connection
+        self._exchanges.clear()
+        self._queues.clear()
+        for setup in self._setups:
+            setup(self._connection.channel())
+
+        self._run_calls()
 
 
 class Producer:
+    """
+    Publishes messages to exchange.
+
+    If batch size is positive messages are buffered and published in batches, when batch is full or flush interval passes.
+    Every batch is published in channel transaction, so broker confirms whole batch with single round trip,
+    batches which are not confirmed are published again, up to max retries times.
+    Persistent messages are written to disk by broker, so messages in durable queues survive its restart.
+    """
 
-    def __init__(self, address, exchange_name, exchange_type):
+    def __init__(self, address, exchange_name, exchange_type, batch_size=0, flush_interval=0.05, max_retries=5, persistent=False):
         self._address = address
         self._exchange_name = exchange_name
         self._exchange_type = exchange_type
+        self._delivery_mode = 2 if persistent else 1
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_retries = max_retries
 
-        # setup connection
-        self._connection = BlockingConnection(ConnectionParameters(host=address))
-        self._channel = self._connection.channel()
+        # buffered messages as (message, key, properties, attempts) tuples
+        self._buffer = []
+        self._buffer_lock = Lock()
+        self._flush_scheduled = False
+
+        # delivery counters
+        self.confirmed = 0
+        self.failed = 0
+
+        # setup connection, buffered messages are flushed by connection thread
+        self._connection = Connection.get(address)
+        self._connection.open(self._setup)
+        if batch_size > 0:
+            self._connection.start()
+
+    def _setup(self, channel):
+        self._channel = channel
 
         # setup exchange
-        self._channel.exchange_declare(exchange=exchange_name, exchange_type=exchange_type, auto_delete=True)
+        self._connection.declare_exchange(channel, self._exchange_name, self._exchange_type)
+
+        # setup transactions for batches, and publish messages left after failure, flush timer of lost connection is gone with it
+        if self._batch_size > 0:
+            self._channel.tx_select()
+            with self._buffer_lock:
+                self._flush_scheduled = False
+            self._schedule_flush()
+
+    def send(self, message, key='', priority=None, correlation_id=None, reply_to=None):
+        """ Sends message, correlation id and reply queue are passed in message properties """
+        self.send_many([message], key, priority, correlation_id, reply_to)
+
+    def send_many(self, messages, key='', priority=None, correlation_id=None, reply_to=None):
+        """ Sends many messages with the same routing key and properties, using single call to connection thread """
+        properties = BasicProperties(delivery_mode=self._delivery_mode, priority=priority, correlation_id=correlation_id, reply_to=reply_to)
+
+        if self._batch_size <= 0:
+            self._connection.call(self._send, messages, key, properties)
+            return
+
+        with self._buffer_lock:
+            self._buffer.extend((message, key, properties, 0) for message in messages)
+            full = len(self._buffer) >= self._batch_size
+
+        # flush full batch now, otherwise after flush interval
+        if full:
+            self._connection.call_soon(self._flush)
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        with self._buffer_lock:
+            if self._flush_scheduled or not self._buffer:
+                return
+            self._flush_scheduled = True
+
+        # timer is started in connection thread, flush is scheduled again by next send if it could not be
+        try:
+            self._connection.call_soon(self._start_flush_timer)
+        except Exception:
+            self._cancel_flush()
+            raise
+
+    def _start_flush_timer(self):
+        try:
+            self._connection.call_later(self._flush_interval, self._flush)
+        except Exception:
+            self._cancel_flush()
+            raise
+
+    def _cancel_flush(self):
+        with self._buffer_lock:
+            self._flush_scheduled = False
+
+    def _send(self, messages, key, properties):
+        for message in messages:
+            self._channel.basic_publish(body=message, exchange=self._exchange_name, routing_key=key, properties=properties)
+
+    def reply(self, message, props):
+        """ Sends reply to request with given properties directly to its reply queue, if request expects it """
+        if props.reply_to:
+            self._connection.call(self._reply, message, props.reply_to, props.correlation_id)
+
+    def _reply(self, message, reply_to, correlation_id):
+        properties = BasicProperties(delivery_mode=self._delivery_mode, correlation_id=correlation_id)
+        self._channel.basic_publish(body=message, exchange='', routing_key=reply_to, properties=properties)
+
+        # channel of batching producer is transactional, batches are published and committed within single call,
+        # so commit publishes just the reply instead of leaving it invisible until next batch
+        if self._batch_size > 0:
+            self._channel.tx_commit()
+
+    def flush(self):
+        """ Publishes buffered messages and waits until broker confirms them """
+        if self._batch_size > 0:
+            self._connection.call(self._flush)
+
+    def _flush(self):
+        with self._buffer_lock:
+            buffer, self._buffer = self._buffer, []
+            self._flush_scheduled = False
+
+        # publish in batches, committing every one of them
+        for start in range(0, len(buffer), self._batch_size):
+            batch = buffer[start:start + self._batch_size]
+            try:
+                for message, key, properties, _ in batch:
+                    self._channel.basic_publish(body=message, exchange=self._exchange_name, routing_key=key, properties=properties)
+                self._channel.tx_commit()
+                self.confirmed += len(batch)
+            except AMQPError as err:
+                self._retry(buffer[start:], err)
+                return
+
+    def _retry(self, messages, err):
+        """ Buffers again messages of failed batch and following ones, drops those out of retries """
+        retried = [(message, key, properties, attempts + 1) for message, key, properties, attempts in messages if attempts < self._max_retries]
+        self.failed += len(messages) - len(retried)
+
+        with self._buffer_lock:
+            self._buffer[:0] = retried
 
-    def send(self, message, key=''):
-        self._channel.basic_publish(body=message, exchange=self._exchange_name, routing_key=key)
+        # failed channel is closed by broker, after connection failure connection sets up new channel itself
+        if isinstance(err, AMQPChannelError):
+            self._setup(self._connection.channel())
 
     def close(self):
-        self._channel.close()
+        self.flush()
+        self._connection.call(self._channel.close)
+        self._connection.release()
 
 
 class Consumer:
 
-    def __init__(self, address, exchange_name, exchange_type):
+    def __init__(self, address, exchange_name, exchange_type, prefetch_count=1):
         self._address = address
         self._exchange_name = exchange_name
         self._exchange_type = exchange_type
+        self._prefetch_count = prefetch_count
+        self._queues = []
+
+        # queue names and policies by consumer tags
+        self._consumers = {}
 
         # setup connection
-        self._connection = BlockingConnection(ConnectionParameters(host=address))
-        self._channel = self._connection.channel()
+        self._connection = Connection.get(address)
+        self._connection.open(self._setup)
+
+    def _setup(self, channel):
+        self._channel = channel
 
         # setup exchange
-        self._channel.exchange_declare(exchange=exchange_name, exchange_type=exchange_type, auto_delete=True)
-        self._channel.basic_qos(prefetch_count=1)
+        self._connection.declare_exchange(channel, self._exchange_name, self._exchange_type)
+        self._channel.basic_qos(prefetch_count=self._prefetch_count)
+
+        # setup queues again after reconnection
+        self._consumers.clear()
+        for name, key, callback, policy in self._queues:
+            self._bind_queue(name, key, callback, policy)
 
-    def register_queue(self, name='', key='', callback=None):
+    def register_queue(self, name='', key='', callback=None, policy=TRANSIENT):
+        self._queues.append((name, key, callback, policy))
+        return self._connection.call(self._bind_queue, name, key, callback, policy)
+
+    def _bind_queue(self, name, key, callback, policy):
         # setup queue
-        name = self._channel.queue_declare(queue=name, auto_delete=True).method.queue
+        name = self._connection.declare_queue(self._channel, name, policy)
 
         # bind queue to channel, and register callback
         self._channel.queue_bind(queue=name, exchange=self._exchange_name, routing_key=key)
-        self._channel.basic_consume(queue=name, on_message_callback=callback)
+        consumer_tag = self._connection.consume(self._channel, name, callback, on_error=self._reject)
+        self._consumers[consumer_tag] = (name, policy)
 
         return name
 
+    def ack(self, channel, delivery_tag):
+        """ Acknowledges message received by callback, can be called from any thread """
+        self._connection.call_soon(self._ack, channel, delivery_tag)
+
+    def _ack(self, channel, delivery_tag):
+        # messages of channel closed in the meantime are redelivered by broker anyway
+        if channel.is_open:
+            channel.basic_ack(delivery_tag=delivery_tag)
+
+    def reject(self, channel, method, props, body):
+        """
+        Rejects message received by callback, can be called from any thread.
+        Message is retried after delay or, if it ran out of retries, moved to dead letter queue. Without retries it is dropped.
+        """
+        self._connection.call_soon(self._reject, channel, method, props, body)
+
+    def _reject(self, channel, method, props, body):
+        if not channel.is_open:
+            return
+
+        name, policy = self._consumers.get(method.consumer_tag, ('', TRANSIENT))
+        if policy.max_retries and retries(props.headers, name) >= policy.max_retries:
+            channel.basic_publish(exchange='', routing_key=f'{name}.dead', body=body, properties=props)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+        else:
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+
     def start_consuming(self):
-        Thread(target=self._channel.start_consuming, args=()).start()
+        self._connection.start()
+
+    def close(self):
+        self._connection.call(self._channel.close)
+        self._connection.release()
+
+
+class Requester:
+    """
+    Sends requests and returns futures resolved with their replies.
+
+    Replies come to exclusive queue of the process and are matched to requests by correlation id.
+    Futures can be cancelled, and fail with TimeoutError if reply does not come in time.
+    Requests waiting when connection is reestablished fail with AMQPConnectionError, as their replies are sent
+    to queue of the lost connection and their timeouts were scheduled on it.
+    """
+
+    def __init__(self, address, exchange_name, exchange_type, persistent=False, decoder=None):
+        self._decoder = decoder
+        self._reply_to = None
+
+        # futures of requests waiting for reply, by correlation id
+        self._pending = {}
+        self._pending_lock = Lock()
+
+        # setup producer of requests and consumer of replies
+        self._producer = Producer(address, exchange_name, exchange_type, persistent=persistent)
+        self._connection = Connection.get(address)
+        self._connection.open(self._setup)
+        self._connection.start()
+
+    def _setup(self, channel):
+        self._channel = channel
+
+        # replies to requests sent before reconnection never come, their reply queue is gone with lost connection
+        if self._reply_to is not None:
+            self._fail_pending(AMQPConnectionError('Connection lost before reply came'))
+
+        # setup reply queue, replies are not acknowledged as they are not redelivered anyway
+        self._reply_to = channel.queue_declare(queue='', exclusive=True).method.queue
+        self._connection.consume(channel, self._reply_to, self._handle_reply, auto_ack=True)
+
+    def _fail_pending(self, err):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(err)
+
+    def request(self, message, key='', correlation_id=None, priority=None, timeout=None):
+        """ Sends request and returns future of its reply, decoded if decoder was given """
+        correlation_id = correlation_id or uuid4().hex
+
+        future = Future()
+        with self._pending_lock:
+            self._pending[correlation_id] = future
+        future.add_done_callback(lambda f: self._forget(correlation_id))
+
+        # request which was not sent is not waiting for reply
+        try:
+            self._producer.send(message, key, priority, correlation_id, self._reply_to)
+        except Exception:
+            future.cancel()
+            raise
+
+        if timeout is not None:
+            self._connection.call_later(timeout, lambda: self._expire(correlation_id, timeout))
+
+        return future
+
+    def _forget(self, correlation_id):
+        with self._pending_lock:
+            self._pending.pop(correlation_id, None)
+
+    def _resolve(self, correlation_id):
+        """ Returns future of request, marked as running so that it cannot be cancelled anymore """
+        with self._pending_lock:
+            future = self._pending.pop(correlation_id, None)
+        if future is None or not future.set_running_or_notify_cancel():
+            return None
+        return future
+
+    def _expire(self, correlation_id, timeout):
+        future = self._resolve(correlation_id)
+        if future is not None:
+            future.set_exception(TimeoutError(f'No reply within {timeout} seconds'))
+
+    def _handle_reply(self, channel, method, props, body):
+        # replies to cancelled or expired requests are dropped
+        future = self._resolve(props.correlation_id)
+        if future is None:
+            return
+
+        try:
+            future.set_result(self._decoder(body) if self._decoder else body)
+        except Exception as err:
+            future.set_exception(err)
 
     def close(self):
-        self._channel.close()
+        self._producer.close()
+        self._connection.call(self._channel.close)
+        self._connection.release()
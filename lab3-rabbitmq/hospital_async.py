@@ -0,0 +1,133 @@
+from time import time
+
+import aio_pika
+
+from hospital import RETRY_EXCHANGE, TRANSIENT, queue_arguments, retries, retry_queue_arguments
+
+
+class Connection:
+    """
+    Connection to broker shared by all producers and consumers running in the event loop.
+    Reconnects by itself, exchanges are declared once and producers publish through single shared channel.
+    """
+
+    def __init__(self, address):
+        self._address = address
+        self._connection = None
+        self._channel = None
+        self._exchanges = {}
+
+    async def connect(self):
+        self._connection = await aio_pika.connect_robust(host=self._address)
+        self._channel = await self._connection.channel()
+
+    async def channel(self, prefetch_count=1):
+        """ Opens new channel, used by consumers so that each of them has its own prefetch """
+        channel = await self._connection.channel()
+        await channel.set_qos(prefetch_count=prefetch_count)
+        return channel
+
+    @property
+    def default_exchange(self):
+        return self._channel.default_exchange
+
+    async def exchange(self, name, exchange_type):
+        """ Returns exchange of shared channel, declaring it on first use """
+        exchange = self._exchanges.get(name)
+        if exchange is None:
+            exchange = await self._channel.declare_exchange(name, aio_pika.ExchangeType(exchange_type), durable=True)
+            self._exchanges[name] = exchange
+        return exchange
+
+    async def close(self):
+        await self._connection.close()
+
+
+class Producer:
+
+    def __init__(self, connection, exchange_name, exchange_type, persistent=False):
+        self._connection = connection
+        self._exchange_name = exchange_name
+        self._exchange_type = exchange_type
+        self._delivery_mode = aio_pika.DeliveryMode.PERSISTENT if persistent else aio_pika.DeliveryMode.NOT_PERSISTENT
+        self._exchange = None
+
+    async def open(self):
+        # setup exchange
+        self._exchange = await self._connection.exchange(self._exchange_name, self._exchange_type)
+
+    async def send(self, message, key='', priority=None, correlation_id=None, headers=None):
+        """ Publishes message stamped with current time, correlation id and headers are passed in message properties """
+        body = message.encode() if isinstance(message, str) else message
+        message = aio_pika.Message(body=body, delivery_mode=self._delivery_mode, priority=priority, timestamp=time(),
+                                   correlation_id=correlation_id, headers=headers)
+        await self._exchange.publish(message, routing_key=key)
+
+    async def send_many(self, messages, key='', priority=None):
+        for message in messages:
+            await self.send(message, key, priority)
+
+    async def reply(self, message, request):
+        """ Sends reply to request directly to its reply queue, if request expects it """
+        if request.reply_to:
+            body = message.encode() if isinstance(message, str) else message
+            reply = aio_pika.Message(body=body, delivery_mode=self._delivery_mode, correlation_id=request.correlation_id)
+            await self._connection.default_exchange.publish(reply, routing_key=request.reply_to)
+
+
+class Consumer:
+
+    def __init__(self, connection, exchange_name, exchange_type, prefetch_count=1):
+        self._connection = connection
+        self._exchange_name = exchange_name
+        self._exchange_type = exchange_type
+        self._prefetch_count = prefetch_count
+        self._channel = None
+
+    async def open(self):
+        # setup channel, exchange is declared on shared channel
+        await self._connection.exchange(self._exchange_name, self._exchange_type)
+        self._channel = await self._connection.channel(self._prefetch_count)
+
+    async def register_queue(self, name='', key='', callback=None, policy=TRANSIENT):
+        """
+        Consumes queue bound with key, message is acknowledged when coroutine callback returns without error.
+        Otherwise it is rejected, and retried or moved to dead letter queue according to queue policy.
+        """
+
+        # setup retry and dead letter queues
+        if policy.max_retries:
+            retry_exchange = await self._channel.declare_exchange(RETRY_EXCHANGE, aio_pika.ExchangeType.DIRECT, durable=True)
+            retry_queue = await self._channel.declare_queue(f'{name}.retry', durable=True, arguments=retry_queue_arguments(name, policy))
+            await retry_queue.bind(retry_exchange, routing_key=name)
+            await self._channel.declare_queue(f'{name}.dead', durable=True)
+
+        # setup queue
+        queue = await self._channel.declare_queue(name, durable=policy.durable, auto_delete=not policy.durable,
+                                                  arguments=queue_arguments(name, policy))
+
+        # bind queue to channel, and register callback
+        await queue.bind(self._exchange_name, routing_key=key)
+
+        async def process(message):
+            try:
+                await callback(message)
+            except Exception:
+                await self._reject(message, queue.name, policy)
+                raise
+            await message.ack()
+
+        await queue.consume(process)
+
+        return queue.name
+
+    async def _reject(self, message, name, policy):
+        if policy.max_retries and retries(message.headers, name) >= policy.max_retries:
+            dead = aio_pika.Message(body=message.body, headers=message.headers, priority=message.priority, delivery_mode=message.delivery_mode)
+            await self._channel.default_exchange.publish(dead, routing_key=f'{name}.dead')
+            await message.ack()
+        else:
+            await message.reject(requeue=False)
+
+    async def close(self):
+        await self._channel.close()
@@ -0,0 +1,184 @@
+import argparse
+import asyncio
+import random
+from time import time
+
+from termcolor import colored
+
+from hospital import EXAMINATIONS, URGENT, decode, encode, new_request, new_result
+from hospital_async import Connection, Producer, Consumer
+
+EXAMINATION_TYPES = ['knee', 'hip', 'elbow']
+
+
+class Doctor:
+
+    def __init__(self, connection, name):
+        self._name = name
+        self._examinations_producer = Producer(connection, 'examinations', 'topic', persistent=True)
+        self._examinations_consumer = Consumer(connection, 'examinations', 'topic')
+        self._announcements_consumer = Consumer(connection, 'announcements', 'fanout')
+
+    async def open(self):
+        # setup producer
+        await self._examinations_producer.open()
+
+        # setup consumer for examination results
+        await self._examinations_consumer.open()
+        await self._examinations_consumer.register_queue(key=f"result.{self._name}", callback=self._handle_examinations)
+
+        # setup consumer for announcements
+        await self._announcements_consumer.open()
+        await self._announcements_consumer.register_queue(callback=self._handle_announcements)
+
+    async def _handle_announcements(self, message):
+        print(colored(f'[A -> {self._name}] ' + message.body.decode(), "cyan"))
+
+    async def _handle_examinations(self, message):
+        result = decode(message.body)
+        print(colored(f'{self._name} received results of {result.examination} examination for {result.patient} after {time() - result.requested:.2f} s', 'green'))
+
+    async def request_examination(self, patient, examination, urgent=False):
+        await self._examinations_producer.send(encode(new_request(patient, examination, self._name)), key=f'exam.{examination}',
+                                               priority=URGENT if urgent else None)
+
+    async def run(self, interval, urgent):
+        """ Requests examinations of random patients every interval seconds on average, given fraction of them urgent """
+        patients = 0
+        while True:
+            await asyncio.sleep(random.expovariate(1 / interval))
+            patients += 1
+            await self.request_examination(f'{self._name}-patient-{patients}', random.choice(EXAMINATION_TYPES), random.random() < urgent)
+
+    async def close(self):
+        await self._examinations_consumer.close()
+        await self._announcements_consumer.close()
+
+
+class Specialist:
+
+    def __init__(self, connection, examination_types, prefetch_count=1):
+        self._examination_types = examination_types
+        self._examinations_producer = Producer(connection, 'examinations', 'topic')
+        self._examinations_consumer = Consumer(connection, 'examinations', 'topic', prefetch_count)
+        self._announcements_consumer = Consumer(connection, 'announcements', 'fanout')
+
+    async def open(self):
+        # setup results producer
+        await self._examinations_producer.open()
+
+        # setup consumer for examination requests
+        await self._examinations_consumer.open()
+        for t in self._examination_types:
+            await self._examinations_consumer.register_queue(name=t, key=f"exam.{t}", callback=self._handle_examinations, policy=EXAMINATIONS)
+
+        # setup consumer for announcements
+        await self._announcements_consumer.open()
+        await self._announcements_consumer.register_queue(callback=self._handle_announcements)
+
+    async def _handle_announcements(self, message):
+        print(colored("[A] " + message.body.decode(), "cyan"))
+
+    async def _handle_examinations(self, message):
+        request = decode(message.body)
+        print(colored(f'Received request for {request.examination} examination for {request.patient} from {request.doctor}', 'blue'))
+
+        await asyncio.sleep(random.randint(1, 3))
+
+        # reply to requester, and publish result for observers and doctors consuming their result queue
+        result = encode(new_result(request))
+        await self._examinations_producer.reply(result, message)
+        await self._examinations_producer.send(result, key=f'result.{request.doctor}')
+        print(colored(f'Results of {request.examination} examination for {request.patient} has been sent to {request.doctor}', 'green'))
+
+    async def close(self):
+        await self._examinations_consumer.close()
+        await self._announcements_consumer.close()
+
+
+class Administrator:
+
+    def __init__(self, connection):
+        self._announcements_producer = Producer(connection, 'announcements', 'fanout')
+        self._examinations_consumer = Consumer(connection, 'examinations', 'topic')
+
+    async def open(self):
+        # setup producer
+        await self._announcements_producer.open()
+
+        # setup consumer
+        await self._examinations_consumer.open()
+        await self._examinations_consumer.register_queue(key="#", callback=self._handle_examinations)
+
+    async def _handle_examinations(self, message):
+        examination = decode(message.body)
+        print(colored(f'[{message.routing_key}] {examination.patient} {examination.examination} {examination.doctor}', "grey"))
+
+    async def send_announcement(self, message):
+        await self._announcements_producer.send(message)
+
+    async def close(self):
+        await self._examinations_consumer.close()
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Simulation of many doctors and specialists in single process')
+
+    parser.add_argument('-d', '--doctors',
+                        type=int,
+                        default=100,
+                        help='Number of simulated doctors'
+                        )
+    parser.add_argument('-s', '--specialists',
+                        type=int,
+                        default=20,
+                        help='Number of simulated specialists, each handling two random examination types'
+                        )
+    parser.add_argument('-i', '--interval',
+                        type=float,
+                        default=10.,
+                        help='Average number of seconds between examination requests of single doctor'
+                        )
+    parser.add_argument('-u', '--urgent',
+                        type=float,
+                        default=0.1,
+                        help='Fraction of urgent examination requests'
+                        )
+    parser.add_argument('-p', '--prefetch',
+                        type=int,
+                        default=4,
+                        help='Number of examinations performed at once by single specialist'
+                        )
+    parser.add_argument('-a', '--administrator',
+                        action='store_true',
+                        help='Run administrator printing all examination messages'
+                        )
+
+    return parser.parse_args()
+
+
+async def _simulate(args):
+    connection = Connection('localhost')
+    await connection.connect()
+
+    # create all roles in single event loop
+    doctors = [Doctor(connection, f'doctor{i}') for i in range(args.doctors)]
+    specialists = [Specialist(connection, random.sample(EXAMINATION_TYPES, 2), args.prefetch) for _ in range(args.specialists)]
+    roles = doctors + specialists + ([Administrator(connection)] if args.administrator else [])
+
+    for role in roles:
+        await role.open()
+
+    try:
+        await asyncio.gather(*(doctor.run(args.interval, args.urgent) for doctor in doctors))
+    finally:
+        for role in roles:
+            await role.close()
+        await connection.close()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.get_event_loop().run_until_complete(_simulate(_parse_arguments()))
+    except KeyboardInterrupt:
+        pass
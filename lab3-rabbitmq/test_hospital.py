@@ -0,0 +1,422 @@
+"""
+Tests of queue policies: queue arguments, retry counting and dead-lettering, and of requests across reconnection.
+
+Tests of fake broker check only its emulation of broker used by simulation and benchmark. Tests against RabbitMQ
+run only when address of broker is given in HOSPITAL_BROKER environment variable, they create and delete their own queues.
+
+Run: python -m unittest test_hospital
+"""
+import asyncio
+import os
+import time
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+from uuid import uuid4
+
+from pika import BlockingConnection, ConnectionParameters
+from pika.exceptions import AMQPConnectionError
+
+import fake_broker
+import hospital
+import hospital_async
+from hospital import RETRY_EXCHANGE, TRANSIENT, Consumer, Producer, QueuePolicy, Requester, queue_arguments, retries, retry_queue_arguments
+
+BROKER = os.environ.get('HOSPITAL_BROKER')
+
+
+def _x_death(rejected, exchange='examinations', key='exam.knee'):
+    """ Returns headers of message rejected given number of times by consumers of knee queue, as set by RabbitMQ """
+    if not rejected:
+        return None
+    died = datetime(2024, 5, 1, 12, 0, 0)
+    return {
+        'x-death': [
+            {'count': rejected, 'exchange': RETRY_EXCHANGE, 'queue': 'knee.retry', 'reason': 'expired', 'routing-keys': ['knee'], 'time': died},
+            {'count': rejected, 'exchange': exchange, 'queue': 'knee', 'reason': 'rejected', 'routing-keys': [key], 'time': died},
+        ],
+        'x-first-death-exchange': exchange,
+        'x-first-death-queue': 'knee',
+        'x-first-death-reason': 'rejected',
+        'x-last-death-exchange': RETRY_EXCHANGE,
+        'x-last-death-queue': 'knee.retry',
+        'x-last-death-reason': 'expired',
+    }
+
+
+class QueueArgumentsTest(unittest.TestCase):
+
+    def test_transient_queue_has_no_arguments(self):
+        self.assertEqual(queue_arguments('', TRANSIENT), {})
+
+    def test_priority_and_retries(self):
+        policy = QueuePolicy(durable=True, max_priority=10, max_retries=3)
+        self.assertEqual(queue_arguments('knee', policy), {
+            'x-max-priority': 10,
+            'x-dead-letter-exchange': RETRY_EXCHANGE,
+            'x-dead-letter-routing-key': 'knee',
+        })
+
+    def test_durable_queue_has_to_be_named(self):
+        with self.assertRaises(ValueError):
+            queue_arguments('', QueuePolicy(durable=True))
+        with self.assertRaises(ValueError):
+            queue_arguments('', QueuePolicy(max_retries=1))
+
+    def test_retry_queue_returns_messages_after_delay(self):
+        self.assertEqual(retry_queue_arguments('knee', QueuePolicy(max_retries=3, retry_delay=2.5)), {
+            'x-message-ttl': 2500,
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': 'knee',
+        })
+
+
+class RetriesTest(unittest.TestCase):
+
+    def test_no_headers(self):
+        self.assertEqual(retries(None, 'knee'), 0)
+        self.assertEqual(retries({}, 'knee'), 0)
+
+    def test_counts_only_rejections_by_queue(self):
+        headers = {'x-death': [
+            {'queue': 'knee', 'reason': 'rejected', 'count': 2},
+            {'queue': 'knee.retry', 'reason': 'expired', 'count': 2},
+            {'queue': 'hip', 'reason': 'rejected', 'count': 5},
+        ]}
+        self.assertEqual(retries(headers, 'knee'), 2)
+
+    def test_headers_set_by_broker(self):
+        self.assertEqual(retries(_x_death(3), 'knee'), 3)
+        self.assertEqual(retries(_x_death(3), 'knee.retry'), 0)
+
+
+class DeclareQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        # connection without broker, only its declarations are used
+        self.connection = hospital.Connection.__new__(hospital.Connection)
+        self.connection._exchanges, self.connection._queues = set(), set()
+        self.channel = mock.MagicMock()
+        self.channel.queue_declare.return_value.method.queue = 'knee'
+
+    def test_queue_with_retries(self):
+        policy = QueuePolicy(durable=True, max_priority=10, max_retries=3, retry_delay=2.5)
+        self.assertEqual(self.connection.declare_queue(self.channel, 'knee', policy), 'knee')
+
+        self.channel.exchange_declare.assert_called_once_with(exchange=RETRY_EXCHANGE, exchange_type='direct', durable=True)
+        self.assertEqual(self.channel.queue_declare.call_args_list, [
+            mock.call(queue='knee.retry', durable=True, arguments=retry_queue_arguments('knee', policy)),
+            mock.call(queue='knee.dead', durable=True),
+            mock.call(queue='knee', durable=True, auto_delete=False, arguments=queue_arguments('knee', policy)),
+        ])
+        self.channel.queue_bind.assert_called_once_with(queue='knee.retry', exchange=RETRY_EXCHANGE, routing_key='knee')
+
+    def test_queue_is_declared_once_per_connection(self):
+        self.connection.declare_queue(self.channel, 'knee', QueuePolicy(durable=True))
+        self.connection.declare_queue(self.channel, 'knee', QueuePolicy(durable=True))
+        self.assertEqual(self.channel.queue_declare.call_count, 1)
+
+
+class _FakeChannel:
+    """ Channel recording acknowledgements and publications """
+
+    is_open = True
+
+    def __init__(self):
+        self.acked, self.nacked, self.published = [], [], []
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.nacked.append(delivery_tag)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((exchange, routing_key, body))
+
+
+class _FakeBlockingConnection:
+    """ Blocking connection of pika without broker, which can be dropped by test """
+
+    instances = []
+
+    def __init__(self, parameters):
+        self.is_open = True
+        self.dropped = False
+        self.failing = False
+        self.channels = []
+        self.timers = []
+        self._callbacks = []
+        self.instances.append(self)
+
+    def channel(self):
+        channel = mock.MagicMock()
+        channel.queue_declare.return_value.method.queue = f'amq.gen-{len(self.instances)}-{len(self.channels)}'
+        self.channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.append(callback)
+
+    def call_later(self, delay, callback):
+        if self.failing:
+            raise AMQPConnectionError('Connection closed')
+        self.timers.append(callback)
+
+    def process_data_events(self, time_limit=0):
+        if self.dropped:
+            self.is_open = False
+            raise AMQPConnectionError('Connection dropped')
+        while self._callbacks:
+            self._callbacks.pop(0)()
+        time.sleep(0.01)
+
+    def close(self):
+        self.is_open = False
+
+
+class _FakeConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        _FakeBlockingConnection.instances = []
+        patcher = mock.patch.object(hospital, 'BlockingConnection', _FakeBlockingConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(hospital.Connection._instances.clear)
+
+    @staticmethod
+    def _wait_for(condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            if time.monotonic() > deadline:
+                raise AssertionError('Condition not met in time')
+            time.sleep(0.01)
+
+
+class ProducerFlushTest(_FakeConnectionTest):
+
+    def setUp(self):
+        super().setUp()
+        self.producer = Producer('fake-broker', 'examinations', 'topic', batch_size=10)
+        self.addCleanup(self.producer.close)
+        self.connection = _FakeBlockingConnection.instances[0]
+
+    def test_flush_is_scheduled_again_after_failure(self):
+        self.connection.failing = True
+        self.producer.send(b'first', key='exam.knee')
+        self._wait_for(lambda: not self.producer._flush_scheduled)
+
+        self.connection.failing = False
+        self.producer.send(b'second', key='exam.knee')
+        self._wait_for(lambda: self.connection.timers)
+
+    def test_flush_is_scheduled_again_after_reconnection(self):
+        self.producer.send(b'first', key='exam.knee')
+        self._wait_for(lambda: self.connection.timers)
+
+        # timer of lost connection never fires, new connection gets its own
+        self.connection.dropped = True
+        self._wait_for(lambda: len(_FakeBlockingConnection.instances) == 2)
+        self._wait_for(lambda: _FakeBlockingConnection.instances[1].timers)
+
+
+class RequesterReconnectTest(_FakeConnectionTest):
+
+    def test_pending_request_fails_when_connection_is_lost(self):
+        requester = Requester('fake-broker', 'examinations', 'topic')
+        self.addCleanup(requester.close)
+        future = requester.request(b'request', key='exam.knee')
+
+        # reply queue of the lost connection is gone, request without timeout must not wait forever
+        _FakeBlockingConnection.instances[0].dropped = True
+        with self.assertRaises(AMQPConnectionError):
+            future.result(timeout=5)
+
+        # requests sent after reconnection wait for replies at new reply queue
+        future = requester.request(b'request', key='exam.knee')
+        self.assertFalse(future.done())
+        self.assertEqual(len(_FakeBlockingConnection.instances), 2)
+
+
+class ConsumerRejectTest(unittest.TestCase):
+
+    def setUp(self):
+        # consumer without connection, only its rejection logic is used
+        self.consumer = Consumer.__new__(Consumer)
+        self.consumer._consumers = {'tag': ('knee', QueuePolicy(durable=True, max_retries=2))}
+        self.channel = _FakeChannel()
+
+    def _reject(self, headers):
+        method = SimpleNamespace(consumer_tag='tag', delivery_tag=1)
+        self.consumer._reject(self.channel, method, SimpleNamespace(headers=headers), b'body')
+
+    def test_first_rejection_is_retried(self):
+        self._reject(None)
+        self.assertEqual(self.channel.nacked, [1])
+        self.assertEqual(self.channel.published, [])
+
+    def test_rejected_message_is_retried(self):
+        self._reject(_x_death(1))
+        self.assertEqual(self.channel.nacked, [1])
+        self.assertEqual(self.channel.published, [])
+
+    def test_message_out_of_retries_is_dead_lettered(self):
+        self._reject(_x_death(2))
+        self.assertEqual(self.channel.published, [('', 'knee.dead', b'body')])
+        self.assertEqual(self.channel.acked, [1])
+        self.assertEqual(self.channel.nacked, [])
+
+
+class AsyncConsumerRejectTest(unittest.TestCase):
+
+    def setUp(self):
+        # consumer without connection, only its rejection logic is used
+        self.consumer = hospital_async.Consumer.__new__(hospital_async.Consumer)
+        self.consumer._channel = mock.MagicMock()
+        self.consumer._channel.default_exchange.publish = mock.AsyncMock()
+        self.policy = QueuePolicy(durable=True, max_retries=2)
+
+    def _reject(self, headers):
+        message = SimpleNamespace(body=b'body', headers=headers or {}, priority=0, delivery_mode=2, ack=mock.AsyncMock(), reject=mock.AsyncMock())
+        asyncio.run(self.consumer._reject(message, 'knee', self.policy))
+        return message
+
+    def test_rejected_message_is_retried(self):
+        message = self._reject(_x_death(1))
+        message.reject.assert_awaited_once_with(requeue=False)
+        self.consumer._channel.default_exchange.publish.assert_not_awaited()
+
+    def test_message_out_of_retries_is_dead_lettered(self):
+        message = self._reject(_x_death(2))
+        message.ack.assert_awaited_once()
+        message.reject.assert_not_awaited()
+        dead, = self.consumer._channel.default_exchange.publish.await_args.args
+        self.assertEqual(self.consumer._channel.default_exchange.publish.await_args.kwargs, {'routing_key': 'knee.dead'})
+        self.assertEqual(dead.body, b'body')
+        self.assertEqual(retries(dead.headers, 'knee'), 2)
+
+
+class FakeBrokerTest(unittest.TestCase):
+    """ Emulation of queue policies by fake broker, it has to behave like RabbitMQ for benchmark and simulation to be meaningful """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_failing_message_is_retried_then_dead_lettered(self):
+        policy = QueuePolicy(durable=True, max_retries=2, retry_delay=0.01)
+        deliveries = []
+
+        async def fail(message):
+            deliveries.append(message)
+            raise RuntimeError('examination failed')
+
+        async def run():
+            connection = fake_broker.Connection()
+            producer = fake_broker.Producer(connection, 'examinations', 'topic')
+            consumer = fake_broker.Consumer(connection, 'examinations', 'topic')
+            await producer.open()
+            await consumer.open()
+            await consumer.register_queue(name='knee', key='exam.knee', callback=fail, policy=policy)
+
+            await producer.send(b'request', key='exam.knee')
+            dead = connection.queue('knee.dead')
+            message = await asyncio.wait_for(dead.get(), 1.)
+            await connection.close()
+            return message
+
+        message = self.loop.run_until_complete(run())
+        self.assertEqual(message.body, b'request')
+        self.assertEqual(len(deliveries), policy.max_retries + 1)
+        self.assertEqual(retries(message.headers, 'knee'), policy.max_retries)
+
+    def test_urgent_messages_go_first(self):
+        received = []
+
+        async def run():
+            connection = fake_broker.Connection()
+            producer = fake_broker.Producer(connection, 'examinations', 'topic')
+            await producer.open()
+
+            # queue messages before consumer starts, so they are ordered by priority
+            queue = connection.queue('knee', QueuePolicy(durable=True, max_priority=10))
+            connection.bind(queue, 'examinations', 'exam.knee')
+            await producer.send(b'routine', key='exam.knee')
+            await producer.send(b'urgent', key='exam.knee', priority=9)
+            for _ in range(2):
+                received.append((await queue.get()).body)
+
+        self.loop.run_until_complete(run())
+        self.assertEqual(received, [b'urgent', b'routine'])
+
+
+@unittest.skipUnless(BROKER, 'requires RabbitMQ, address of broker is given in HOSPITAL_BROKER')
+class BrokerTest(unittest.TestCase):
+    """ Queue policies applied by RabbitMQ itself """
+
+    def setUp(self):
+        self.name = f'test-{uuid4().hex[:8]}'
+        self.exchange = f'{self.name}.examinations'
+        self.connection = BlockingConnection(ConnectionParameters(host=BROKER))
+        self.channel = self.connection.channel()
+
+    def tearDown(self):
+        for queue in (self.name, f'{self.name}.retry', f'{self.name}.dead'):
+            self.channel.queue_delete(queue=queue)
+        self.channel.exchange_delete(exchange=self.exchange)
+        self.connection.close()
+        hospital.Connection._instances.clear()
+
+    def _get(self, queue, timeout=10.):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            method, props, body = self.channel.basic_get(queue=queue, auto_ack=True)
+            if method is not None:
+                return props, body
+            time.sleep(0.05)
+        self.fail(f'No message in queue {queue}')
+
+    def test_failing_message_is_retried_then_dead_lettered(self):
+        policy = QueuePolicy(durable=True, max_retries=2, retry_delay=0.1)
+        deliveries = []
+
+        def fail(channel, method, props, body):
+            deliveries.append(retries(props.headers, self.name))
+            raise RuntimeError('examination failed')
+
+        consumer = Consumer(BROKER, self.exchange, 'topic')
+        consumer.register_queue(name=self.name, key='exam.knee', callback=fail, policy=policy)
+        consumer.start_consuming()
+        producer = Producer(BROKER, self.exchange, 'topic')
+        try:
+            producer.send(b'request', key='exam.knee')
+            props, body = self._get(f'{self.name}.dead')
+        finally:
+            producer.close()
+            consumer.close()
+
+        self.assertEqual(body, b'request')
+        self.assertEqual(deliveries, [0, 1, 2])
+        self.assertEqual(retries(props.headers, self.name), policy.max_retries)
+
+    def test_urgent_messages_go_first(self):
+        policy = QueuePolicy(durable=True, max_priority=10)
+        self.channel.exchange_declare(exchange=self.exchange, exchange_type='topic', durable=True)
+        self.channel.queue_declare(queue=self.name, durable=True, arguments=queue_arguments(self.name, policy))
+        self.channel.queue_bind(queue=self.name, exchange=self.exchange, routing_key='exam.knee')
+
+        producer = Producer(BROKER, self.exchange, 'topic')
+        try:
+            producer.send(b'routine', key='exam.knee')
+            producer.send(b'urgent', key='exam.knee', priority=9)
+        finally:
+            producer.close()
+
+        self.assertEqual([self._get(self.name)[1] for _ in range(2)], [b'urgent', b'routine'])
+
+if __name__ == '__main__':
+    unittest.main()
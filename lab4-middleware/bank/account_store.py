@@ -0,0 +1,510 @@
+import json
+from array import array
+import os
+import threading
+from contextlib import ExitStack, contextmanager
+from typing import Iterable, List, Tuple
+
+from loguru import logger
+
+from exchange_rates import Currency
+
+
+class AccountRemovedError(KeyError):
+    """ Raised when changed account was removed from the store or is frozen, e.g. moved to another shard """
+
+    def __init__(self, pesel: str):
+        super().__init__(pesel)
+        self.pesel = pesel
+
+
+class JournalError(Exception):
+    """ Raised when write-ahead log is corrupted or cannot be written """
+
+
+class AccountRecord:
+    """
+    Account state kept by account store, servants only provide access to it.
+    Slotted to keep per-account overhead low, balance is an array indexed by currency value.
+    """
+
+    __slots__ = ('firstName', 'lastName', 'pesel', 'declared_income', 'password', 'premium', 'balance')
+
+    def __init__(self, firstName: str, lastName: str, pesel: str, declared_income: float, password: str, premium: bool, balance: array = None):
+        """ Creates account record, with empty balance if not given """
+        self.firstName = firstName
+        self.lastName = lastName
+        self.pesel = pesel
+        self.declared_income = declared_income
+        self.password = password
+        self.premium = premium
+        self.balance = balance if balance is not None else array('d', [0.]) * len(Currency)
+
+    def to_dict(self) -> dict:
+        """ Returns record as plain dict, used for serialization """
+        return {
+            'firstName': self.firstName,
+            'lastName': self.lastName,
+            'pesel': self.pesel,
+            'declared_income': self.declared_income,
+            'password': self.password,
+            'premium': self.premium,
+            'balance': self.balance.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """ Creates record from dict returned by to_dict """
+        return cls(data['firstName'], data['lastName'], data['pesel'], data['declared_income'], data['password'], data['premium'], array('d', data['balance']))
+
+    def __repr__(self):
+        return f"<AccountRecord(pesel='{self.pesel}', premium={self.premium})>"
+
+
+class AccountStore:
+    """
+    In-memory account store, maps pesel to account record.
+    Base class for persistent stores, which override hooks called on every change.
+
+    Changes are synchronized with striped locks, account is guarded by lock selected by hash of its pesel,
+    so operations on different accounts can run in parallel without keeping a lock per account.
+    """
+
+    def __init__(self, stripes: int = 64):
+        """ Creates empty store """
+        self._accounts = dict()
+        self._frozen = set()
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def __contains__(self, pesel: str):
+        return pesel in self._accounts
+
+    def __getitem__(self, pesel: str):
+        return self._accounts[pesel]
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def get(self, pesel: str, default: AccountRecord = None) -> AccountRecord:
+        return self._accounts.get(pesel, default)
+
+    def keys(self):
+        return self._accounts.keys()
+
+    def values(self):
+        return self._accounts.values()
+
+    def recover(self) -> List[AccountRecord]:
+        """ Restores accounts from storage, returns restored records """
+        return []
+
+    def register(self, account: AccountRecord) -> bool:
+        """ Adds new account to the store, returns False if account with the same pesel already exists """
+        with self._lock(account.pesel):
+            if account.pesel in self._accounts:
+                return False
+            self._accounts[account.pesel] = account
+            ticket = self._record({'op': 'register', 'account': account.to_dict()})
+        self._commit(ticket)
+        return True
+
+    def remove(self, pesel: str) -> AccountRecord:
+        """ Removes account from the store, returns its record or None if there is no such account """
+        with self._lock(pesel):
+            account = self._accounts.pop(pesel, None)
+            self._frozen.discard(pesel)
+            if account is None:
+                return None
+            ticket = self._record({'op': 'remove', 'pesel': pesel})
+        self._commit(ticket)
+        return account
+
+    def freeze(self, pesels: Iterable[str]) -> List[AccountRecord]:
+        """
+        Stops changes of accounts, so that their state can be copied, returns records of frozen accounts.
+        Freezing is not persisted, accounts are unfrozen after restart.
+        """
+        records = []
+        for pesel in pesels:
+            with self._lock(pesel):
+                account = self._accounts.get(pesel)
+                if account is not None:
+                    self._frozen.add(pesel)
+                    records.append(account)
+        return records
+
+    def unfreeze(self, pesels: Iterable[str]):
+        """ Allows changes of frozen accounts again """
+        for pesel in pesels:
+            with self._lock(pesel):
+                self._frozen.discard(pesel)
+
+    def frozen(self) -> List[str]:
+        """ Returns pesels of frozen accounts """
+        return list(self._frozen)
+
+    def deposit(self, account: AccountRecord, currency: Currency, amount: float):
+        """ Adds amount to account balance """
+        with self._lock(account.pesel):
+            self._check(account)
+            account.balance[currency] += amount
+            ticket = self._record({'op': 'deposit', 'pesel': account.pesel, 'currency': int(currency), 'amount': amount})
+        self._commit(ticket)
+
+    def withdraw(self, account: AccountRecord, currency: Currency, amount: float) -> bool:
+        """ Subtracts amount from account balance, returns False if there is not enough money """
+        with self._lock(account.pesel):
+            self._check(account)
+            if account.balance[currency] < amount:
+                return False
+            account.balance[currency] -= amount
+            ticket = self._record({'op': 'withdraw', 'pesel': account.pesel, 'currency': int(currency), 'amount': amount})
+        self._commit(ticket)
+        return True
+
+    def transfer(self, source: AccountRecord, source_currency: Currency, source_amount: float,
+                 target: AccountRecord, target_currency: Currency, target_amount: float) -> bool:
+        """
+        Atomically withdraws source amount from source account and deposits target amount to target account.
+        Source and target may be the same account, to exchange between its currencies.
+        Returns False if there is not enough money.
+        """
+        with self._locked(source.pesel, target.pesel):
+            self._check(source, target)
+            if source.balance[source_currency] < source_amount:
+                return False
+            source.balance[source_currency] -= source_amount
+            target.balance[target_currency] += target_amount
+            ticket = self._record({
+                'op': 'transfer',
+                'source': source.pesel, 'source_currency': int(source_currency), 'source_amount': source_amount,
+                'target': target.pesel, 'target_currency': int(target_currency), 'target_amount': target_amount
+            })
+        self._commit(ticket)
+        return True
+
+    def close(self):
+        """ Releases resources held by store """
+        pass
+
+    def apply(self, changes: List[Tuple[AccountRecord, Currency, float]], atomic: bool = False) -> List[bool]:
+        """
+        Applies many balance changes at once, negative change is a withdrawal and fails if there is not enough money.
+        Returns success of every change, if atomic and any change fails none of them is applied.
+        """
+        if not changes:
+            return []
+
+        with self._locked(*{account.pesel for account, _, _ in changes}):
+            self._check(*{account for account, _, _ in changes})
+
+            # check changes against balances as they would be after preceding changes
+            results = []
+            balances = dict()
+            for account, currency, delta in changes:
+                key = (account.pesel, currency)
+                balance = balances.get(key, account.balance[currency]) + delta
+                success = delta >= 0 or balance >= 0
+                if success:
+                    balances[key] = balance
+                results.append(success)
+
+            if atomic and not all(results):
+                return results
+
+            # apply successful changes
+            applied = []
+            for (account, currency, delta), success in zip(changes, results):
+                if success:
+                    account.balance[currency] += delta
+                    applied.append([account.pesel, int(currency), delta])
+
+            ticket = self._record({'op': 'batch', 'changes': applied}) if applied else 0
+
+        self._commit(ticket)
+        return results
+
+    def _check(self, *accounts: AccountRecord):
+        """ Raises AccountRemovedError if any of accounts was removed or is frozen, must be called with their locks held """
+        for account in accounts:
+            if self._accounts.get(account.pesel) is not account or account.pesel in self._frozen:
+                raise AccountRemovedError(account.pesel)
+
+    def _lock(self, pesel: str) -> threading.Lock:
+        """ Returns lock guarding account with given pesel """
+        return self._locks[hash(pesel) % len(self._locks)]
+
+    @contextmanager
+    def _locked(self, *pesels: str):
+        """ Acquires locks of all given accounts, or all locks if none given, always in the same order to avoid deadlocks """
+        if pesels:
+            indexes = sorted({hash(pesel) % len(self._locks) for pesel in pesels})
+        else:
+            indexes = range(len(self._locks))
+
+        with ExitStack() as stack:
+            for index in indexes:
+                stack.enter_context(self._locks[index])
+            yield
+
+    def _record(self, record: dict):
+        """ Called with lock of changed accounts held after every change, returns ticket passed to _commit """
+        return None
+
+    def _commit(self, ticket):
+        """ Called without store lock, should block until change identified by ticket is durable """
+        pass
+
+
+class JournaledAccountStore(AccountStore):
+    """
+    Account store backed by write-ahead log and periodic snapshots.
+
+    Every change is appended to the current log segment and fsynced by a background writer,
+    callers waiting for durability at the same time share a single fsync (group commit).
+    After snapshot_interval changes a snapshot is written and log segments it covers are removed,
+    so recovery only replays changes made after the last snapshot.
+    """
+
+    _SNAPSHOT = 'accounts.snapshot'
+    _SEGMENT = 'wal-{:020d}.log'
+
+    def __init__(self, directory: str, snapshot_interval: int = 10000):
+        """ Creates store keeping its files in given directory """
+        super().__init__()
+        self._directory = directory
+        self._snapshot_interval = snapshot_interval
+
+        # log sequence numbers
+        self._seq = 0
+        self._durable_seq = 0
+        self._snapshot_seq = 0
+        self._snapshot_due = False
+        self._snapshotting = False
+
+        # queue of pending log lines, consumed by writer
+        self._pending = []
+        self._writer_condition = threading.Condition()
+        self._durable_condition = threading.Condition()
+        self._closed = False
+        self._writer_error = None
+
+        self._segment = None
+        self._writer = threading.Thread(target=self._write_loop, name='account-store-writer', daemon=True)
+
+        os.makedirs(directory, exist_ok=True)
+
+    def recover(self) -> List[AccountRecord]:
+        # load snapshot
+        path = os.path.join(self._directory, self._SNAPSHOT)
+        if os.path.exists(path):
+            with open(path) as file:
+                snapshot = json.load(file)
+            self._snapshot_seq = snapshot['seq']
+            for data in snapshot['accounts']:
+                account = AccountRecord.from_dict(data)
+                self._accounts[account.pesel] = account
+
+        # replay log tail
+        self._seq = self._snapshot_seq
+        replayed = 0
+        segments = self._segments()
+        for i, (_, segment) in enumerate(segments):
+            for record in self._read_segment(segment, last=i == len(segments) - 1):
+                if record['seq'] <= self._snapshot_seq:
+                    continue
+                self._replay(record)
+                self._seq = record['seq']
+                replayed += 1
+
+        logger.info('Recovered {} accounts from snapshot at {} and {} log records', len(self._accounts), self._snapshot_seq, replayed)
+
+        # continue in segment starting after the last record, torn record at its end was already truncated
+        self._durable_seq = self._seq
+        self._open_segment(self._seq + 1)
+        self._writer.start()
+
+        return list(self._accounts.values())
+
+    def close(self):
+        if not self._writer.is_alive():
+            return
+        with self._writer_condition:
+            self._closed = True
+            self._writer_condition.notify()
+        self._writer.join()
+        self._segment.close()
+
+    def _record(self, record: dict):
+        payload = json.dumps(record, separators=(',', ':'))
+
+        # assign sequence number and enqueue, records of the same account are ordered by its lock
+        with self._writer_condition:
+            self._seq += 1
+            seq = self._seq
+            self._pending.append((seq, f'{{"seq":{seq},{payload[1:]}\n'))
+
+            if seq - self._snapshot_seq >= self._snapshot_interval and not self._snapshotting:
+                self._snapshot_due = True
+
+            self._writer_condition.notify()
+
+        return seq
+
+    def _commit(self, ticket):
+        if self._snapshot_due:
+            self._snapshot()
+
+        with self._durable_condition:
+            while self._durable_seq < ticket:
+                if self._writer_error is not None:
+                    raise JournalError('Account store writer failed, change is not durable') from self._writer_error
+                self._durable_condition.wait()
+
+    def _snapshot(self):
+        """ Rotates log segment and schedules snapshot of current state """
+
+        # stop all changes, so state matches last assigned sequence number
+        with self._locked(), self._writer_condition:
+            if self._snapshotting:
+                return
+            self._snapshot_due = False
+            self._snapshotting = True
+
+            state = [account.to_dict() for account in self._accounts.values()]
+            self._pending.append(_Rotation(self._seq, state))
+            self._writer_condition.notify()
+
+    def _write_loop(self):
+        """ Runs writer, failure is passed to callers waiting for durability """
+        try:
+            self._write_batches()
+        except Exception as e:
+            logger.exception('Account store writer failed')
+            with self._durable_condition:
+                self._writer_error = e
+                self._durable_condition.notify_all()
+
+    def _write_batches(self):
+        """ Writes pending records in batches, one fsync per batch """
+        while True:
+
+            # get batch
+            with self._writer_condition:
+                while not self._pending and not self._closed:
+                    self._writer_condition.wait()
+                if not self._pending and self._closed:
+                    return
+                batch, self._pending = self._pending, []
+
+            # write batch
+            for item in batch:
+                if isinstance(item, _Rotation):
+                    seq = item.seq
+                    self._sync()
+                    self._segment.close()
+                    self._open_segment(item.seq + 1)
+                    threading.Thread(target=self._write_snapshot, args=(item.seq, item.state), daemon=True).start()
+                else:
+                    seq, line = item
+                    self._segment.write(line)
+            self._sync()
+
+            # notify waiting callers
+            with self._durable_condition:
+                self._durable_seq = seq
+                self._durable_condition.notify_all()
+
+    def _write_snapshot(self, seq: int, state: List[dict]):
+        """ Atomically replaces snapshot and removes log segments covered by it """
+        path = os.path.join(self._directory, self._SNAPSHOT)
+
+        with open(path + '.tmp', 'w') as file:
+            json.dump({'seq': seq, 'accounts': state}, file, separators=(',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+        self._sync_directory()
+
+        # remove segments containing only records older than snapshot
+        for start, segment in self._segments():
+            if start <= seq:
+                os.remove(segment)
+
+        logger.debug('Account store snapshot written at {}', seq)
+
+        with self._writer_condition:
+            self._snapshot_seq = seq
+            self._snapshotting = False
+
+    def _replay(self, record: dict):
+        """ Applies log record to in-memory state """
+        if record['op'] == 'register':
+            account = AccountRecord.from_dict(record['account'])
+            self._accounts[account.pesel] = account
+        elif record['op'] == 'remove':
+            del self._accounts[record['pesel']]
+        elif record['op'] == 'deposit':
+            self._accounts[record['pesel']].balance[record['currency']] += record['amount']
+        elif record['op'] == 'withdraw':
+            self._accounts[record['pesel']].balance[record['currency']] -= record['amount']
+        elif record['op'] == 'transfer':
+            self._accounts[record['source']].balance[record['source_currency']] -= record['source_amount']
+            self._accounts[record['target']].balance[record['target_currency']] += record['target_amount']
+        elif record['op'] == 'batch':
+            for pesel, currency, delta in record['changes']:
+                self._accounts[pesel].balance[currency] += delta
+
+    def _segments(self):
+        """ Returns sorted (start seq, path) pairs of existing log segments """
+        segments = []
+        for name in os.listdir(self._directory):
+            if name.startswith('wal-') and name.endswith('.log'):
+                segments.append((int(name[4:-4]), os.path.join(self._directory, name)))
+        return sorted(segments)
+
+    @staticmethod
+    def _read_segment(path: str, last: bool) -> Iterable[dict]:
+        """
+        Reads records from segment. Torn record left by crash at the end of the last segment is truncated,
+        so records appended after recovery are not glued to it, any other unreadable record raises JournalError.
+        """
+        with open(path, 'rb+') as file:
+            offset = 0
+            for line in file:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('record without line end')
+                    record = json.loads(line)
+                except ValueError:
+                    if not last or file.read(1):
+                        raise JournalError(f'Corrupted record at offset {offset} of {path}')
+                    logger.warning('Truncating torn record at the end of {}', path)
+                    file.truncate(offset)
+                    os.fsync(file.fileno())
+                    return
+                offset += len(line)
+                yield record
+
+    def _open_segment(self, start: int):
+        self._segment = open(os.path.join(self._directory, self._SEGMENT.format(start)), 'a')
+        self._sync_directory()
+
+    def _sync(self):
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+
+    def _sync_directory(self):
+        fd = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class _Rotation:
+    """ Writer queue marker, closes current segment and triggers snapshot """
+
+    def __init__(self, seq: int, state: List[dict]):
+        self.seq = seq
+        self.state = state
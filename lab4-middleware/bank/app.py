@@ -5,7 +5,9 @@ import Ice
 from argparse_utils import enum_action
 from loguru import logger
 
-from bank import BankI
+from account_store import AccountStore, JournaledAccountStore
+from audit import AuditLog
+from bank import BankI, ShardI, metrics
 from exchange_rates import Currency, ExchangeRates
 
 
@@ -18,14 +20,15 @@ def _parse_arguments():
                         help='Port to listen to'
                         )
     parser.add_argument('-eh', '--exchange-host',
-                        required=True,
                         help='Host of exchange rates service'
                         )
     parser.add_argument('-ep', '--exchange-port',
                         type=int,
-                        required=True,
                         help='Port of exchange rates service'
                         )
+    parser.add_argument('-er', '--exchange-relay',
+                        help='Unix socket path of exchange rates relay, used instead of connecting to exchange rates service'
+                        )
     parser.add_argument('-b', '--base-currency',
                         action=enum_action(Currency),
                         required=True,
@@ -42,8 +45,67 @@ def _parse_arguments():
                         default=10000,
                         help='Premium account threshold'
                         )
+    parser.add_argument('-d', '--data-dir',
+                        help='Directory for persistent account store, accounts are kept only in memory if omitted'
+                        )
+    parser.add_argument('-s', '--snapshot-interval',
+                        type=int,
+                        default=10000,
+                        help='Number of account changes between account store snapshots'
+                        )
+    parser.add_argument('-sc', '--servant-cache',
+                        type=int,
+                        default=0,
+                        help='Activate account servants lazily keeping at most given number of them, all servants are kept if 0'
+                        )
+    parser.add_argument('-si', '--servant-idle-timeout',
+                        type=float,
+                        default=300.,
+                        help='Seconds after which unused account servant is evicted from cache'
+                        )
+    parser.add_argument('-T', '--threads',
+                        type=int,
+                        default=1,
+                        help='Number of threads dispatching requests'
+                        )
+    parser.add_argument('-st', '--session-timeout',
+                        type=float,
+                        default=600.,
+                        help='Seconds after which session token expires'
+                        )
+    parser.add_argument('-ma', '--max-rates-age',
+                        type=float,
+                        default=0.,
+                        help='Refuse operations priced on exchange rates older than given number of seconds, 0 disables the check'
+                        )
+    parser.add_argument('-al', '--audit-log',
+                        help='File to write audit events of account operations to, events are discarded if omitted'
+                        )
+    parser.add_argument('-as', '--audit-sample-rate',
+                        type=float,
+                        default=0.1,
+                        help='Fraction of read-only operations recorded in audit log'
+                        )
+    parser.add_argument('-ac', '--audit-capacity',
+                        type=int,
+                        default=100000,
+                        help='Maximum number of audit events waiting to be written, further events are dropped'
+                        )
+    parser.add_argument('-sh', '--shard',
+                        action='store_true',
+                        help='Run as shard of sharded bank, exposing interface used by router to move accounts, port must not be reachable by clients'
+                        )
+    parser.add_argument('-mp', '--metrics-port',
+                        type=int,
+                        help='Port of HTTP server exposing metrics in Prometheus format, metrics are not exposed if omitted'
+                        )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if not args.exchange_relay and (args.exchange_host is None or args.exchange_port is None):
+        parser.error('either exchange rates service host and port or exchange rates relay is required')
+
+    return args
 
 
 if __name__ == '__main__':
@@ -53,16 +115,51 @@ if __name__ == '__main__':
 
     # create and start exchange rates
     exchange_rates = ExchangeRates(args.base_currency, args.currencies)
-    threading.Thread(target=exchange_rates.subscribe, args=(args.exchange_host, args.exchange_port)).start()
+    if args.exchange_relay:
+        threading.Thread(target=exchange_rates.attach, args=(args.exchange_relay,)).start()
+    else:
+        threading.Thread(target=exchange_rates.subscribe, args=(args.exchange_host, args.exchange_port)).start()
+
+    # create account store
+    if args.data_dir:
+        store = JournaledAccountStore(args.data_dir, args.snapshot_interval)
+    else:
+        store = AccountStore()
+
+    # create audit log
+    audit = AuditLog(args.audit_log, args.audit_sample_rate, args.audit_capacity)
+
+    # expose metrics
+    if args.metrics_port:
+        metrics.gauge('exchange_rates_version', 'Version of current exchange rates', lambda: exchange_rates.snapshot.version)
+        metrics.gauge('exchange_rates_age_seconds', 'Time since last exchange rates update', lambda: exchange_rates.snapshot.age)
+        metrics.gauge('exchange_rates_reconnects_total', 'Number of exchange rates resubscriptions', lambda: exchange_rates.reconnects, 'counter')
+        metrics.gauge('exchange_rates_unavailable_seconds_total', 'Time without working exchange rates subscription', lambda: exchange_rates.time_without_rates, 'counter')
+        metrics.histogram('exchange_rates_update_lag_seconds', 'Delay between sending of rates by exchange rates service and their use by bank',
+                          exchange_rates.update_lag, exchange_rates.update_lag_lock)
+        metrics.gauge('audit_events_written_total', 'Number of audit events written', lambda: audit.written, 'counter')
+        metrics.gauge('audit_events_dropped_total', 'Number of audit events dropped because of full queue', lambda: audit.dropped, 'counter')
+        metrics.serve(args.metrics_port)
 
     # setup ice
-    with Ice.initialize() as communicator:
+    init_data = Ice.InitializationData()
+    init_data.properties = Ice.createProperties()
+    init_data.properties.setProperty('Ice.ThreadPool.Server.Size', str(args.threads))
+    init_data.properties.setProperty('Ice.ThreadPool.Server.SizeMax', str(args.threads))
+
+    with Ice.initialize(init_data) as communicator:
 
         # setup adapter
         adapter = communicator.createObjectAdapterWithEndpoints('BankAdapter', f'default -p {args.port}')
-        adapter.add(BankI(adapter, exchange_rates, args.base_currency, args.currencies, args.threshold), communicator.stringToIdentity('Bank'))
+        bank = BankI(adapter, exchange_rates, args.base_currency, args.currencies, args.threshold, store, args.servant_cache, args.servant_idle_timeout, args.session_timeout, args.max_rates_age, audit)
+        adapter.add(bank, communicator.stringToIdentity('Bank'))
+        if args.shard:
+            adapter.add(ShardI(bank), communicator.stringToIdentity('Shard'))
         adapter.activate()
 
         logger.info('Bank server started at port {}', args.port)
 
         communicator.waitForShutdown()
+
+    store.close()
+    audit.close()
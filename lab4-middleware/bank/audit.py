@@ -0,0 +1,82 @@
+import json
+import random
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from loguru import logger
+
+
+class AuditLog:
+    """
+    Asynchronous audit log of bank operations.
+
+    Dispatch threads only append events to a bounded queue, background writer writes them to file in batches
+    as line-delimited JSON. Events of read-only operations are sampled, events not fitting the queue are dropped and counted.
+    If path is None events are discarded.
+    """
+
+    def __init__(self, path: Optional[str] = None, sample_rate: float = 1., capacity: int = 100000, flush_interval: float = 0.5):
+        """ Creates audit log writing to file at given path """
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+
+        # counters, updated without locking so dropped count is approximate under heavy contention
+        self.written = 0
+        self.dropped = 0
+
+        # queue of (timestamp, event, fields) tuples, deque append and popleft are thread-safe
+        self._queue = deque()
+        self._closed = threading.Event()
+
+        # start writer
+        self._path = path
+        self._writer = None
+        if path is not None:
+            self._writer = threading.Thread(target=self._write_loop, name='audit-writer', daemon=True)
+            self._writer.start()
+
+    def record(self, event: str, **fields):
+        """ Enqueues event of operation changing state """
+        if self._writer is None:
+            return
+        if len(self._queue) >= self.capacity:
+            self.dropped += 1
+            return
+        self._queue.append((time.time(), event, fields))
+
+    def sample(self, event: str, **fields):
+        """ Enqueues event of read-only operation, with probability equal to sample rate """
+        if self._writer is None or random.random() >= self.sample_rate:
+            return
+        self.record(event, **fields)
+
+    def close(self):
+        """ Stops writer after writing all enqueued events """
+        if self._writer is None:
+            return
+        self._closed.set()
+        self._writer.join()
+
+    def _write_loop(self):
+        with open(self._path, 'a') as file:
+            while not self._closed.wait(self.flush_interval):
+                self._write_batch(file)
+            self._write_batch(file)
+
+        logger.debug('Audit log closed, {} events written, {} dropped', self.written, self.dropped)
+
+    def _write_batch(self, file):
+        """ Writes all currently enqueued events """
+        lines = []
+        queue = self._queue
+        while queue:
+            timestamp, event, fields = queue.popleft()
+            lines.append(json.dumps({'t': timestamp, 'e': event, **fields}, separators=(',', ':')))
+
+        if lines:
+            file.write('\n'.join(lines) + '\n')
+            file.flush()
+            self.written += len(lines)
@@ -1,18 +1,31 @@
+import hmac
 import inspect
 import random
 import string
 import sys
-from typing import List
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import List, Tuple
 
 import Ice
 from loguru import logger
 
-from exchange_rates import Currency, ExchangeRates
+from account_store import AccountRecord, AccountRemovedError, AccountStore
+from audit import AuditLog
+from exchange_rates import Currency, ExchangeRates, RatesSnapshot
+from metrics import Metrics
+from sessions import SessionTable
+from sharding import HashRing
 
 # fix broken ice imports
 sys.path.append('./idl')
 import Banking
 
+# latency and errors of all bank operations
+metrics = Metrics()
+
 
 def _ice_currency(currency: Currency):
     """ Parses grpc currency to ice currency """
@@ -30,79 +43,160 @@ def _generate_password(length: int = 10):
 
 
 def authenticate(func):
-    """ Decorator that performs pesel/password check """
+    """ Decorator that performs session token check, or pesel/password check if no token was provided """
 
-    # create decorator
-    def authenticate_decorator(*args, **kwargs):
+    # resolve position of `current` argument once, at decoration time
+    parameters = list(inspect.signature(func).parameters)
+    current_index = parameters.index('current')
 
-        # retrieve arguments using inspect to match their names
-        arguments = inspect.signature(func).bind(*args, **kwargs).arguments
-        account = arguments['self']
-        context = arguments['current'].ctx
+    # create decorator
+    @wraps(func)
+    def authenticate_decorator(self, *args, **kwargs):
 
-        # check if password was provided
-        if 'password' not in context:
-            raise Banking.AuthenticationException('No password provided')
+        # retrieve current, it is either passed by keyword or positionally (self is not in args)
+        current = kwargs['current'] if 'current' in kwargs else args[current_index - 1]
+        context = current.ctx
 
-        # check password
-        if context['password'] != account.password:
-            raise Banking.AuthenticationException('Incorrect pesel/password combination')
+        # check session token
+        token = context.get('token')
+        if token is not None:
+            if self._bank.sessions.get(token) != self.pesel:
+                raise Banking.AuthenticationException('Invalid or expired session token')
 
-        # if everything is fine execute normally
-        return func(*args, **kwargs)
+        # check password, if provided
+        else:
+            password = context.get('password')
+            if password is None:
+                raise Banking.AuthenticationException('No session token or password provided')
+            if not hmac.compare_digest(password.encode(), self.password.encode()):
+                raise Banking.AuthenticationException('Incorrect pesel/password combination')
+
+        # if everything is fine execute normally, account could be moved to another shard in the meantime
+        try:
+            return func(self, *args, **kwargs)
+        except AccountRemovedError as err:
+            if err.pesel != self.pesel:
+                raise Banking.AccountNotFoundException(f'There is no account with pesel {err.pesel}')
+            raise Ice.ObjectNotExistException()
 
     # return decorator
     return authenticate_decorator
 
 
 class AccountI(Banking.Account):
-    """ Implementation of standard account """
+    """ Implementation of standard account, servant providing access to account record """
+
+    type = Banking.AccountType.STANDARD
 
-    def __init__(self, bank, firstName: str, lastName: str, pesel: str, declared_income: float, password: str):
-        """ Creates account """
+    def __init__(self, bank, record: AccountRecord):
+        """ Creates account servant """
         self._bank = bank
-        self.firstName = firstName
-        self.lastName = lastName
-        self.pesel = pesel
-        self.declared_income = declared_income
-        self.password = password
-        self.type = Banking.AccountType.STANDARD
-        self.balance = {c: 0. for c in (self._bank.currencies + [self._bank.base_currency])}
+        self._record = record
 
+    @property
+    def firstName(self) -> str:
+        return self._record.firstName
+
+    @property
+    def lastName(self) -> str:
+        return self._record.lastName
+
+    @property
+    def pesel(self) -> str:
+        return self._record.pesel
+
+    @property
+    def password(self) -> str:
+        return self._record.password
+
+    @property
+    def balance(self):
+        return self._record.balance
+
+    @metrics.measure
     @authenticate
     def getBalance(self, current=None):
-        logger.info("Client {} requested balance", self.pesel)
-        return {_ice_currency(c): value for c, value in self.balance.items()}
+        self._bank.audit.sample('balance', pesel=self.pesel)
+        balance = self.balance
+        return {_ice_currency(c): balance[c] for c in self._bank.supported_currencies}
 
+    @metrics.measure
     @authenticate
     def deposit(self, currency, amount: float, current=None):
         currency = _grpc_currency(currency)
 
         # check if currency is supported
-        if currency not in self.balance:
+        if currency not in self._bank.supported_currencies:
             raise Banking.UnsupportedCurrencyException(f'Currency {currency.name} is not supported by this bank')
 
         # deposit to account
-        self.balance[currency] += amount
+        self._bank.accounts.deposit(self._record, currency, amount)
 
-        logger.info("Deposited {} {} to account of client {}", amount, currency.name, self.pesel)
+        self._bank.audit.record('deposit', pesel=self.pesel, currency=currency.name, amount=amount)
 
+    @metrics.measure
     @authenticate
     def withdraw(self, currency, amount: float, current=None):
         currency = _grpc_currency(currency)
 
         # check if currency is supported
-        if currency not in self.balance:
+        if currency not in self._bank.supported_currencies:
             raise Banking.UnsupportedCurrencyException(f'Currency {currency.name} is not supported by this bank')
 
-        # check if has enough money
-        if self.balance[currency] < amount:
+        # withdraw from acccount, if has enough money
+        if not self._bank.accounts.withdraw(self._record, currency, amount):
             raise Banking.NotEnoughMoneyException('This account has not enough money to withdraw')
 
-        # withdraw from acccount
-        self.balance[currency] -= amount
+        self._bank.audit.record('withdraw', pesel=self.pesel, currency=currency.name, amount=amount)
+
+    @metrics.measure
+    @authenticate
+    def transfer(self, targetPesel: str, currency, targetCurrency, amount: float, current=None):
+
+        # get target account, it can be moved to another shard at any moment
+        target = self._bank.accounts.get(targetPesel)
+        if target is None:
+            raise Banking.AccountNotFoundException(f'There is no account with pesel {targetPesel}')
+
+        return self._transfer(target, _grpc_currency(currency), _grpc_currency(targetCurrency), amount)
+
+    @metrics.measure
+    @authenticate
+    def exchange(self, currency, targetCurrency, amount: float, current=None):
+        return self._transfer(self._record, _grpc_currency(currency), _grpc_currency(targetCurrency), amount)
+
+    @metrics.measure
+    @authenticate
+    def executeBatch(self, operations, atomic: bool, current=None):
+        statuses = self._bank.execute([(self._record, operations)], atomic)[0]
+
+        self._bank.audit.record('batch', pesel=self.pesel, operations=len(operations), atomic=atomic)
+
+        return statuses
+
+    def _transfer(self, target: AccountRecord, currency: Currency, target_currency: Currency, amount: float):
+        """ Moves amount from this account to target account, converting it to target currency """
+
+        # check amount
+        if amount <= 0:
+            raise Banking.InvalidAmountException('Amount has to be positive')
 
-        logger.info("Withdraw {} {} from account of client {}", amount, currency.name, self.pesel)
+        # check if currencies are supported
+        for c in (currency, target_currency):
+            if c not in self._bank.supported_currencies:
+                raise Banking.UnsupportedCurrencyException(f'Currency {c.name} is not supported by this bank')
+
+        # convert amount
+        target_amount = self._bank.convert(amount, currency, target_currency)
+
+        # move money, if has enough
+        if not self._bank.accounts.transfer(self._record, currency, amount, target, target_currency, target_amount):
+            raise Banking.NotEnoughMoneyException('This account has not enough money to transfer')
+
+        self._bank.audit.record('transfer', pesel=self.pesel, currency=currency.name, amount=amount,
+                                target=target.pesel, target_currency=target_currency.name, target_amount=target_amount)
+
+        return Banking.TransferResult(amount, target_amount)
 
     def __repr__(self):
         return f"<Account(firstName='{self.firstName}'', lastName='{self.lastName}'', pesel='{self.pesel}'')>"
@@ -111,49 +205,222 @@ class AccountI(Banking.Account):
 class PremiumAccountI(AccountI, Banking.PremiumAccount):
     """ Extends base account with premium functionality """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.type = Banking.AccountType.PREMIUM
+    type = Banking.AccountType.PREMIUM
 
+    @metrics.measure
     @authenticate
     def getCreditOffer(self, currency, amount: float, monthsDuration: int, current=None):
         currency = _grpc_currency(currency)
 
         # check if currency is supported
-        if currency not in self.balance:
+        if currency not in self._bank.supported_currencies:
             raise Banking.UnsupportedCurrencyException(f'Currency {currency.name} is not supported by this bank')
 
+        # get consistent rates
+        rates = self._bank.rates_snapshot(currency)
+
         # calculate total cost
         cost = amount + (amount * monthsDuration * self._bank.interest)
 
-        logger.info("Client {} requested credit offer", self.pesel)
+        self._bank.audit.sample('credit_offer', pesel=self.pesel, currency=currency.name, amount=amount, months=monthsDuration)
 
         # return response
         return Banking.CreditOffer(
-            baseCurrency=cost / self._bank.rates[currency],
-            foreignCurrency=cost
+            baseCurrency=cost / rates[currency],
+            foreignCurrency=cost,
+            ratesVersion=rates.version,
+            ratesAge=rates.age
         )
 
     def __repr__(self):
         return f"<PremiumAccount(firstName='{self.firstName}'', lastName='{self.lastName}'', pesel='{self.pesel}'')>"
 
 
+class AccountLocator(Ice.ServantLocator):
+    """
+    Servant locator creating account servants on first request.
+    Servants are kept in bounded LRU cache and evicted when idle, so only recently used accounts stay resident.
+    """
+
+    def __init__(self, bank, size: int, idle_timeout: float):
+        """ Creates locator, caching at most size servants for at most idle_timeout seconds since last use """
+        self._bank = bank
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._servants = OrderedDict()
+        self._lock = threading.Lock()
+
+    def locate(self, current):
+        pesel = current.id.name
+        now = time.monotonic()
+
+        with self._lock:
+
+            # get cached servant and mark it as recently used
+            entry = self._servants.pop(pesel, None)
+            servant = entry[0] if entry else None
+
+            # create servant from store
+            if servant is None:
+                record = self._bank.accounts.get(pesel)
+                if record is None:
+                    return None
+                servant = self._bank.create_servant(record)
+
+            # evict idle servants, least recently used are at the beginning
+            while self._servants:
+                oldest = next(iter(self._servants.values()))
+                if now - oldest[1] < self._idle_timeout and len(self._servants) < self._size:
+                    break
+                self._servants.popitem(last=False)
+
+            self._servants[pesel] = (servant, now)
+
+        return servant, None
+
+    def finished(self, current, servant, cookie):
+        pass
+
+    def evict(self, pesel: str):
+        """ Removes servant of account from cache """
+        with self._lock:
+            self._servants.pop(pesel, None)
+
+    def deactivate(self, category):
+        with self._lock:
+            self._servants.clear()
+
+
 class BankI(Banking.Bank):
 
-    def __init__(self, adapter, rates: ExchangeRates, base_currency: Currency, currencies: List[Currency], premium_threshold: int):
+    def __init__(self, adapter, rates: ExchangeRates, base_currency: Currency, currencies: List[Currency], premium_threshold: int,
+                 store: AccountStore = None, servant_cache: int = 0, servant_idle_timeout: float = 300., session_timeout: float = 600.,
+                 max_rates_age: float = 0., audit: AuditLog = None):
+        """
+        Creates bank.
+        If servant_cache is positive account servants are activated lazily by servant locator,
+        otherwise servant of every account is added to adapter.
+        If max_rates_age is positive, operations using exchange rates older than that number of seconds are refused.
+        """
         self.adapter = adapter
         self.rates = rates
         self.base_currency = base_currency
         self.currencies = currencies
         self.premium_threshold = premium_threshold
         self.interest = 0.05
-        self.accounts = dict()
+        self.max_rates_age = max_rates_age
+        self.supported_currencies = tuple(sorted(set(currencies + [base_currency])))
+        self.accounts = store if store is not None else AccountStore()
+        self.sessions = SessionTable(session_timeout)
+        self.audit = audit if audit is not None else AuditLog()
+        self.locator = None
+
+        # recover accounts
+        records = self.accounts.recover()
+
+        # setup servants activation
+        if servant_cache > 0:
+            self.locator = AccountLocator(self, servant_cache, servant_idle_timeout)
+            self.adapter.addServantLocator(self.locator, '')
+        else:
+            for record in records:
+                self.adapter.add(self.create_servant(record), Ice.stringToIdentity(record.pesel))
+
+    def rates_snapshot(self, *currencies: Currency) -> RatesSnapshot:
+        """ Returns current exchange rates, checks if they are not stale and contain rates of given currencies """
+        snapshot = self.rates.snapshot
+
+        # check age
+        if self.max_rates_age and snapshot.age > self.max_rates_age:
+            raise Banking.RatesUnavailableException(f'Exchange rates are stale, last update was {snapshot.age:.1f} seconds ago')
+
+        # check currencies
+        for currency in currencies:
+            if currency not in snapshot:
+                raise Banking.RatesUnavailableException(f'Exchange rate for currency {currency.name} is not available')
+
+        return snapshot
+
+    def convert(self, amount: float, currency: Currency, target_currency: Currency) -> float:
+        """ Converts amount between currencies using current exchange rates """
+        if currency == target_currency:
+            return amount
+        rates = self.rates_snapshot(currency, target_currency)
+        return amount / rates[currency] * rates[target_currency]
+
+    def execute(self, batches: List[Tuple[AccountRecord, list]], atomic: bool) -> List[list]:
+        """ Validates and applies batches of operations of many accounts at once, returns statuses grouped by batch """
+        statuses = []
+        changes = []
+        positions = []
+
+        # validate operations and convert them to balance changes
+        for account, operations in batches:
+            batch_statuses = []
+            for operation in operations:
+                currency = _grpc_currency(operation.currency)
+                if currency not in self.supported_currencies:
+                    status = Banking.OperationStatus.UNSUPPORTED
+                elif operation.amount <= 0:
+                    status = Banking.OperationStatus.INVALID
+                else:
+                    status = Banking.OperationStatus.SUCCESS
+                    delta = operation.amount if operation.type == Banking.OperationType.DEPOSIT else -operation.amount
+                    changes.append((account, currency, delta))
+                    positions.append((batch_statuses, len(batch_statuses)))
+                batch_statuses.append(status)
+            statuses.append(batch_statuses)
+
+        # apply changes, atomic batch with invalid operations fails as a whole
+        if atomic and len(changes) != sum(len(operations) for _, operations in batches):
+            results, rolled_back = [True] * len(changes), True
+        else:
+            results = self.accounts.apply(changes, atomic)
+            rolled_back = atomic and not all(results)
+
+        # update statuses of valid operations
+        for (batch_statuses, index), success in zip(positions, results):
+            if not success:
+                batch_statuses[index] = Banking.OperationStatus.INSUFFICIENT
+            elif rolled_back:
+                batch_statuses[index] = Banking.OperationStatus.ROLLEDBACK
+
+        return statuses
+
+    def create_servant(self, record: AccountRecord) -> AccountI:
+        """ Creates servant of type matching account record """
+        if record.premium:
+            return PremiumAccountI(self, record)
+        return AccountI(self, record)
+
+    def add_account(self, record: AccountRecord) -> bool:
+        """ Adds account to store, returns False if it already exists. With servant locator servant will be created on first request """
+        if not self.accounts.register(record):
+            return False
+        if self.locator is None:
+            self.adapter.add(self.create_servant(record), Ice.stringToIdentity(record.pesel))
+        return True
+
+    def remove_account(self, pesel: str) -> AccountRecord:
+        """ Removes account from store together with its servant, returns removed record or None if there is no such account """
+        record = self.accounts.remove(pesel)
+        if record is None:
+            return None
+        if self.locator is None:
+            self.adapter.remove(Ice.stringToIdentity(pesel))
+        else:
+            self.locator.evict(pesel)
+        return record
 
-    def registerAccount(self, firstName: str, lastName: str, pesel: str, declaredMonthlyIncome: float, current=None):
+    def _create_proxy(self, record: AccountRecord, current):
+        """ Creates proxy of type matching account record """
+        account_proxy = current.adapter.createProxy(Ice.stringToIdentity(record.pesel))
+        if record.premium:
+            return Banking.PremiumAccountPrx.uncheckedCast(account_proxy)
+        return Banking.AccountPrx.uncheckedCast(account_proxy)
 
-        # check pesel
-        if pesel in self.accounts.keys():
-            raise Banking.AccountExistsException('Account with given pesel already exists')
+    @metrics.measure
+    def registerAccount(self, firstName: str, lastName: str, pesel: str, declaredMonthlyIncome: float, current=None):
 
         # generate password
         password = _generate_password()
@@ -165,47 +432,162 @@ class BankI(Banking.Bank):
             account_type = Banking.AccountType.PREMIUM
 
         # create account
-        if account_type == Banking.AccountType.STANDARD:
-            account = AccountI(self, firstName, lastName, pesel, declaredMonthlyIncome, password)
-        else:
-            account = PremiumAccountI(self, firstName, lastName, pesel, declaredMonthlyIncome, password)
+        account = AccountRecord(firstName, lastName, pesel, declaredMonthlyIncome, password, account_type == Banking.AccountType.PREMIUM)
 
         # register account
-        self.adapter.add(account, Ice.stringToIdentity(pesel))
-        self.accounts[pesel] = account
+        if not self.add_account(account):
+            raise Banking.AccountExistsException('Account with given pesel already exists')
 
         # logging
         logger.info('Registered new account: {}', repr(account))
 
-        # get proxy
-        account_proxy = current.adapter.createProxy(Ice.stringToIdentity(account.pesel))
-        if account.type == Banking.AccountType.PREMIUM:
-            account_proxy = Banking.PremiumAccountPrx.uncheckedCast(account_proxy)
-        else:
-            account_proxy = Banking.AccountPrx.uncheckedCast(account_proxy)
-
         # response
-        return Banking.RegistrationResult(firstName, lastName, pesel, password, _ice_currency(self.base_currency), account_type, account_proxy)
+        return Banking.RegistrationResult(firstName, lastName, pesel, password, _ice_currency(self.base_currency), account_type, self._create_proxy(account, current))
 
-    def recoverAccount(self, pesel: str, password: str, current=None):
+    def _check_password(self, pesel: str, password: str) -> AccountRecord:
+        """ Returns account with given pesel if password is correct """
 
         # get account
-        if pesel not in self.accounts:
+        account = self.accounts.get(pesel)
+        if account is None:
             raise Banking.AuthenticationException('Wrong pesel')
 
-        print(password, self.accounts[pesel].password)
-
-        # get account
-        if self.accounts[pesel].password != password:
+        # check password
+        if not hmac.compare_digest(account.password.encode(), password.encode()):
             raise Banking.AuthenticationException('Wrong password')
 
-        account = self.accounts[pesel]
+        return account
 
-        # get proxy
-        account_proxy = current.adapter.createProxy(Ice.stringToIdentity(account.pesel))
-        if account.type == Banking.AccountType.PREMIUM:
-            account_proxy = Banking.PremiumAccountPrx.uncheckedCast(account_proxy)
-        else:
-            account_proxy = Banking.AccountPrx.uncheckedCast(account_proxy)
+    @metrics.measure
+    def recoverAccount(self, pesel: str, password: str, current=None):
+        account = self._check_password(pesel, password)
+        account_type = Banking.AccountType.PREMIUM if account.premium else Banking.AccountType.STANDARD
+
+        return Banking.RegistrationResult(account.firstName, account.lastName, pesel, password, _ice_currency(self.base_currency), account_type, self._create_proxy(account, current))
+
+    @metrics.measure
+    def login(self, pesel: str, password: str, current=None):
+        self._check_password(pesel, password)
+        token, _ = self.sessions.create(pesel)
+
+        logger.info('Client {} logged in', pesel)
+
+        return Banking.Session(token, int(self.sessions.timeout))
+
+    @metrics.measure
+    def logout(self, token: str, current=None):
+        self.sessions.revoke(token)
+
+    @metrics.measure
+    def getExchangeRatesStatus(self, current=None):
+        snapshot = self.rates.snapshot
+        return Banking.ExchangeRatesStatus(snapshot.version, snapshot.age, self.rates.reconnects, self.rates.time_without_rates)
+
+    @metrics.measure
+    def executeBulk(self, batches, atomic: bool, current=None):
+
+        # authenticate every batch before executing any of them
+        accounts = []
+        for batch in batches:
+            account = self.accounts.get(batch.pesel)
+            if account is None or not hmac.compare_digest(account.password.encode(), batch.password.encode()):
+                raise Banking.AuthenticationException(f'Incorrect pesel/password combination for {batch.pesel}')
+            accounts.append((account, batch.operations))
+
+        try:
+            statuses = self.execute(accounts, atomic)
+        except AccountRemovedError as err:
+            raise Banking.AuthenticationException(f'Incorrect pesel/password combination for {err.pesel}')
+
+        self.audit.record('bulk', batches=len(batches), atomic=atomic)
+
+        return statuses
+
+
+def _account_state(record: AccountRecord):
+    """ Converts account record to state sent between shards """
+    balance = {_ice_currency(c): record.balance[c] for c in Currency}
+    return Banking.AccountState(record.firstName, record.lastName, record.pesel, record.declared_income, record.password, record.premium, balance)
+
+
+def _account_record(state) -> AccountRecord:
+    """ Converts state received from another shard to account record """
+    record = AccountRecord(state.firstName, state.lastName, state.pesel, state.declaredIncome, state.password, state.premium)
+    for currency, amount in state.balance.items():
+        record.balance[currency.value] = amount
+    return record
+
+
+class ShardI(Banking.Shard):
+    """
+    Internal servant of bank running as one of shards, used by router to move accounts between shards.
+    Accounts to export are found once per ring, then handed out in chunks. Exported accounts are frozen
+    and removed only when router confirms that their owner imported them.
+    """
+
+    def __init__(self, bank: BankI):
+        self._bank = bank
+        self._ring = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def exportAccounts(self, ring, name: str, limit: int, current=None):
+        with self._lock:
+
+            # find accounts owned by other shards, if ring changed, ring is kept as (shards, name, hash ring)
+            if self._ring is None or self._ring[:2] != (tuple(ring), name):
+                hash_ring = HashRing(ring)
+                self._ring = (tuple(ring), name, hash_ring)
+                self._pending = [pesel for pesel in list(self._bank.accounts.keys()) if hash_ring.owner(pesel) != name]
+            hash_ring = self._ring[2]
+
+            # accounts left frozen by interrupted rebalance are exported again, unless ring changed and they are owned by this shard now
+            frozen = self._bank.accounts.frozen()
+            owned = [pesel for pesel in frozen if hash_ring.owner(pesel) == name]
+            if owned:
+                self._bank.accounts.unfreeze(owned)
+                logger.info('Kept {} accounts left frozen by interrupted rebalance', len(owned))
+            frozen = [pesel for pesel in frozen if hash_ring.owner(pesel) != name]
+
+            if frozen:
+                records = self._bank.accounts.freeze(frozen[:limit])
+
+            else:
+                # freeze chunk of them
+                records = self._bank.accounts.freeze(self._pending[-limit:])
+                del self._pending[-limit:]
+
+                # forget ring when done, so that next rebalance looks for accounts again
+                if not records and not self._pending:
+                    self._ring = None
+
+        logger.info('Exported {} accounts to other shards', len(records))
+
+        return [_account_state(record) for record in records]
+
+    def importAccounts(self, accounts, current=None):
+        rejected = []
+        for state in accounts:
+            record = _account_record(state)
+            if self._bank.add_account(record):
+                continue
+
+            # the same account imported again after interrupted rebalance is accepted
+            existing = self._bank.accounts.get(state.pesel)
+            if existing is None or _account_state(existing) != state:
+                rejected.append(state.pesel)
+
+        logger.info('Imported {} accounts from other shards', len(accounts) - len(rejected))
+
+        return rejected
+
+    def confirmExport(self, pesels, current=None):
+        for pesel in pesels:
+            self._bank.remove_account(pesel)
+
+        logger.info('Removed {} accounts moved to other shards', len(pesels))
+
+    def abortExport(self, pesels, current=None):
+        self._bank.accounts.unfreeze(pesels)
 
-        return Banking.RegistrationResult(account.firstName, account.lastName, pesel, password, _ice_currency(self.base_currency), account.type, account_proxy)
+        logger.info('Kept {} accounts which could not be moved to other shards', len(pesels))
@@ -0,0 +1,77 @@
+"""
+Benchmark of account store throughput.
+Compares in-memory store with journaled store, deposits are made concurrently from many threads
+the same way Ice dispatches them from its thread pool.
+
+Run from bank directory: python -m benchmarks.account_store
+"""
+import argparse
+import tempfile
+import threading
+import time
+
+from account_store import AccountRecord, AccountStore, JournaledAccountStore
+from exchange_rates import Currency
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Account store benchmark')
+
+    parser.add_argument('-a', '--accounts',
+                        type=int,
+                        default=1000,
+                        help='Number of registered accounts'
+                        )
+    parser.add_argument('-n', '--operations',
+                        type=int,
+                        default=20000,
+                        help='Number of deposits per thread'
+                        )
+    parser.add_argument('-t', '--threads',
+                        type=int,
+                        default=8,
+                        help='Number of dispatching threads'
+                        )
+    parser.add_argument('-s', '--snapshot-interval',
+                        type=int,
+                        default=100000,
+                        help='Number of changes between snapshots of journaled store'
+                        )
+
+    return parser.parse_args()
+
+
+def _run(store: AccountStore, args) -> float:
+    """ Registers accounts and performs deposits, returns operations per second """
+    store.recover()
+
+    accounts = [AccountRecord('John', 'Doe', str(i), 1000., 'password', False) for i in range(args.accounts)]
+    for account in accounts:
+        store.register(account)
+
+    def worker(offset: int):
+        for i in range(args.operations):
+            store.deposit(accounts[(offset + i) % len(accounts)], Currency.PLN, 1.)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    store.close()
+    return args.threads * args.operations / elapsed
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    args = _parse_arguments()
+
+    print(f'{"memory":>10}: {_run(AccountStore(), args):12,.0f} deposits/s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f'{"journaled":>10}: {_run(JournaledAccountStore(directory, args.snapshot_interval), args):12,.0f} deposits/s')
@@ -0,0 +1,90 @@
+"""
+Micro-benchmark of authenticated account calls.
+Compares previous, inspect based, authenticate decorator with current one, using password and session token.
+
+Run from bank directory: python -m benchmarks.authenticate
+"""
+import argparse
+import inspect
+import timeit
+from types import SimpleNamespace
+
+import bank
+from bank import authenticate
+from sessions import SessionTable
+
+
+def _legacy_authenticate(func):
+    """ Previous implementation of authenticate, binds signature on every call """
+
+    def authenticate_decorator(*args, **kwargs):
+        arguments = inspect.signature(func).bind(*args, **kwargs).arguments
+        account = arguments['self']
+        context = arguments['current'].ctx
+
+        if 'password' not in context:
+            raise bank.Banking.AuthenticationException('No password provided')
+
+        if context['password'] != account.password:
+            raise bank.Banking.AuthenticationException('Incorrect pesel/password combination')
+
+        return func(*args, **kwargs)
+
+    return authenticate_decorator
+
+
+def _operation(self, currency, amount, current=None):
+    return amount
+
+
+class _Account:
+    """ Minimal account, avoids measuring anything but decorator """
+
+    pesel = '12345678901'
+    password = 'abcdefghij'
+    _bank = SimpleNamespace(sessions=SessionTable(600.))
+
+    legacy = _legacy_authenticate(_operation)
+    cached = authenticate(_operation)
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Authenticated calls benchmark')
+
+    parser.add_argument('-n', '--number',
+                        type=int,
+                        default=200000,
+                        help='Number of calls per measurement'
+                        )
+    parser.add_argument('-r', '--repeat',
+                        type=int,
+                        default=5,
+                        help='Number of measurements, best one is reported'
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    args = _parse_arguments()
+
+    account = _Account()
+    token, _ = account._bank.sessions.create(account.pesel)
+
+    cases = (
+        ('legacy', account.legacy, {'password': account.password}),
+        ('cached', account.cached, {'password': account.password}),
+        ('session', account.cached, {'token': token}),
+    )
+
+    for name, method, context in cases:
+        current = SimpleNamespace(ctx=context)
+
+        # Ice passes current positionally, measure both call styles
+        positional = min(timeit.repeat(lambda: method(None, 1., current), number=args.number, repeat=args.repeat))
+        keyword = min(timeit.repeat(lambda: method(None, 1., current=current), number=args.number, repeat=args.repeat))
+
+        print(f'{name:>8}: {args.number / positional:12,.0f} calls/s (positional current)')
+        print(f'{name:>8}: {args.number / keyword:12,.0f} calls/s (keyword current)')
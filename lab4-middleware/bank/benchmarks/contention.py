@@ -0,0 +1,90 @@
+"""
+Contention benchmark of account store locking.
+Many threads, like Ice dispatch threads, make deposits, withdrawals and transfers between a small set of accounts.
+Throughput is reported for different numbers of lock stripes, total money is checked to detect lost updates.
+
+Run from bank directory: python -m benchmarks.contention
+"""
+import argparse
+import random
+import threading
+import time
+
+from account_store import AccountRecord, AccountStore
+from exchange_rates import Currency
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Account store contention benchmark')
+
+    parser.add_argument('-a', '--accounts',
+                        type=int,
+                        default=16,
+                        help='Number of accounts'
+                        )
+    parser.add_argument('-n', '--operations',
+                        type=int,
+                        default=50000,
+                        help='Number of operations per thread'
+                        )
+    parser.add_argument('-t', '--threads',
+                        type=int,
+                        default=32,
+                        help='Number of dispatching threads'
+                        )
+    parser.add_argument('-s', '--stripes',
+                        type=int,
+                        nargs='*',
+                        default=[1, 16, 64],
+                        help='Numbers of lock stripes to compare'
+                        )
+
+    return parser.parse_args()
+
+
+def _run(stripes: int, args):
+    """ Returns operations per second and difference between expected and actual total balance """
+    store = AccountStore(stripes)
+    accounts = [AccountRecord('John', 'Doe', str(i), 1000., 'password', False) for i in range(args.accounts)]
+    for account in accounts:
+        store.register(account)
+        store.deposit(account, Currency.PLN, 1000.)
+
+    deposited = [0.] * args.threads
+
+    def worker(index: int):
+        rand = random.Random(index)
+        for _ in range(args.operations):
+            source, target = rand.choice(accounts), rand.choice(accounts)
+            operation = rand.random()
+            if operation < 0.25:
+                store.deposit(source, Currency.PLN, 1.)
+                deposited[index] += 1.
+            elif operation < 0.5:
+                if store.withdraw(source, Currency.PLN, 1.):
+                    deposited[index] -= 1.
+            else:
+                store.transfer(source, Currency.PLN, 1., target, Currency.PLN, 1.)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    expected = 1000. * args.accounts + sum(deposited)
+    actual = sum(account.balance[Currency.PLN] for account in accounts)
+    return args.threads * args.operations / elapsed, actual - expected
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    args = _parse_arguments()
+
+    for stripes in args.stripes:
+        throughput, difference = _run(stripes, args)
+        print(f'{stripes:>4} stripes: {throughput:12,.0f} operations/s, balance difference {difference}')
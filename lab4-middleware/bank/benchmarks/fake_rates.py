@@ -0,0 +1,96 @@
+"""
+Fake exchange rates service, streams randomly changing rates like the real node server.
+Can be started in-process with serve, or standalone.
+
+Run from bank directory: python -m benchmarks.fake_rates -p 50051
+"""
+import argparse
+import random
+import time
+from concurrent import futures
+
+import grpc
+
+import idl.exchange_rates_pb2 as proto
+from exchange_rates import Currency
+from idl.exchange_rates_pb2_grpc import ExchangeRatesServiceServicer, add_ExchangeRatesServiceServicer_to_server
+
+# rates relative to EUR, same as defaults of exchange rates server
+DEFAULT_RATES = {
+    Currency.EUR: 1.0000,
+    Currency.USD: 1.1155,
+    Currency.GBP: 0.85785,
+    Currency.PLN: 4.2853
+}
+
+# banks ping service every 10 seconds by default to detect lost connections, pings more often than
+# every 5 minutes are refused by default with too_many_pings and connection is closed
+SERVER_OPTIONS = [
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.min_ping_interval_without_data_ms', 5000),
+]
+
+
+class FakeRatesService(ExchangeRatesServiceServicer):
+    """ Sends all requested rates on subscription, then changes of random rates every interval """
+
+    def __init__(self, interval: float = 1., max_change: float = 0.01):
+        self.interval = interval
+        self.max_change = max_change
+        self.rates = dict(DEFAULT_RATES)
+
+    def _update(self, request, currencies):
+        update = proto.ExchangeRatesUpdate(timestamp=time.time())
+        base = self.rates[Currency(request.baseCurrency)]
+        for currency in currencies:
+            update.rates.add(currency=currency, value=self.rates[Currency(currency)] / base)
+        return update
+
+    def subscribe(self, request, context):
+        yield self._update(request, request.requestedCurrencies)
+
+        while context.is_active():
+            time.sleep(self.interval)
+
+            # change random rate
+            currency = random.choice([c for c in Currency if c != Currency.EUR])
+            self.rates[currency] *= 1 + random.uniform(-self.max_change, self.max_change)
+
+            if currency == Currency(request.baseCurrency):
+                yield self._update(request, request.requestedCurrencies)
+            elif currency in request.requestedCurrencies:
+                yield self._update(request, [currency])
+
+
+def serve(port: int, interval: float = 1.) -> grpc.Server:
+    """ Starts fake service at given port, returns started server """
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=16), options=SERVER_OPTIONS)
+    add_ExchangeRatesServiceServicer_to_server(FakeRatesService(interval), server)
+    server.add_insecure_port(f'[::]:{port}')
+    server.start()
+    return server
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Fake exchange rates service')
+
+    parser.add_argument('-p', '--port',
+                        type=int,
+                        required=True,
+                        help='Port to listen to'
+                        )
+    parser.add_argument('-i', '--interval',
+                        type=float,
+                        default=1.,
+                        help='Seconds between rate changes'
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    args = _parse_arguments()
+
+    serve(args.port, args.interval).wait_for_termination()
@@ -0,0 +1,267 @@
+"""
+Load generator for bank server.
+Starts fake exchange rates service and bank server (unless existing bank is given),
+then drives configurable mix of operations from many concurrent clients using asynchronous invocations.
+Every client keeps single request in flight and sends next one when previous completes.
+Throughput and latency percentiles are reported as JSON.
+
+Run from bank directory: python -m benchmarks.load -c 64 -d 30 --mix deposit=40,withdraw=30,balance=20,credit=5,register=5
+"""
+import argparse
+import itertools
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+import Ice
+
+from benchmarks import fake_rates
+from metrics import Histogram
+
+# fix broken ice imports
+sys.path.append('./idl')
+import Banking
+
+OPERATIONS = ('register', 'deposit', 'withdraw', 'balance', 'credit')
+
+
+def _parse_mix(value: str):
+    mix = {}
+    for item in value.split(','):
+        operation, weight = item.split('=')
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'unknown operation {operation}, available: {", ".join(OPERATIONS)}')
+        mix[operation] = float(weight)
+    return mix
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Bank server load generator')
+
+    parser.add_argument('-c', '--clients',
+                        type=int,
+                        default=32,
+                        help='Number of concurrent clients'
+                        )
+    parser.add_argument('-d', '--duration',
+                        type=float,
+                        default=10.,
+                        help='Duration of measurement in seconds'
+                        )
+    parser.add_argument('-m', '--mix',
+                        type=_parse_mix,
+                        default=_parse_mix('deposit=40,withdraw=30,balance=20,credit=5,register=5'),
+                        help='Weights of operations, as comma separated operation=weight pairs'
+                        )
+    parser.add_argument('-H', '--host',
+                        default='localhost',
+                        help='Host of existing bank server'
+                        )
+    parser.add_argument('-p', '--port',
+                        type=int,
+                        default=10000,
+                        help='Port of bank server'
+                        )
+    parser.add_argument('-e', '--existing',
+                        action='store_true',
+                        help='Use already running bank server instead of starting one'
+                        )
+    parser.add_argument('-rp', '--rates-port',
+                        type=int,
+                        default=50051,
+                        help='Port of started fake exchange rates service'
+                        )
+    parser.add_argument('-T', '--threads',
+                        type=int,
+                        default=4,
+                        help='Number of dispatch threads of started bank server'
+                        )
+    parser.add_argument('-o', '--output',
+                        help='File to write JSON report to, printed if omitted'
+                        )
+
+    return parser.parse_args()
+
+
+class _Stats:
+    """ Latency histograms and errors of all operations """
+
+    def __init__(self):
+        self.latency = {operation: Histogram() for operation in OPERATIONS}
+        self.errors = {operation: Counter() for operation in OPERATIONS}
+        self.lock = threading.Lock()
+
+    def record(self, operation: str, elapsed: float, error):
+        with self.lock:
+            self.latency[operation].record(elapsed)
+            if error is not None:
+                self.errors[operation][type(error).__name__] += 1
+
+    def report(self, duration: float) -> dict:
+        operations = {}
+        for operation in OPERATIONS:
+            histogram = self.latency[operation]
+            if not histogram.count:
+                continue
+            operations[operation] = {
+                'count': histogram.count,
+                'throughput': histogram.count / duration,
+                'errors': dict(self.errors[operation]),
+                'p50': histogram.percentile(50),
+                'p99': histogram.percentile(99),
+                'p999': histogram.percentile(99.9),
+                'mean': histogram.sum / histogram.count,
+            }
+
+        total = sum(o['count'] for o in operations.values())
+        return {'duration': duration, 'operations': total, 'throughput': total / duration, 'by_operation': operations}
+
+
+class _Client:
+    """ Closed-loop client, sends next request from callback of previous one """
+
+    def __init__(self, generator, registration, context):
+        self._generator = generator
+        self._account = Banking.PremiumAccountPrx.uncheckedCast(registration.account)
+        self._context = context
+
+    def next(self):
+        generator = self._generator
+        if generator.stopped:
+            generator.finished()
+            return
+
+        operation = generator.choose()
+        start = time.perf_counter()
+        future = self._invoke(operation)
+        future.add_done_callback(lambda f: self._completed(operation, start, f))
+
+    def _invoke(self, operation: str):
+        currency = random.choice(self._generator.currencies)
+        if operation == 'register':
+            return self._generator.bank.registerAccountAsync('Load', 'Test', self._generator.pesel(), 20000.)
+        if operation == 'deposit':
+            return self._account.depositAsync(currency, 10., self._context)
+        if operation == 'withdraw':
+            return self._account.withdrawAsync(currency, 5., self._context)
+        if operation == 'balance':
+            return self._account.getBalanceAsync(self._context)
+        return self._account.getCreditOfferAsync(currency, 1000., 12, self._context)
+
+    def _completed(self, operation: str, start: float, future):
+        self._generator.stats.record(operation, time.perf_counter() - start, future.exception())
+        self.next()
+
+
+class LoadGenerator:
+    """ Runs clients against bank for given duration """
+
+    def __init__(self, bank_proxy, clients: int, mix: dict):
+        self.bank = bank_proxy
+        self.stats = _Stats()
+        self.stopped = False
+        self.currencies = [Banking.Currency.PLN, Banking.Currency.EUR, Banking.Currency.USD]
+
+        self._clients = clients
+        self._operations = list(mix.keys())
+        self._weights = list(mix.values())
+        self._pesels = itertools.count(10 ** 10)
+        self._running = clients
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+
+    def pesel(self) -> str:
+        return str(next(self._pesels))
+
+    def choose(self) -> str:
+        return random.choices(self._operations, self._weights)[0]
+
+    def finished(self):
+        with self._lock:
+            self._running -= 1
+            if not self._running:
+                self._finished.set()
+
+    def run(self, duration: float) -> dict:
+        # register accounts, premium so that credit offers are available
+        clients = []
+        for _ in range(self._clients):
+            registration = self.bank.registerAccount('Load', 'Test', self.pesel(), 20000.)
+            session = self.bank.login(registration.pesel, registration.password)
+            clients.append(_Client(self, registration, {'token': session.token}))
+
+        # run clients
+        start = time.perf_counter()
+        for client in clients:
+            client.next()
+        time.sleep(duration)
+        self.stopped = True
+        self._finished.wait()
+
+        return self.stats.report(time.perf_counter() - start)
+
+
+def _start_bank(args):
+    """ Starts bank server connected to fake exchange rates service """
+    return subprocess.Popen([
+        sys.executable, 'app.py',
+        '-p', str(args.port),
+        '-eh', 'localhost',
+        '-ep', str(args.rates_port),
+        '-b', 'PLN',
+        '-T', str(args.threads),
+    ])
+
+
+def _wait_for_bank(proxy, timeout: float = 30.):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            proxy.ice_ping()
+            return
+        except Ice.ConnectFailedException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    args = _parse_arguments()
+
+    rates_server = None
+    bank_process = None
+
+    # start fake exchange rates service and bank
+    if not args.existing:
+        rates_server = fake_rates.serve(args.rates_port)
+        bank_process = _start_bank(args)
+
+    try:
+        with Ice.initialize() as communicator:
+            proxy = communicator.stringToProxy(f'Bank:default -h {args.host} -p {args.port}')
+            _wait_for_bank(proxy)
+            bank_proxy = Banking.BankPrx.uncheckedCast(proxy)
+
+            report = LoadGenerator(bank_proxy, args.clients, args.mix).run(args.duration)
+            report['config'] = {'clients': args.clients, 'mix': args.mix, 'threads': None if args.existing else args.threads}
+
+    finally:
+        if bank_process is not None:
+            bank_process.terminate()
+            bank_process.wait()
+        if rates_server is not None:
+            rates_server.stop(0)
+
+    # write report
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
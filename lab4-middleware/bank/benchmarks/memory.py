@@ -0,0 +1,62 @@
+"""
+Benchmark of memory used by account records.
+Compares compact AccountRecord with previous representation, an object with __dict__ and balance dict keyed by currency.
+
+Run from bank directory: python -m benchmarks.memory
+"""
+import argparse
+import gc
+import tracemalloc
+
+from account_store import AccountRecord
+from exchange_rates import Currency
+
+
+class _LegacyAccount:
+    """ Previous account representation """
+
+    def __init__(self, firstName: str, lastName: str, pesel: str, declared_income: float, password: str):
+        self.firstName = firstName
+        self.lastName = lastName
+        self.pesel = pesel
+        self.declared_income = declared_income
+        self.password = password
+        self.premium = False
+        self.balance = {c: 0. for c in Currency}
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Account records memory benchmark')
+
+    parser.add_argument('-a', '--accounts',
+                        type=int,
+                        default=1000000,
+                        help='Number of accounts'
+                        )
+
+    return parser.parse_args()
+
+
+def _measure(factory, count: int) -> int:
+    """ Returns number of bytes allocated by count accounts, shared strings are excluded """
+    names = ('John', 'Doe', 'password')
+    pesels = [f'{i:011d}' for i in range(count)]
+
+    gc.collect()
+    tracemalloc.start()
+    accounts = [factory(names[0], names[1], pesel, 1000., names[2]) for pesel in pesels]
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del accounts
+    return used
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    args = _parse_arguments()
+
+    for name, factory in (('legacy', _LegacyAccount), ('compact', lambda *fields: AccountRecord(*fields, False))):
+        used = _measure(factory, args.accounts)
+        print(f'{name:>8}: {used / 2 ** 20:10,.1f} MiB, {used / args.accounts:6,.0f} bytes per account')
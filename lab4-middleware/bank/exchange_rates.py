@@ -1,12 +1,21 @@
 import enum
+import math
+import random
+import socket
+import struct
+import threading
 import time
-from typing import List
+from typing import Callable, Dict, Iterable, List, Optional
 
 import grpc
 from loguru import logger
 
 import idl.exchange_rates_pb2 as proto
 from idl.exchange_rates_pb2_grpc import ExchangeRatesServiceStub
+from metrics import Histogram
+
+
+_LENGTH = struct.Struct('!I')
 
 
 class Currency(enum.IntEnum):
@@ -20,14 +29,46 @@ class Currency(enum.IntEnum):
         return self.name
 
 
-class ExchangeRates:
-    """ Auto-updated exchange rates table. """
+def write_message(sock: socket.socket, message):
+    """ Sends protobuf message prefixed with its length """
+    data = message.SerializeToString()
+    sock.sendall(_LENGTH.pack(len(data)) + data)
 
-    def __init__(self, base_currency: Currency, requested_currencies: List[Currency]):
-        """ Creates exchange rates table """
+
+def read_message(sock: socket.socket, message_class):
+    """ Receives protobuf message of given class sent by write_message, raises ConnectionError when socket is closed """
+    length, = _LENGTH.unpack(_read_exactly(sock, _LENGTH.size))
+    return message_class.FromString(_read_exactly(sock, length))
+
+
+def _read_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return bytes(data)
+
+
+class RatesSnapshot:
+    """ Immutable exchange rates table, as it was after single update. """
+
+    __slots__ = ('version', 'received_at', '_base_currency', '_rates')
+
+    def __init__(self, version: int, received_at: Optional[float], base_currency: Currency, rates: Dict[Currency, float]):
+        """ Creates snapshot, rates should not be modified afterwards """
+        self.version = version
+        self.received_at = received_at
         self._base_currency = base_currency
-        self._requested_currencies = requested_currencies
-        self._rates = dict()
+        self._rates = rates
+
+    @property
+    def age(self) -> float:
+        """ Returns number of seconds since snapshot was received, or infinity if no update was received """
+        if self.received_at is None:
+            return math.inf
+        return time.time() - self.received_at
 
     def __contains__(self, key: Currency):
         """ Checks if rate for given currency is available. """
@@ -43,36 +84,153 @@ class ExchangeRates:
             raise KeyError(f'Exchange rate for currency {key.name} is not available')
         return self._rates[key]
 
-    def _subscribe(self, host: str, port: int):
-        with grpc.insecure_channel(f'{host}:{port}') as channel:
-            stub = ExchangeRatesServiceStub(channel)
+    def items(self):
+        """ Returns available (currency, rate) pairs, excluding base currency. """
+        return self._rates.items()
+
 
-            # setup request
-            req = proto.ExchangeRatesSubscription()
-            req.baseCurrency = int(self._base_currency)
-            req.requestedCurrencies[:] = [int(c) for c in self._requested_currencies]
+class ExchangeRates:
+    """
+    Auto-updated exchange rates table.
+    Every update is published as new snapshot replacing previous one with single assignment,
+    so readers get consistent rates without locking.
 
-            # get subscription
-            subscription = stub.subscribe(req)
+    Lost subscription is restarted immediately, following failures are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, base_currency: Currency, requested_currencies: List[Currency]):
+        """ Creates exchange rates table """
+        self._base_currency = base_currency
+        self._requested_currencies = requested_currencies
+        self.snapshot = RatesSnapshot(0, None, base_currency, dict())
+
+        # connection statistics
+        self.reconnects = 0
+        self._time_without_rates = 0.
+        self._without_rates_since = time.monotonic()
+
+        # delay between sending of update by exchange rates service and its publication, guarded by lock when read
+        self.update_lag = Histogram()
+        self.update_lag_lock = threading.Lock()
+
+    def __contains__(self, key: Currency):
+        """ Checks if rate for given currency is available. """
+        return key in self.snapshot
+
+    def __getitem__(self, key: Currency):
+        """ Returns rate for given value, or throws KeyError if rate is not available. """
+        return self.snapshot[key]
+
+    @property
+    def time_without_rates(self) -> float:
+        """ Returns total number of seconds during which there was no working subscription """
+        since = self._without_rates_since
+        if since is None:
+            return self._time_without_rates
+        return self._time_without_rates + time.monotonic() - since
+
+    def _publish(self, update):
+        """ Publishes snapshot containing previous rates updated with given ones """
+        previous = self.snapshot
+        rates = dict(previous.items())
+        for rate in update.rates:
+            rates[Currency(rate.currency)] = rate.value
+        now = time.time()
+        self.snapshot = RatesSnapshot(previous.version + 1, now, self._base_currency, rates)
+
+        # updates of older services and initial rates sent by relay have no timestamp
+        if update.timestamp:
+            with self.update_lag_lock:
+                self.update_lag.record(max(0., now - update.timestamp))
+
+        # mark subscription as working
+        if self._without_rates_since is not None:
+            self._time_without_rates += time.monotonic() - self._without_rates_since
+            self._without_rates_since = None
+
+        logger.debug('Exchange rates updated to version {}: {}', self.snapshot.version, dict(self.snapshot.items()))
+
+    def _subscribe(self, host: str, port: int, keepalive: float, ready_timeout: float) -> Iterable:
+        options = [
+            ('grpc.keepalive_time_ms', int(keepalive * 1000)),
+            ('grpc.keepalive_timeout_ms', int(keepalive * 1000)),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+        ]
+
+        with grpc.insecure_channel(f'{host}:{port}', options=options) as channel:
+            channel.subscribe(lambda state: logger.debug('Exchange rates channel state changed to {}', state.name))
+
+            # wait until channel is ready
+            grpc.channel_ready_future(channel).result(timeout=ready_timeout)
+
+            stub = ExchangeRatesServiceStub(channel)
 
             logger.debug('Subscribing to exchange rates service at {}:{}', host, port)
 
             # start fetching updates
-            for update in subscription:
-                for rate in update.rates:
-                    currency = Currency(rate.currency)
-                    self._rates[currency] = rate.value
-                    logger.debug('Exchange rate updated: {} {}', currency.name, rate.value)
+            yield from stub.subscribe(self._subscription_request())
+
+    def _attach(self, path: str) -> Iterable:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
 
-    def subscribe(self, host: str, port: int, retry_time: float = 5.):
+            # send subscription
+            write_message(sock, self._subscription_request())
+
+            logger.debug('Attached to exchange rates relay at {}', path)
+
+            # start fetching updates
+            while True:
+                yield read_message(sock, proto.ExchangeRatesUpdate)
+
+    def _subscription_request(self):
+        """ Creates subscription request for currencies of this table """
+        req = proto.ExchangeRatesSubscription()
+        req.baseCurrency = int(self._base_currency)
+        req.requestedCurrencies[:] = [int(c) for c in self._requested_currencies]
+        return req
+
+    def _receive(self, updates: Callable[[], Iterable], source: str, initial_backoff: float, max_backoff: float):
+        """ Publishes updates from given source, restarts it when it fails or ends """
+        failures = 0
+        while True:
+            try:
+                for update in updates():
+                    self._publish(update)
+                    failures = 0
+                logger.debug('Subscription to {} has ended', source)
+            except (grpc.RpcError, grpc.FutureTimeoutError, OSError) as err:
+                logger.debug('Lost connection to {}: {}', source, err)
+            except Exception:
+                logger.exception('Unexpected error while receiving exchange rates from {}', source)
+
+            # mark subscription as lost
+            if self._without_rates_since is None:
+                self._without_rates_since = time.monotonic()
+            self.reconnects += 1
+
+            # resubscribe immediately after first failure, then back off
+            if failures:
+                delay = min(max_backoff, initial_backoff * 2 ** (failures - 1))
+                delay = random.uniform(delay / 2, delay)
+                logger.debug('Reconnecting in {:.2f} seconds...', delay)
+                time.sleep(delay)
+            failures += 1
+
+    def attach(self, path: str, initial_backoff: float = 0.1, max_backoff: float = 30.):
+        """
+        Connects to exchange rates relay listening on unix socket at given path and starts receiving updates.
+        Should be started as separate thread, instead of subscribe.
+        """
+        self._receive(lambda: self._attach(path), 'exchange rates relay', initial_backoff, max_backoff)
+
+    def subscribe(self, host: str, port: int, initial_backoff: float = 0.1, max_backoff: float = 30.,
+                  keepalive: float = 10., ready_timeout: float = 5.):
         """
         Establishes connection with exchange rates server and starts receiving updates.
         Should be started as separate thread.
+        Connection is pinged every keepalive seconds, server has to permit pings that often even when it sends no updates,
+        gRPC servers close connection with too_many_pings after pings more often than every 5 minutes by default.
         """
-        while True:
-            try:
-                self._subscribe(host, port)
-            except grpc._channel._Rendezvous:
-                logger.debug('Lost connection to exchange rates server')
-                logger.debug('Reconnecting in {} seconds...', retry_time)
-                time.sleep(retry_time)
+        self._receive(lambda: self._subscribe(host, port, keepalive, ready_timeout), 'exchange rates server', initial_backoff, max_backoff)
@@ -0,0 +1,175 @@
+import math
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+# histogram resolution, every power of two is split into that many buckets (about 3% relative error)
+_SUB_BUCKETS = 32
+_EXPONENTS = 48
+
+
+class Histogram:
+    """
+    Log-linear latency histogram, in the spirit of HDR histogram.
+    Records values in microseconds with constant relative precision, in constant time and memory.
+    """
+
+    def __init__(self):
+        """ Creates empty histogram """
+        self.counts = [0] * (_EXPONENTS * _SUB_BUCKETS)
+        self.count = 0
+        self.sum = 0.
+
+    def record(self, seconds: float):
+        """ Records single value """
+        micros = seconds * 1e6
+        if micros < 1.:
+            index = 0
+        else:
+            mantissa, exponent = math.frexp(micros)
+            index = min(exponent * _SUB_BUCKETS + int((mantissa * 2 - 1) * _SUB_BUCKETS), len(self.counts) - 1)
+
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, percentile: float) -> float:
+        """ Returns upper bound, in seconds, of bucket containing given percentile """
+        if not self.count:
+            return 0.
+
+        rank = math.ceil(self.count * percentile / 100)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self._upper_bound(index) / 1e6
+        return self._upper_bound(len(self.counts) - 1) / 1e6
+
+    @staticmethod
+    def _upper_bound(index: int) -> float:
+        exponent, sub = divmod(index, _SUB_BUCKETS)
+        if exponent == 0:
+            return 1.
+        return (1 + (sub + 1) / _SUB_BUCKETS) * 2 ** (exponent - 1)
+
+
+class _OperationStats:
+    """ Latency and errors of single operation """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+
+class Metrics:
+    """ Registry of per-operation latency histograms and exception counts, rendered in Prometheus text format """
+
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, prefix: str = 'bank'):
+        """ Creates empty registry, metric names start with prefix """
+        self.prefix = prefix
+        self._operations: Dict[str, _OperationStats] = dict()
+        self._gauges: List[Tuple[str, str, Callable[[], float], str]] = []
+        self._histograms: List[Tuple[str, str, Histogram, threading.Lock]] = []
+
+    def measure(self, func):
+        """ Decorator recording latency and raised exceptions of function, named after it """
+        stats = self._operations.setdefault(func.__name__, _OperationStats())
+
+        @wraps(func)
+        def measure_decorator(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                with stats.lock:
+                    stats.errors[type(err).__name__] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                with stats.lock:
+                    stats.latency.record(elapsed)
+
+        return measure_decorator
+
+    def gauge(self, name: str, description: str, value: Callable[[], float], kind: str = 'gauge'):
+        """ Registers value read when metrics are rendered, kind is its Prometheus type """
+        self._gauges.append((name, description, value, kind))
+
+    def histogram(self, name: str, description: str, histogram: Histogram, lock: threading.Lock):
+        """ Registers histogram recorded elsewhere, rendered as summary, lock guards recording to it """
+        self._histograms.append((name, description, histogram, lock))
+
+    def render(self) -> str:
+        """ Returns all metrics in Prometheus text exposition format """
+        latency = f'{self.prefix}_operation_latency_seconds'
+        errors = f'{self.prefix}_operation_errors_total'
+        lines = [
+            f'# HELP {latency} Latency of bank operations',
+            f'# TYPE {latency} summary',
+        ]
+        error_lines = [
+            f'# HELP {errors} Exceptions raised by bank operations',
+            f'# TYPE {errors} counter',
+        ]
+
+        for name, stats in sorted(self._operations.items()):
+            with stats.lock:
+                quantiles = [(q, stats.latency.percentile(q * 100)) for q in self.QUANTILES]
+                count, total = stats.latency.count, stats.latency.sum
+                raised = sorted(stats.errors.items())
+
+            for q, value in quantiles:
+                lines.append(f'{latency}{{operation="{name}",quantile="{q}"}} {value}')
+            lines.append(f'{latency}_count{{operation="{name}"}} {count}')
+            lines.append(f'{latency}_sum{{operation="{name}"}} {total}')
+            for exception, value in raised:
+                error_lines.append(f'{errors}{{operation="{name}",exception="{exception}"}} {value}')
+
+        lines += error_lines
+
+        for name, description, histogram, lock in self._histograms:
+            with lock:
+                quantiles = [(q, histogram.percentile(q * 100)) for q in self.QUANTILES]
+                count, total = histogram.count, histogram.sum
+
+            lines.append(f'# HELP {self.prefix}_{name} {description}')
+            lines.append(f'# TYPE {self.prefix}_{name} summary')
+            for q, value in quantiles:
+                lines.append(f'{self.prefix}_{name}{{quantile="{q}"}} {value}')
+            lines.append(f'{self.prefix}_{name}_count {count}')
+            lines.append(f'{self.prefix}_{name}_sum {total}')
+
+        for name, description, value, kind in self._gauges:
+            lines.append(f'# HELP {self.prefix}_{name} {description}')
+            lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+            lines.append(f'{self.prefix}_{name} {value()}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        """ Starts HTTP server exposing metrics at given port in background thread """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        return server
@@ -0,0 +1,275 @@
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, Set
+
+import grpc
+from argparse_utils import enum_action
+from loguru import logger
+
+import idl.exchange_rates_pb2 as proto
+from exchange_rates import Currency, read_message, write_message
+from idl.exchange_rates_pb2_grpc import ExchangeRatesServiceStub
+
+# function starting upstream subscription, returns stream of updates
+Upstream = Callable[[proto.ExchangeRatesSubscription], Iterable[proto.ExchangeRatesUpdate]]
+
+
+def grpc_upstream(host: str, port: int) -> Upstream:
+    """ Returns upstream subscribing to exchange rates service at given address """
+    channel = grpc.insecure_channel(f'{host}:{port}')
+    return ExchangeRatesServiceStub(channel).subscribe
+
+
+class _Subscriber:
+    """
+    Bank connected to relay.
+    Rates are sent by subscriber's own thread, rates not sent yet are replaced by newer ones,
+    so slow bank gets fewer updates instead of delaying other banks.
+    """
+
+    def __init__(self, connection: socket.socket, subscription: proto.ExchangeRatesSubscription):
+        self.connection = connection
+        self.base_currency = Currency(subscription.baseCurrency)
+        self.currencies = {Currency(c) for c in subscription.requestedCurrencies}
+
+        # rates waiting for sending, with upstream time of the newest update they come from
+        self._pending: Dict[Currency, float] = {}
+        self._timestamp = 0.
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def offer(self, rates: Dict[Currency, float], timestamp: float = 0.):
+        """ Queues rates for sending, without blocking, timestamp is upstream time of update or 0 if unknown """
+        with self._condition:
+            self._pending.update(rates)
+            self._timestamp = max(self._timestamp, timestamp)
+            self._condition.notify()
+
+    def send_loop(self, on_error: Callable[['_Subscriber'], None]):
+        """ Sends queued rates until subscriber is closed, calls on_error when sending fails """
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                rates, self._pending = self._pending, {}
+                timestamp, self._timestamp = self._timestamp, 0.
+
+            update = proto.ExchangeRatesUpdate(timestamp=timestamp)
+            for currency in sorted(rates):
+                update.rates.add(currency=int(currency), value=rates[currency])
+
+            try:
+                write_message(self.connection, update)
+            except OSError as err:
+                logger.debug('Failed to send exchange rates to bank: {}', err)
+                on_error(self)
+                return
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.connection.close()
+
+
+class RatesRelay:
+    """
+    Local exchange rates relay.
+    Keeps single upstream subscription for union of currencies requested by banks connected over unix socket,
+    and sends them updates converted to their base currencies.
+    Bank which does not receive update within send timeout is disconnected.
+    """
+
+    def __init__(self, upstream: Upstream, path: str, base_currency: Currency = Currency.EUR, send_timeout: float = 10.):
+        """ Creates relay listening at given unix socket path """
+        self._upstream = upstream
+        self._path = path
+        self._base_currency = base_currency
+        self._send_timeout = send_timeout
+
+        # rates relative to relay base currency
+        self._rates: Dict[Currency, float] = {base_currency: 1.0}
+        self._subscribers = []
+        self._currencies: Set[Currency] = set()
+        self._lock = threading.Lock()
+
+        # upstream subscription, generation changes with every change of subscribed currencies
+        self._call = None
+        self._generation = 0
+        self._currencies_changed = threading.Condition(self._lock)
+
+    def serve(self, retry_time: float = 5.):
+        """ Starts upstream subscription and accepts banks, blocks forever """
+        threading.Thread(target=self._upstream_loop, args=(retry_time,), daemon=True).start()
+
+        # setup socket
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._path)
+        server.listen()
+
+        logger.info('Exchange rates relay listening at {}', self._path)
+
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    def _handle(self, connection: socket.socket):
+        """ Registers connected bank and waits until it disconnects """
+        try:
+            subscriber = _Subscriber(connection, read_message(connection, proto.ExchangeRatesSubscription))
+        except (OSError, ValueError):
+            connection.close()
+            return
+
+        # limit time of blocking send, slow bank is disconnected instead of falling behind forever
+        seconds = int(self._send_timeout)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                              struct.pack('ll', seconds, int((self._send_timeout - seconds) * 1e6)))
+        threading.Thread(target=subscriber.send_loop, args=(self._remove,), daemon=True).start()
+
+        with self._lock:
+            self._subscribers.append(subscriber)
+
+            # send rates that are already known
+            self._offer(subscriber, subscriber.currencies)
+
+            # extend upstream subscription if needed
+            required = subscriber.currencies | {subscriber.base_currency}
+            required.discard(self._base_currency)
+            if not required <= self._currencies:
+                self._currencies |= required
+                self._resubscribe()
+
+        logger.debug('Bank attached to relay, {} banks attached', len(self._subscribers))
+
+        # wait for disconnection, banks do not send anything after subscription
+        try:
+            while connection.recv(1024):
+                pass
+        except OSError:
+            pass
+
+        self._remove(subscriber)
+
+    def _remove(self, subscriber: _Subscriber):
+        with self._lock:
+            if subscriber not in self._subscribers:
+                return
+            self._subscribers.remove(subscriber)
+        subscriber.close()
+
+    def _resubscribe(self):
+        """
+        Restarts upstream subscription with current currencies, should be called with lock held.
+        Upstream call is cancelled if it supports it, otherwise upstream loop resubscribes after next update.
+        """
+        self._generation += 1
+        if self._call is not None and hasattr(self._call, 'cancel'):
+            self._call.cancel()
+        self._currencies_changed.notify()
+
+    def _upstream_loop(self, retry_time: float):
+        """ Receives updates from upstream, restarts subscription when requested currencies change """
+        while True:
+
+            # start subscription, call is replaced under lock so that resubscribe cancels the current one
+            with self._lock:
+                while not self._currencies:
+                    self._currencies_changed.wait()
+
+                generation = self._generation
+                req = proto.ExchangeRatesSubscription()
+                req.baseCurrency = int(self._base_currency)
+                req.requestedCurrencies[:] = [int(c) for c in sorted(self._currencies)]
+
+                try:
+                    self._call = call = self._upstream(req)
+                except Exception as err:
+                    self._call = call = None
+                    logger.debug('Failed to subscribe to upstream exchange rates: {}', err)
+
+            if call is not None:
+                logger.debug('Subscribed to upstream exchange rates for {}', [Currency(c) for c in req.requestedCurrencies])
+                try:
+                    for update in call:
+                        self._dispatch(update)
+                        if generation != self._generation:
+                            break
+                except Exception as err:
+                    if generation == self._generation:
+                        logger.debug('Lost upstream exchange rates subscription: {}', err)
+
+            # resubscribe immediately when currencies changed
+            with self._lock:
+                if generation != self._generation:
+                    continue
+
+            logger.debug('Resubscribing in {} seconds...', retry_time)
+            time.sleep(retry_time)
+
+    def _dispatch(self, update: proto.ExchangeRatesUpdate):
+        """ Saves upstream update and queues it for banks interested in changed currencies """
+        changed = {Currency(rate.currency) for rate in update.rates}
+
+        with self._lock:
+            for rate in update.rates:
+                self._rates[Currency(rate.currency)] = rate.value
+
+            # change of bank base currency rate changes all its rates
+            for subscriber in self._subscribers:
+                if subscriber.base_currency in changed:
+                    self._offer(subscriber, subscriber.currencies, update.timestamp)
+                else:
+                    self._offer(subscriber, subscriber.currencies & changed, update.timestamp)
+
+    def _offer(self, subscriber: _Subscriber, currencies: Set[Currency], timestamp: float = 0.):
+        """ Queues known rates of given currencies converted to subscriber base currency, should be called with lock held """
+        base_rate = self._rates.get(subscriber.base_currency)
+        if base_rate is None:
+            return
+
+        rates = {currency: self._rates[currency] / base_rate for currency in currencies if currency in self._rates}
+        if rates:
+            subscriber.offer(rates, timestamp)
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Exchange rates relay shared by local banks')
+
+    parser.add_argument('-s', '--socket',
+                        required=True,
+                        help='Path of unix socket to listen at'
+                        )
+    parser.add_argument('-eh', '--exchange-host',
+                        required=True,
+                        help='Host of exchange rates service'
+                        )
+    parser.add_argument('-ep', '--exchange-port',
+                        type=int,
+                        required=True,
+                        help='Port of exchange rates service'
+                        )
+    parser.add_argument('-b', '--base-currency',
+                        action=enum_action(Currency),
+                        default=Currency.EUR,
+                        help='Base currency of upstream subscription'
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    args = _parse_arguments()
+
+    # start relay
+    RatesRelay(grpc_upstream(args.exchange_host, args.exchange_port), args.socket, args.base_currency).serve()
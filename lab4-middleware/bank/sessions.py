@@ -0,0 +1,53 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class SessionTable:
+    """
+    Table of short-lived session tokens, maps token to pesel of logged in client.
+    All sessions live for the same time, so insertion order is expiry order and expired ones are evicted from the front.
+    """
+
+    def __init__(self, timeout: float):
+        """ Creates empty table of sessions expiring after timeout seconds """
+        self.timeout = timeout
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, pesel: str) -> Tuple[str, float]:
+        """ Creates session of given client, returns its token and expiry time """
+        token = secrets.token_urlsafe(16)
+        expires = time.monotonic() + self.timeout
+
+        with self._lock:
+            self._evict()
+            self._sessions[token] = (pesel, expires)
+
+        return token, expires
+
+    def get(self, token: str) -> Optional[str]:
+        """ Returns pesel of client owning given token, or None if there is no such session or it has expired """
+        session = self._sessions.get(token)
+        if session is None or session[1] < time.monotonic():
+            return None
+        return session[0]
+
+    def revoke(self, token: str):
+        """ Removes session with given token """
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    def _evict(self):
+        """ Removes expired sessions, should be called with lock held """
+        now = time.monotonic()
+        while self._sessions:
+            token, (_, expires) = next(iter(self._sessions.items()))
+            if expires >= now:
+                break
+            del self._sessions[token]
@@ -0,0 +1,243 @@
+import argparse
+import bisect
+import hashlib
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, Iterable, List
+
+import Ice
+from loguru import logger
+
+# fix broken ice imports
+sys.path.append('./idl')
+import Banking
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping pesels to shards.
+    Every shard is placed on the ring at many points, so accounts are spread evenly
+    and adding a shard moves only accounts falling between its points and their predecessors.
+    """
+
+    def __init__(self, shards: Iterable[str] = (), points: int = 128):
+        """ Creates ring of given shards, each placed at given number of points """
+        self.points = points
+        self._hashes: List[int] = []
+        self._owners: List[str] = []
+        for shard in shards:
+            self.add(shard)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        """ Stable hash of key, the same in every process unlike builtin hash """
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+    @property
+    def shards(self) -> List[str]:
+        return sorted(set(self._owners))
+
+    def add(self, shard: str):
+        """ Places shard on the ring """
+        for point in range(self.points):
+            value = self._hash(f'{shard}#{point}')
+            index = bisect.bisect(self._hashes, value)
+            self._hashes.insert(index, value)
+            self._owners.insert(index, shard)
+
+    def remove(self, shard: str):
+        """ Removes shard from the ring """
+        points = [(h, o) for h, o in zip(self._hashes, self._owners) if o != shard]
+        self._hashes = [h for h, _ in points]
+        self._owners = [o for _, o in points]
+
+    def owner(self, pesel: str) -> str:
+        """ Returns shard owning account with given pesel, the first one clockwise from its hash """
+        if not self._hashes:
+            raise ValueError('Hash ring has no shards')
+        index = bisect.bisect(self._hashes, self._hash(pesel)) % len(self._hashes)
+        return self._owners[index]
+
+
+class BankRouter(Banking.Bank):
+    """
+    Front bank of sharded deployment.
+    Routes requests to bank process owning the account, registration results contain proxies of accounts at that shard,
+    so clients talk to shards directly afterwards. Forwarded calls are dispatched asynchronously and do not block router threads.
+    """
+
+    def __init__(self, communicator, shards: Dict[str, str]):
+        """ Creates router of shards given as name to endpoints mapping """
+        self.ring = HashRing(shards)
+        self._banks = {name: Banking.BankPrx.uncheckedCast(communicator.stringToProxy(f'Bank:{endpoints}')) for name, endpoints in shards.items()}
+        self._shards = {name: Banking.ShardPrx.uncheckedCast(communicator.stringToProxy(f'Shard:{endpoints}')) for name, endpoints in shards.items()}
+
+    def _owner(self, pesel: str):
+        return self._banks[self.ring.owner(pesel)]
+
+    def rebalance(self, limit: int = 1000) -> int:
+        """
+        Moves every account to shard owning it in the ring, in chunks of at most limit accounts, returns number of moved accounts.
+        Accounts are frozen at source shard until owner imports them, and removed from source only afterwards,
+        so interrupted rebalance leaves every account in at least one shard and can simply be run again.
+        """
+        names = self.ring.shards
+        moved = 0
+
+        for name, shard in self._shards.items():
+            while True:
+
+                # copy accounts not owned by the shard anymore, they are frozen until confirmed or aborted
+                states = shard.exportAccounts(names, name, limit)
+                if not states:
+                    break
+
+                # accounts owned by the source itself must never be confirmed, it holds their only copy
+                owned = defaultdict(list)
+                imported, kept = [], []
+                for state in states:
+                    owner = self.ring.owner(state.pesel)
+                    if owner == name:
+                        kept.append(state.pesel)
+                    else:
+                        owned[owner].append(state)
+
+                # import them at their owners
+                for owner, owner_states in owned.items():
+                    try:
+                        rejected = set(self._shards[owner].importAccounts(owner_states))
+                    except Ice.Exception:
+                        logger.exception('Failed to move {} accounts from shard {} to shard {}, keeping them', len(owner_states), name, owner)
+                        shard.confirmExport(imported)
+                        done = set(imported)
+                        shard.abortExport([s.pesel for s in states if s.pesel not in done])
+                        raise
+
+                    # account with the same pesel but different state already exists at owner, keep it where it was
+                    if rejected:
+                        logger.warning('Shard {} rejected accounts {}, keeping them at shard {}', owner, sorted(rejected), name)
+
+                    imported.extend(s.pesel for s in owner_states if s.pesel not in rejected)
+                    kept.extend(rejected)
+
+                # remove imported accounts from source
+                shard.confirmExport(imported)
+                if kept:
+                    shard.abortExport(kept)
+
+                moved += len(imported)
+
+        logger.info('Rebalanced {} shards, moved {} accounts', len(names), moved)
+
+        return moved
+
+    def registerAccount(self, firstName: str, lastName: str, pesel: str, declaredMonthlyIncome: float, current=None):
+        return self._owner(pesel).registerAccountAsync(firstName, lastName, pesel, declaredMonthlyIncome)
+
+    def recoverAccount(self, pesel: str, password: str, current=None):
+        return self._owner(pesel).recoverAccountAsync(pesel, password)
+
+    def login(self, pesel: str, password: str, current=None):
+        return self._owner(pesel).loginAsync(pesel, password)
+
+    def logout(self, token: str, current=None):
+
+        # token does not identify shard, every shard revokes it if it knows it
+        for bank in self._banks.values():
+            bank.logoutAsync(token)
+
+    def getExchangeRatesStatus(self, current=None):
+        return self._banks[self.ring.owner('')].getExchangeRatesStatusAsync()
+
+    def executeBulk(self, batches, atomic: bool, current=None):
+
+        # group batches by shard
+        groups = OrderedDict()
+        for index, batch in enumerate(batches):
+            groups.setdefault(self.ring.owner(batch.pesel), []).append(index)
+
+        # forward bulk of single shard as it is
+        if len(groups) <= 1:
+            owner = next(iter(groups), self.ring.owner(''))
+            return self._banks[owner].executeBulkAsync(batches, atomic)
+
+        # atomicity would require distributed transaction
+        if atomic:
+            raise Banking.PermissionException('Atomic bulk operations cannot span accounts of many shards')
+
+        # execute parts at all shards and merge their statuses in original order
+        result = Ice.Future()
+        statuses = [None] * len(batches)
+        remaining = [len(groups)]
+        lock = threading.Lock()
+
+        def completed(future, indexes):
+            with lock:
+                if result.done():
+                    return
+                try:
+                    for index, batch_statuses in zip(indexes, future.result()):
+                        statuses[index] = batch_statuses
+                except Exception as err:
+                    result.set_exception(err)
+                    return
+                remaining[0] -= 1
+                if not remaining[0]:
+                    result.set_result(statuses)
+
+        for owner, indexes in groups.items():
+            future = self._banks[owner].executeBulkAsync([batches[i] for i in indexes], False)
+            future.add_done_callback(lambda f, indexes=indexes: completed(f, indexes))
+
+        return result
+
+
+def _parse_shard(value: str):
+    name, address = value.split('=')
+    host, port = address.rsplit(':', 1)
+    return name, f'default -h {host} -p {int(port)}'
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Router of sharded bank')
+
+    parser.add_argument('-p', '--port',
+                        type=int,
+                        required=True,
+                        help='Port to listen to'
+                        )
+    parser.add_argument('-s', '--shards',
+                        type=_parse_shard,
+                        nargs='+',
+                        required=True,
+                        help='Shards as name=host:port, names have to stay the same between restarts'
+                        )
+    parser.add_argument('-l', '--rebalance-limit',
+                        type=int,
+                        default=1000,
+                        help='Maximum number of accounts moved between shards in single request'
+                        )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    args = _parse_arguments()
+
+    with Ice.initialize() as communicator:
+
+        # move accounts to their shards before accepting requests, e.g. after a shard was added
+        router = BankRouter(communicator, dict(args.shards))
+        router.rebalance(args.rebalance_limit)
+
+        # setup adapter
+        adapter = communicator.createObjectAdapterWithEndpoints('RouterAdapter', f'default -p {args.port}')
+        adapter.add(router, communicator.stringToIdentity('Bank'))
+        adapter.activate()
+
+        logger.info('Bank router started at port {}', args.port)
+
+        communicator.waitForShutdown()
@@ -0,0 +1,175 @@
+"""
+Tests of exchange rates relay with in-process fake upstream and banks attached over unix socket.
+
+Run from bank directory: python -m unittest test_rates_relay
+"""
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import idl.exchange_rates_pb2 as proto
+from exchange_rates import Currency, read_message, write_message
+from rates_relay import RatesRelay
+
+
+def _update(**rates) -> proto.ExchangeRatesUpdate:
+    update = proto.ExchangeRatesUpdate()
+    for name, value in rates.items():
+        update.rates.add(currency=int(Currency[name]), value=value)
+    return update
+
+
+class _FakeCall:
+    """ Upstream stream of updates pushed by test, cancellable like grpc call """
+
+    def __init__(self, updates: queue.Queue):
+        self._updates = updates
+        self.cancelled = False
+
+    def __iter__(self):
+        while not self.cancelled:
+            try:
+                update = self._updates.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            yield update
+        raise RuntimeError('Call cancelled')
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _FakeUpstream:
+    """ Upstream recording subscriptions, updates pushed by test go to the current one """
+
+    def __init__(self, cancellable: bool = True):
+        self.cancellable = cancellable
+        self.requests = queue.Queue()
+        self.updates = queue.Queue()
+
+    def __call__(self, request):
+        self.requests.put({Currency(c) for c in request.requestedCurrencies})
+        call = _FakeCall(self.updates)
+        return call if self.cancellable else iter(call)
+
+
+class RatesRelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, 'relay.sock')
+        self.banks = []
+
+    def tearDown(self):
+        for bank in self.banks:
+            bank.close()
+        self._directory.cleanup()
+
+    def _start(self, upstream, **kwargs) -> RatesRelay:
+        relay = RatesRelay(upstream, self.path, Currency.EUR, **kwargs)
+        threading.Thread(target=relay.serve, args=(0.05,), daemon=True).start()
+        deadline = time.monotonic() + 5
+        while not os.path.exists(self.path):
+            self.assertLess(time.monotonic(), deadline, 'Relay did not start')
+            time.sleep(0.01)
+        return relay
+
+    def _attach(self, base: Currency, *currencies: Currency) -> socket.socket:
+        bank = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        bank.settimeout(5)
+        bank.connect(self.path)
+        subscription = proto.ExchangeRatesSubscription()
+        subscription.baseCurrency = int(base)
+        subscription.requestedCurrencies[:] = [int(c) for c in currencies]
+        write_message(bank, subscription)
+        self.banks.append(bank)
+        return bank
+
+    def _wait_for_banks(self, relay: RatesRelay, count: int):
+        deadline = time.monotonic() + 5
+        while len(relay._subscribers) < count:
+            self.assertLess(time.monotonic(), deadline, 'Banks did not attach')
+            time.sleep(0.01)
+
+    @staticmethod
+    def _receive(bank: socket.socket):
+        return {Currency(r.currency): r.value for r in read_message(bank, proto.ExchangeRatesUpdate).rates}
+
+    def test_single_upstream_for_union_of_currencies(self):
+        upstream = _FakeUpstream()
+        self._start(upstream)
+
+        usd_bank = self._attach(Currency.EUR, Currency.USD)
+        self.assertEqual(upstream.requests.get(timeout=5), {Currency.USD})
+        upstream.updates.put(_update(USD=1.25))
+        self.assertEqual(self._receive(usd_bank), {Currency.USD: 1.25})
+
+        # another bank extends upstream subscription, rates are converted to its base currency
+        pln_bank = self._attach(Currency.PLN, Currency.GBP)
+        self.assertEqual(upstream.requests.get(timeout=5), {Currency.USD, Currency.GBP, Currency.PLN})
+        upstream.updates.put(_update(GBP=0.5, PLN=4.))
+        self.assertEqual(self._receive(pln_bank), {Currency.GBP: 0.125})
+
+    def test_upstream_timestamp_is_forwarded(self):
+        upstream = _FakeUpstream()
+        self._start(upstream)
+
+        bank = self._attach(Currency.EUR, Currency.USD)
+        self.assertEqual(upstream.requests.get(timeout=5), {Currency.USD})
+        update = _update(USD=1.25)
+        update.timestamp = 1234.5
+        upstream.updates.put(update)
+        self.assertEqual(read_message(bank, proto.ExchangeRatesUpdate).timestamp, 1234.5)
+
+    def test_resubscribe_without_cancellable_upstream(self):
+        upstream = _FakeUpstream(cancellable=False)
+        relay = self._start(upstream)
+
+        self._attach(Currency.EUR, Currency.USD)
+        self.assertEqual(upstream.requests.get(timeout=5), {Currency.USD})
+
+        # upstream cannot be cancelled, subscription is restarted after its next update
+        gbp_bank = self._attach(Currency.EUR, Currency.GBP)
+        self._wait_for_banks(relay, 2)
+        upstream.updates.put(_update(USD=1.25))
+        self.assertEqual(upstream.requests.get(timeout=5), {Currency.USD, Currency.GBP})
+        upstream.updates.put(_update(GBP=0.5))
+        self.assertEqual(self._receive(gbp_bank), {Currency.GBP: 0.5})
+
+    def test_blocked_bank_does_not_delay_others(self):
+        upstream = _FakeUpstream()
+        relay = self._start(upstream)
+
+        self._attach(Currency.EUR, Currency.USD)
+        self.assertEqual(upstream.requests.get(timeout=5), {Currency.USD})
+        fast_bank = self._attach(Currency.EUR, Currency.USD)
+        self._wait_for_banks(relay, 2)
+
+        # sending to the first bank blocks until released
+        blocked, released = threading.Event(), threading.Event()
+
+        class _BlockingConnection:
+            def sendall(self, data):
+                blocked.set()
+                released.wait()
+
+            def close(self):
+                pass
+
+        relay._subscribers[0].connection = _BlockingConnection()
+
+        # updates not sent yet are replaced by newer ones, so the last one is eventually received
+        for value in (1.25, 1.5, 1.75):
+            upstream.updates.put(_update(USD=value))
+        while self._receive(fast_bank)[Currency.USD] != 1.75:
+            pass
+        self.assertTrue(blocked.wait(5))
+        released.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+Tests of moving accounts between shards running in-process, with router calling them through Ice.
+
+Run from bank directory after generating ice stubs: python -m unittest test_sharding
+"""
+import unittest
+
+import Ice
+
+from account_store import AccountRecord
+from bank import BankI, ShardI
+from exchange_rates import Currency, ExchangeRates
+from sharding import BankRouter, HashRing
+
+
+class RebalanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.communicator = Ice.initialize()
+        self.banks, self.shards, self.endpoints = {}, {}, {}
+        for name in ('a', 'b', 'c'):
+            adapter = self.communicator.createObjectAdapterWithEndpoints(f'Shard-{name}', 'tcp -h 127.0.0.1')
+            bank = BankI(adapter, ExchangeRates(Currency.PLN, [Currency.USD]), Currency.PLN, [Currency.USD], 10000)
+            shard = ShardI(bank)
+            adapter.add(bank, Ice.stringToIdentity('Bank'))
+            adapter.add(shard, Ice.stringToIdentity('Shard'))
+            adapter.activate()
+            self.banks[name], self.shards[name] = bank, shard
+            self.endpoints[name] = adapter.getEndpoints()[0].toString()
+
+    def tearDown(self):
+        self.communicator.destroy()
+
+    def _register(self, name: str, count: int):
+        for i in range(count):
+            record = AccountRecord('Jan', 'Kowalski', f'{i:011}', 1000., 'password', False)
+            record.balance[Currency.PLN] = i
+            self.banks[name].add_account(record)
+
+    def _router(self, *names: str) -> BankRouter:
+        return BankRouter(self.communicator, {name: self.endpoints[name] for name in names})
+
+    def _placement(self):
+        """ Returns shards holding every pesel, and total balance of all accounts """
+        placement, total = {}, 0.
+        for name, bank in self.banks.items():
+            for record in bank.accounts.values():
+                placement.setdefault(record.pesel, []).append(name)
+                total += record.balance[Currency.PLN]
+        return placement, total
+
+    def test_accounts_are_moved_to_their_owners(self):
+        self._register('a', 50)
+        router = self._router('a', 'b', 'c')
+        router.rebalance(limit=7)
+
+        placement, total = self._placement()
+        self.assertEqual(len(placement), 50)
+        self.assertEqual(total, sum(range(50)))
+        for pesel, names in placement.items():
+            self.assertEqual(names, [router.ring.owner(pesel)])
+
+    def test_interrupted_export_and_changed_ring(self):
+        self._register('a', 50)
+
+        # export from shard a is interrupted, accounts owned by c under the old ring stay frozen
+        exported = self.shards['a'].exportAccounts(['a', 'b', 'c'], 'a', 50)
+        old_ring, new_ring = HashRing(['a', 'b', 'c']), HashRing(['a', 'b'])
+        self.assertTrue(any(old_ring.owner(s.pesel) == 'c' and new_ring.owner(s.pesel) == 'a' for s in exported))
+
+        # shard c is removed, so some of them are owned by their source now
+        router = self._router('a', 'b')
+        router.rebalance(limit=7)
+
+        placement, total = self._placement()
+        self.assertEqual(len(placement), 50)
+        self.assertEqual(total, sum(range(50)))
+        for pesel, names in placement.items():
+            self.assertEqual(names, [router.ring.owner(pesel)])
+        self.assertEqual(self.banks['a'].accounts.frozen(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
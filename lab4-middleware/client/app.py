@@ -17,6 +17,17 @@ def _parse_arguments():
 
     parser.add_argument('port', help='Port of bank server', type=int)
 
+    parser.add_argument('-s', '--script',
+                        type=argparse.FileType('r'),
+                        help='File with commands to execute instead of starting interactive shell, - for stdin'
+                        )
+
+    parser.add_argument('-w', '--window',
+                        type=int,
+                        default=64,
+                        help='Maximum number of asynchronous requests in flight when executing script'
+                        )
+
     return parser.parse_args()
 
 
@@ -34,5 +45,8 @@ if __name__ == '__main__':
         if not bank_proxy:
             raise RuntimeError("Invalid Bank proxy")
 
-        # start cli
-        ClientShell(bank_proxy).cmdloop()
+        # execute script, or start cli
+        if args.script:
+            ClientShell(bank_proxy, args.window).run_script(args.script)
+        else:
+            ClientShell(bank_proxy).cmdloop()
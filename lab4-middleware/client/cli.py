@@ -1,4 +1,6 @@
 import cmd
+import threading
+import time
 from argparse import ArgumentParser
 from functools import wraps
 
@@ -15,6 +17,36 @@ def _currency(currency: str):
     return _CURRENCY_MAP[currency.upper()]
 
 
+_OPERATION_TYPE_MAP = {t.name: t for t in Banking.OperationType._enumerators.values()}
+
+
+def _read_operations(path: str):
+    """ Reads operations from file, one `<deposit|withdraw> <currency> <amount>` per line """
+    operations = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            operation_type, currency, amount = line.split()
+            operations.append(Banking.Operation(_OPERATION_TYPE_MAP[operation_type.upper()], _currency(currency), float(amount)))
+    return operations
+
+
+def _account_proxy(result):
+    """ Casts account proxy from registration result, type is already known so no round trip is needed """
+    if result.type == Banking.AccountType.PREMIUM:
+        return Banking.PremiumAccountPrx.uncheckedCast(result.account)
+    return Banking.AccountPrx.uncheckedCast(result.account)
+
+
+def _print_error(err: Exception):
+    if isinstance(err, Banking.BaseException):
+        print('Error:', err.message)
+    else:
+        print('Error:', str(err))
+
+
 def argument(*args, **kwargs):
     """ Decorator that parses arguments using argparse parser """
     def parse_decorator(func):
@@ -47,21 +79,139 @@ def except_errors(func):
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
-        except Banking.BaseException as err:
-            print('Error:', err.message)
         except Exception as err:
-            print('Error:', str(err))
+            _print_error(err)
     return wrapper
 
 
+class _Call:
+    """ Asynchronous call of pipelined mode, started when calls it waits for complete """
+
+    def __init__(self, invoke, then, pesels):
+        self.invoke = invoke
+        self.then = then
+        self.pesels = pesels
+        self.waiting = 0
+        self.dependents = []
+
+
 class ClientShell(cmd.Cmd):
     intro = 'Welcome to bank client shell. Type help or ? to list commands.'
 
-    def __init__(self, bank):
+    def __init__(self, bank, window: int = 0):
+        """
+        Creates shell for given bank.
+        If window is positive account operations are sent asynchronously, with at most window of them in flight.
+        Server may dispatch calls of one connection concurrently, so call is sent only after earlier calls
+        of the same accounts complete, calls of different accounts are pipelined.
+        """
         super().__init__()
         self.bank = bank
         self.account = None
         self.accounts = {}
+        self.sessions = {}
+        self._window_size = window
+        self._window = threading.BoundedSemaphore(window) if window > 0 else None
+
+        # last call of every account which is not completed yet
+        self._last_calls = {}
+        self._calls_lock = threading.Lock()
+
+    def _call(self, operation: str, *args, then=None, targets=()):
+        """
+        Invokes operation of active account and passes its result to then, asynchronously in pipelined mode.
+        Targets are pesels of other accounts changed by operation, its call is ordered after their earlier calls too.
+        """
+        proxy = self.account.account
+        context = self._context()
+
+        # blocking call
+        if self._window is None:
+            result = getattr(proxy, operation)(*args, context)
+            if then:
+                then(result)
+            return
+
+        # asynchronous call, waits if window is full
+        self._window.acquire()
+        call = _Call(lambda: getattr(proxy, operation + 'Async')(*args, context), then, {self.account.pesel, *targets})
+
+        # wait for earlier calls of the same accounts
+        with self._calls_lock:
+            for pesel in call.pesels:
+                previous = self._last_calls.get(pesel)
+                if previous is not None:
+                    previous.dependents.append(call)
+                    call.waiting += 1
+                self._last_calls[pesel] = call
+            ready = call.waiting == 0
+
+        if ready:
+            self._start(call)
+
+    def _start(self, call: _Call):
+        try:
+            future = call.invoke()
+        except Exception as err:
+            _print_error(err)
+            self._completed(call)
+            return
+        future.add_done_callback(lambda f: self._completed(call, f))
+
+    def _completed(self, call: _Call, future=None):
+        try:
+            if future is not None:
+                result = future.result()
+                if call.then:
+                    call.then(result)
+        except Exception as err:
+            _print_error(err)
+        finally:
+            self._window.release()
+
+        # start calls waiting only for this one, even if it failed, as blocking calls would be
+        with self._calls_lock:
+            for pesel in call.pesels:
+                if self._last_calls.get(pesel) is call:
+                    del self._last_calls[pesel]
+            ready = []
+            for dependent in call.dependents:
+                dependent.waiting -= 1
+                if dependent.waiting == 0:
+                    ready.append(dependent)
+
+        for dependent in ready:
+            self._start(dependent)
+
+    def drain(self):
+        """ Waits until all asynchronous calls complete """
+        if self._window is None:
+            return
+        for _ in range(self._window_size):
+            self._window.acquire()
+        for _ in range(self._window_size):
+            self._window.release()
+
+    def run_script(self, file):
+        """ Executes commands read from file, one per line, and waits for their completion """
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if self.onecmd(line):
+                break
+        self.drain()
+
+    def _context(self):
+        """ Returns request context with session token of active account, logs in again if session is about to expire """
+        token, expires = self.sessions.get(self.account.pesel, (None, 0.))
+
+        if expires <= time.monotonic():
+            session = self.bank.login(self.account.pesel, self.account.password)
+            token, expires = session.token, time.monotonic() + 0.9 * session.timeout
+            self.sessions[self.account.pesel] = (token, expires)
+
+        return {'token': token}
 
     @property
     def prompt(self):
@@ -84,10 +234,7 @@ class ClientShell(cmd.Cmd):
             declaredMonthlyIncome=args.income
         )
 
-        if result.type == Banking.AccountType.PREMIUM:
-            result.account = Banking.PremiumAccountPrx.checkedCast(result.account)
-        else:
-            result.account = Banking.AccountPrx.checkedCast(result.account)
+        result.account = _account_proxy(result)
 
         self.accounts[args.pesel] = result
         self.account = result
@@ -104,10 +251,7 @@ class ClientShell(cmd.Cmd):
             password=args.password
         )
 
-        if result.type == Banking.AccountType.PREMIUM:
-            result.account = Banking.PremiumAccountPrx.checkedCast(result.account)
-        else:
-            result.account = Banking.AccountPrx.checkedCast(result.account)
+        result.account = _account_proxy(result)
 
         self.accounts[args.pesel] = result
         self.account = result
@@ -120,6 +264,18 @@ class ClientShell(cmd.Cmd):
         table = [(a.pesel, a.firstName, a.lastName, a.type) for a in self.accounts.values()]
         print(tabulate(table, headers=["pesel", "first name", "last name", "type"]))
 
+    @except_errors
+    def do_rates(self, args):
+        """ Display state of bank exchange rates subscription """
+        status = self.bank.getExchangeRatesStatus()
+        table = [
+            ("version", status.version),
+            ("age", status.age),
+            ("reconnects", status.reconnects),
+            ("time without rates", status.timeWithoutRates)
+        ]
+        print(tabulate(table))
+
     @except_errors
     @argument('pesel')
     def do_switch(self, args):
@@ -134,20 +290,53 @@ class ClientShell(cmd.Cmd):
     @argument('currency', type=_currency)
     def do_deposit(self, args):
         """ Deposit money in given currency """
-        self.account.account.deposit(args.currency, args.amount, {'password': self.account.password})
+        self._call('deposit', args.currency, args.amount)
 
     @except_errors
     @argument('amount', type=float)
     @argument('currency', type=_currency)
     def do_withdraw(self, args):
         """ Withdraw money in given currency """
-        self.account.account.withdraw(args.currency, args.amount, {'password': self.account.password})
+        self._call('withdraw', args.currency, args.amount)
+
+    @except_errors
+    @argument('amount', type=float)
+    @argument('target_currency', type=_currency)
+    @argument('currency', type=_currency)
+    @argument('target_pesel')
+    def do_transfer(self, args):
+        """ Transfer money to another account, converting it if currencies differ """
+        self._call('transfer', args.target_pesel, args.currency, args.target_currency, args.amount, targets=(args.target_pesel,), then=lambda result: print(
+            f'Transferred {result.withdrawn} {args.currency.name} as {result.deposited} {args.target_currency.name}'
+        ))
+
+    @except_errors
+    @argument('amount', type=float)
+    @argument('target_currency', type=_currency)
+    @argument('currency', type=_currency)
+    def do_exchange(self, args):
+        """ Exchange money between currencies of account """
+        self._call('exchange', args.currency, args.target_currency, args.amount, then=lambda result: print(
+            f'Exchanged {result.withdrawn} {args.currency.name} to {result.deposited} {args.target_currency.name}'
+        ))
+
+    @except_errors
+    @argument('--atomic', action='store_true', help='Apply all operations or none of them')
+    @argument('file')
+    def do_batch(self, args):
+        """ Execute operations from file in a single request """
+        operations = _read_operations(args.file)
+
+        def print_statuses(statuses):
+            table = [(o.type, o.currency, o.amount, s) for o, s in zip(operations, statuses)]
+            print(tabulate(table, headers=["operation", "currency", "amount", "status"]))
+
+        self._call('executeBatch', operations, args.atomic, then=print_statuses)
 
     @except_errors
     def do_balance(self, args):
         """ Display account balance """
-        balance = self.account.account.getBalance({'password': self.account.password})
-        print(tabulate(balance.items(), headers=["currency", "amount"]))
+        self._call('getBalance', then=lambda balance: print(tabulate(balance.items(), headers=["currency", "amount"])))
 
     @except_errors
     @argument('months_duration', type=int)
@@ -155,8 +344,19 @@ class ClientShell(cmd.Cmd):
     @argument('currency', type=_currency)
     def do_credit(self, args):
         """ Get credit offer """
-        offer = self.account.account.getCreditOffer(args.currency, args.amount, args.months_duration, {'password': self.account.password})
-        print(f'Credit will cost {offer.foreignCurrency} {args.currency.name}, thats {offer.baseCurrency} {self.account.baseCurrency.name}')
+        base_currency = self.account.baseCurrency
+
+        def print_offer(offer):
+            print(f'Credit will cost {offer.foreignCurrency} {args.currency.name}, thats {offer.baseCurrency} {base_currency.name}')
+            print(f'Priced on exchange rates version {offer.ratesVersion}, updated {offer.ratesAge:.1f} seconds ago')
+
+        self._call('getCreditOffer', args.currency, args.amount, args.months_duration, then=print_offer)
+
+    @except_errors
+    def do_logout(self, args):
+        """ End session of active account """
+        if self.account.pesel in self.sessions:
+            self.bank.logout(self.sessions.pop(self.account.pesel)[0])
 
     def do_exit(self, args):
         """ Exit client shell """
@@ -8,6 +8,7 @@ const protoLoader = require('@grpc/proto-loader');
 // constants
 const PROTO_PATH = path.resolve(__dirname, '../idl/exchange-rates.proto');
 const BASE_CURRENCY = 'EUR';
+const MIN_PING_INTERVAL = 5000;
 const DEFAULT_RATES = {
     EUR: 1.0000,
     USD: 1.1155,
@@ -29,7 +30,13 @@ const proto = grpc.loadPackageDefinition(protoLoader.loadSync(
 class ExchangeRatesServer extends grpc.Server {
 
     constructor(){
-        super();
+
+        // banks ping every 10 seconds by default to detect lost connections, pings more often than
+        // every 5 minutes are refused by default with too_many_pings and connection is closed
+        super({
+            'grpc.keepalive_permit_without_calls': 1,
+            'grpc.http2.min_ping_interval_without_data_ms': MIN_PING_INTERVAL
+        });
 
         // register services
         this.addService(proto.ExchangeRatesService.service, {
@@ -71,7 +78,8 @@ class ExchangeRatesServer extends grpc.Server {
         const self = this;
         // create response
         let response = {
-            rates: []
+            rates: [],
+            timestamp: Date.now() / 1000
         };
 
         // for each requested currency